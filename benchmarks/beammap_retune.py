@@ -0,0 +1,184 @@
+"""
+Beammap.loadFrequencies and Beammap.retuneMap on a full MEC beammap, against the per-resonator loops they replaced.
+
+    python benchmarks/beammap_retune.py [--feedline 3] [--repeat 3] [--seed 0]
+
+Synthetic powersweep files cover every resonator (with some repeated, to check the last entry wins) and the retune
+files reassign the resIDs of one feedline, with failed, missing and new tones. Both implementations must give
+identical frequencies, attenuations, resIDs and flags.
+"""
+import argparse
+import copy
+import os
+import tempfile
+import time
+from glob import glob
+
+import numpy as np
+
+from mkidcore.objects import Beammap
+from mkidcore.pixelflags import beammap as beamMapFlags
+
+
+def best_of(func, repeat):
+    """Return the result of func and the fastest of repeat wall clock timings"""
+    best = float('inf')
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - tic)
+    return result, best
+
+
+def loop_load_frequencies(bmap, filepath):
+    """Beammap.loadFrequencies as it was, looping over the powersweep entries"""
+    powerSweeps = glob(filepath)
+    psData = np.loadtxt(powerSweeps[0])
+    for sweep in powerSweeps[1:]:
+        psData = np.concatenate((psData, np.loadtxt(sweep)))
+    bmap.frequencies = np.full(bmap.resIDs.shape, np.nan)
+    bmap.attenuations = np.full(bmap.resIDs.shape, np.nan)
+    for rID, freq, atten in psData:
+        location = bmap.resIDs == rID
+        bmap.frequencies[location] = freq / (10 ** 6)
+        bmap.attenuations[location] = atten
+
+
+def loop_retune_map(bmap, newIDsboardA=None, newIDsboardB=None):
+    """
+    Beammap.retuneMap as it was, looping over the retune entries and resonators. The board tests use 'is not None'
+    as the old 'if a and b' raised for any board A file of more than one entry, and newResIDs and newFlags are float
+    as full_like can't hold NaN for integer resIDs and flags.
+    """
+    a, b = None, None
+    if newIDsboardA is not None:
+        a = np.genfromtxt(str(newIDsboardA))
+        feedlineGuess = np.floor(np.average(a[~np.isnan(a[:, 0])][:, 0]) / 10000)
+    if newIDsboardB is not None:
+        b = np.genfromtxt(str(newIDsboardB))
+        feedlineGuess = np.floor(np.average(b[~np.isnan(b[:, 0])][:, 0]) / 10000)
+    feedlineBase = feedlineGuess * 10000
+
+    if a is not None:
+        aMask = []
+        for i in range(len(a)):
+            if not np.isnan(a[i][0]) and not np.isnan(a[i][1]):
+                aMask.append((a[i][0] <= feedlineBase + 1023) and (a[i][1] <= feedlineBase + 1023))
+            elif not np.isnan(a[i][0]) and np.isnan(a[i][1]):
+                aMask.append(a[i][0] <= feedlineBase + 1023)
+            elif np.isnan(a[i][0]) and not np.isnan(a[i][1]):
+                aMask.append(a[i][1] <= feedlineBase + 1023)
+        a = a[aMask]
+    if b is not None:
+        bMask = []
+        for i in range(len(b)):
+            if not np.isnan(b[i][0]) and not np.isnan(b[i][1]):
+                bMask.append((b[i][0] >= feedlineBase + 1024) and (b[i][1] >= feedlineBase + 1024))
+            elif not np.isnan(b[i][0]) and np.isnan(b[i][1]):
+                bMask.append(b[i][0] <= feedlineBase + 1024)
+            elif np.isnan(b[i][0]) and not np.isnan(b[i][1]):
+                bMask.append(b[i][1] <= feedlineBase + 1024)
+        b = b[bMask]
+    reassignmentList = np.concatenate([x for x in (a, b) if x is not None], axis=0)
+
+    newResIDs = np.full(bmap.resIDs.shape, np.nan)
+    newFlags = np.full(bmap.flags.shape, np.nan)
+    for i in reassignmentList:
+        if i[2] == 1:
+            mask = bmap.resIDs == i[0]
+            newResIDs[mask] = i[1]
+            newFlags[mask] = beamMapFlags['good']
+        elif i[2] == 4:
+            mask = bmap.resIDs == i[0]
+            newResIDs[mask] = i[1]
+            newFlags[mask] = beamMapFlags['failed']
+
+    if a is not None and b is not None:
+        validIDs = [10000 * feedlineGuess, 10000 * feedlineGuess + 9999]
+    elif a is not None:
+        validIDs = [10000 * feedlineGuess, 10000 * feedlineGuess + 1023]
+    else:
+        validIDs = [10000 * feedlineGuess + 1024, 10000 * feedlineGuess + 9999]
+    mask = (bmap.resIDs >= validIDs[0]) & (bmap.resIDs <= validIDs[1])
+    unused = np.setdiff1d(bmap.resIDs[mask], newResIDs[mask])
+    for i, j in enumerate(bmap.resIDs):
+        if (j >= validIDs[0]) and (j <= validIDs[1]) and np.isnan(newResIDs[i]):
+            newResIDs[i] = unused[0]
+            if unused[0] in reassignmentList[:, 1]:
+                newFlags[i] = beamMapFlags['noDacTone']
+            elif unused[0] in reassignmentList[:, 0]:
+                newFlags[i] = beamMapFlags['failed']
+            else:
+                newFlags[i] = beamMapFlags['noDacTone']
+            unused = np.delete(unused, 0)
+
+    mask2 = mask & (bmap.flags == 0)
+    resIDs, flags = bmap.resIDs.copy(), bmap.flags.copy()
+    resIDs[mask] = newResIDs[mask]
+    flags[mask2] = newFlags[mask2]
+    bmap.resIDs, bmap.flags = resIDs, flags
+
+
+def write_sweeps(directory, bmap, rng, nfiles=10):
+    """Write powersweep files of (resID, frequency (Hz), attenuation (dB)) for every resonator, some repeated"""
+    resids = np.concatenate((bmap.resIDs, rng.choice(bmap.resIDs, bmap.resIDs.size // 20)))
+    data = np.column_stack((resids, rng.uniform(4e9, 8e9, resids.size), rng.integers(40, 80, resids.size)))
+    for i, chunk in enumerate(np.array_split(data, nfiles)):
+        np.savetxt(os.path.join(directory, 'psfreqs_FL{}.txt'.format(i)), chunk, fmt='%d %.1f %d')
+    return os.path.join(directory, 'psfreqs_FL*.txt')
+
+
+def write_retune(directory, bmap, feedline, rng):
+    """Write board A and B retune files (old resID, new resID, flag) reassigning the resIDs of feedline"""
+    files = []
+    for board, (lo, hi) in enumerate(((0, 1023), (1024, 2043))):
+        resids = np.arange(feedline * 10000 + lo, feedline * 10000 + hi + 1, dtype=float)
+        new = resids.copy()
+        swap = rng.choice(resids.size, resids.size // 2, replace=False)
+        new[swap] = new[rng.permutation(swap)]
+        flag = rng.choice([1, 1, 1, 1, 4, 0], resids.size).astype(float)
+        old = resids.copy()
+        new[rng.choice(resids.size, resids.size // 50, replace=False)] = np.nan  # tones not found
+        old[rng.choice(resids.size, resids.size // 50, replace=False)] = np.nan  # new tones
+        old[np.isnan(old) & np.isnan(new)] = resids[np.isnan(old) & np.isnan(new)]
+        files.append(os.path.join(directory, 'board{}.txt'.format('AB'[board])))
+        np.savetxt(files[-1], np.column_stack((old, new, flag)), fmt='%.0f')
+    return files
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--feedline', type=int, default=3, help='Feedline to retune')
+    parser.add_argument('--repeat', type=int, default=3, help='Timing repeats, the best is reported')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    bmap = Beammap('MEC')
+    with tempfile.TemporaryDirectory() as d:
+        sweeps = write_sweeps(d, bmap, rng)
+        boarda, boardb = write_retune(d, bmap, args.feedline, rng)
+        print('MEC beammap, {} resonators'.format(bmap.resIDs.size))
+
+        cases = [('loadFrequencies', loop_load_frequencies, Beammap.loadFrequencies, (sweeps,)),
+                 ('retuneMap A+B', loop_retune_map, Beammap.retuneMap, (boarda, boardb)),
+                 ('retuneMap A', loop_retune_map, Beammap.retuneMap, (boarda, None)),
+                 ('retuneMap B', loop_retune_map, Beammap.retuneMap, (None, boardb))]
+        for name, loop, vectorised, fargs in cases:
+            def run(func):
+                b = copy.deepcopy(bmap)
+                func(b, *fargs)
+                return b
+            old, told = best_of(lambda: run(loop), args.repeat)
+            new, tnew = best_of(lambda: run(vectorised), args.repeat)
+            same = all(np.array_equal(getattr(old, attr), getattr(new, attr), equal_nan=True)
+                       if getattr(old, attr) is not None else getattr(new, attr) is None
+                       for attr in ('resIDs', 'flags', 'frequencies', 'attenuations'))
+            print('  {:16s}: loop {:8.3f} s, vectorised {:7.4f} s, {:7.1f}x, identical: {}'.format(
+                name, told, tnew, told / tnew, same))
+            if not same:
+                raise SystemExit('{} results differ'.format(name))
+
+
+if __name__ == '__main__':
+    main()
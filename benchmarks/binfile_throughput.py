@@ -0,0 +1,103 @@
+"""
+Photon throughput and peak memory of parse and extract, compiled and NumPy, on synthetic bin files.
+
+    python benchmarks/binfile_throughput.py [--arrays mec darkness] [--seconds 5] [--rate 250] [--repeat 5]
+                                            [--nthreads 1] [--output results.json]
+
+Each array gets bin files with realistic per-pixel count rates (synthetic.pixel_rates, mean --rate). Every
+measurement runs in a fresh process so its peak RSS, reported above that of the idle process, is its own.
+Save the results with --output to compare against later runs.
+"""
+import argparse
+import json
+import multiprocessing
+import resource
+import tempfile
+import time
+
+import numpy as np
+
+START = 1547683242
+
+
+def best_of(func, repeat):
+    """Return the result of func and the fastest of repeat wall clock timings"""
+    best = float('inf')
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - tic)
+    return result, best
+
+
+def _peak_rss_mb():
+    """Peak RSS of this process in MB. ru_maxrss is inherited across fork and exec so VmHWM is used if available."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(backend, op, directory, files, array, seconds, repeat, nthreads):
+    """Time op in this process, returning the photon count, best time and peak RSS above that at the start"""
+    from mkidcore.binfile import mkidbin, npbin
+    from mkidcore.instruments import DEFAULT_ARRAY_SIZES
+    from mkidcore.objects import Beammap
+
+    reader = {'c': mkidbin, 'numpy': npbin}[backend]
+    ncols, nrows = DEFAULT_ARRAY_SIZES[array]
+    bmap = Beammap(array.upper(), xydim=(ncols, nrows))
+    ops = {'parse': lambda: reader.parse(files[1]),
+           'extract': lambda: reader.extract(directory, START, seconds - 1, bmap, ncols, nrows, nthreads=nthreads),
+           'window': lambda: reader.extract_window(directory, START, 1.25, 1.3, bmap, ncols, nrows,
+                                                   nthreads=nthreads)}
+    rss0 = _peak_rss_mb()
+    photons, t = best_of(ops[op], repeat)
+    return len(photons), t, _peak_rss_mb() - rss0
+
+
+def main():
+    from mkidcore.binfile import synthetic
+    from mkidcore.instruments import DEFAULT_ARRAY_SIZES
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--arrays', nargs='+', default=['mec', 'darkness'], choices=sorted(DEFAULT_ARRAY_SIZES),
+                        help='Array sizes to benchmark')
+    parser.add_argument('--seconds', type=int, default=5, help='Seconds of data to extract')
+    parser.add_argument('--rate', type=float, default=250, help='Mean count rate per pixel (cts/s)')
+    parser.add_argument('--repeat', type=int, default=5, help='Timing repeats, the best is reported')
+    parser.add_argument('--nthreads', type=int, default=1, help='Threads for extract')
+    parser.add_argument('--backends', nargs='+', default=['c', 'numpy'], choices=['c', 'numpy'])
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    args = parser.parse_args()
+
+    results = []
+    ctx = multiprocessing.get_context('spawn')
+    for array in args.arrays:
+        ncols, nrows = DEFAULT_ARRAY_SIZES[array]
+        with tempfile.TemporaryDirectory() as d:
+            rates = synthetic.pixel_rates(ncols, nrows, mean=args.rate, seed=0)
+            files = synthetic.generate(d, START - 1, args.seconds + 2, ncols, nrows, rate=rates, seed=0)
+            print('{} ({}x{}), {} s at a mean of {:g} cts/pixel/s'.format(array, ncols, nrows, args.seconds,
+                                                                         np.mean(rates)))
+            for backend in args.backends:
+                for op in ('parse', 'extract', 'window'):
+                    with ctx.Pool(1) as pool:
+                        n, t, rss = pool.apply(measure, (backend, op, d, files, array, args.seconds, args.repeat,
+                                                         args.nthreads))
+                    print('  {:5s} {:8s}: {:9d} photons in {:6.3f} s, {:6.2f} Mphotons/s, peak RSS +{:7.1f} MB'.format(
+                        backend, op, n, t, n / t / 1e6, rss))
+                    results.append(dict(array=array, backend=backend, op=op, photons=n, seconds=t,
+                                        photons_per_second=n / t, peak_rss_mb=rss, nthreads=args.nthreads))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,2 +1,31 @@
-from .mkidbin import extract_fake, extract, parse
-__all__=[extract_fake, extract, parse]
+"""
+Readers for Gen2 readout .bin files.
+
+The compiled mkidbin extension is used when it is available, otherwise the pure NumPy npbin reader. Set the
+environment variable MKIDCORE_BINFILE_BACKEND to 'c' or 'numpy' before import to force one, BACKEND is the one in use.
+"""
+import os
+
+from mkidcore.corelog import getLogger
+
+BACKEND = os.environ.get('MKIDCORE_BINFILE_BACKEND', 'auto').lower()
+if BACKEND not in ('auto', 'c', 'numpy'):
+    raise ValueError("MKIDCORE_BINFILE_BACKEND must be 'auto', 'c' or 'numpy', not {}".format(BACKEND))
+
+if BACKEND != 'numpy':
+    try:
+        from .mkidbin import extract_fake, extract, extract_window, iter_extract, parse, Extractor, histogram
+        BACKEND = 'c'
+    except ImportError:
+        if BACKEND == 'c':
+            raise
+        getLogger(__name__).warning('mkidbin extension not compiled, using the NumPy bin file reader')
+        BACKEND = 'numpy'
+if BACKEND == 'numpy':
+    from .npbin import extract_fake, extract, extract_window, iter_extract, parse, Extractor, histogram
+from .batch import batch_extract
+from .tail import BinTailReader
+from .photonfile import write_photons, read_photons, PhotonFile
+
+__all__=[extract_fake, extract, extract_window, iter_extract, parse, Extractor, histogram, batch_extract,
+         BinTailReader, write_photons, read_photons, PhotonFile]
@@ -0,0 +1,108 @@
+"""
+Extraction of many (directory, start, inttime) requests across a pool of processes.
+
+Each worker builds an Extractor for the beammap once and extracts each request straight into a
+multiprocessing.shared_memory block rather than pickling the photons through a pipe, so the only copy made is the
+parent's, out of the block into the returned array. The workers share the parent's resource tracker, so blocks the
+parent never gets to free are unlinked when it and its workers exit, even if it crashes.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from mkidcore.corelog import getLogger
+from mkidcore.headers import PhotonNumpyType, TICKS_PER_SECOND
+from mkidcore.binfile.npbin import _max_photons
+
+_extractor = None
+
+
+def _init_worker(beammap, x, y):
+    global _extractor
+    from mkidcore.binfile import Extractor
+    _extractor = Extractor(beammap, x, y)
+
+
+def _extract_to_shm(directory, start, inttime, kwargs):
+    """Extract one request into a new shared memory block, returning its name and the number of photons"""
+    n_max = _max_photons(directory, start, 0, (inttime + 1) * TICKS_PER_SECOND)
+    if not n_max:
+        _extractor.extract(directory, start, inttime, **kwargs)  # no photons, but raise as extract would
+        return None, 0
+    # The block is sized for every word in the files, but pages that are never written are never allocated
+    shm = shared_memory.SharedMemory(create=True, size=n_max * PhotonNumpyType.itemsize)
+    out = None
+    try:
+        out = np.ndarray(n_max, dtype=PhotonNumpyType, buffer=shm.buf)
+        n = _extractor.extract(directory, start, inttime, out=out, **kwargs).size
+    except BaseException:
+        shm.unlink()
+        raise
+    finally:
+        del out
+        shm.close()
+    return shm.name, n
+
+
+def _collect(name, n):
+    """Copy n photons out of the shared memory block name and free the block"""
+    photons = np.empty(n, dtype=PhotonNumpyType)
+    if name is None:
+        return photons
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        photons[:] = np.ndarray(n, dtype=PhotonNumpyType, buffer=shm.buf)
+    finally:
+        shm.close()
+        shm.unlink()
+    return photons
+
+
+def batch_extract(requests, beammap, x=None, y=None, workers=None, progress=None, **kwargs):
+    """
+    Extract the photons of each (directory, start, inttime) in requests, as extract would, using workers processes.
+
+    Returns a list of PhotonNumpyType arrays in the order of requests. x and y default to the beammap's ncols and
+    nrows and the remaining keyword arguments (include_baseline, nthreads, use_index, ...) are passed to extract.
+    Progress is logged and, if given, progress(ndone, ntotal) is called as each request finishes. workers defaults
+    to the number of CPUs.
+    """
+    if kwargs.get('resid_offsets'):
+        raise ValueError('batch_extract does not support resid_offsets')
+    requests = [tuple(r) for r in requests]
+    if x is None or y is None:
+        x, y = beammap.ncols, beammap.nrows
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(min(int(workers), len(requests)), 1)
+    log = getLogger(__name__)
+
+    results = [None] * len(requests)
+    futures = {}
+    # Started before the pool so forked workers register their blocks with it rather than each with their own,
+    # which would unlink them when the worker exits, before the parent has read them
+    resource_tracker.ensure_running()
+    try:
+        with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(beammap, x, y)) as pool:
+            futures = {pool.submit(_extract_to_shm, d, s, t, kwargs): i for i, (d, s, t) in enumerate(requests)}
+            try:
+                for ndone, future in enumerate(as_completed(futures), 1):
+                    i = futures[future]
+                    results[i] = _collect(*future.result())
+                    log.info('Extracted {} photons from {}.bin + {} s ({}/{})'.format(results[i].size,
+                                                                                      requests[i][1],
+                                                                                      requests[i][2], ndone,
+                                                                                      len(requests)))
+                    if progress is not None:
+                        progress(ndone, len(requests))
+            finally:
+                for future in futures:
+                    future.cancel()
+    finally:
+        # the pool has waited for the running requests, free the blocks of any not collected after one failed
+        for future, i in futures.items():
+            if results[i] is None and not future.cancelled() and future.exception() is None:
+                _collect(*future.result())
+    return results
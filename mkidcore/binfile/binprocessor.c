@@ -24,6 +24,7 @@
 #include <semaphore.h>
 #include <fcntl.h>
 #include <sys/stat.h>
+#include <sys/mman.h>
 #include <math.h>
 #include <dirent.h>
 #include "binprocessor.h"
@@ -53,13 +54,15 @@
 
 // MKID array stats
 #define NPIXELS_PER_ROACH 1024
+#define FAKE_PHOTON_X 511  // the x coordinate of the fake photons that end frames
 #define RAD2DEG 57.2957795131
 
 #define TSOFFS2017 1483228800 //difference between epoch and Jan 1 2017 UTC
 #define TSOFFS 1514764800 //difference between epoch and Jan 1 2018 UTC
 
-#define MAX_CNT_RATE 2500
 #define NBMFIELD 4
+#define NOPIXEL ((uint32_t)(-1))
+#define NBASELINE (1<<17)  // the baseline is a signed 17 bit number
 
 struct datapacket {
     int baseline:17;
@@ -76,9 +79,12 @@ struct hdrpacket {
     unsigned int start:8;
 }__attribute__((packed));;
 
-// useful globals
-uint32_t residarr[10000] = {0};
-uint64_t tstart = 0;
+// a word of a bin file, after byte swapping
+union binword {
+    uint64_t raw;
+    struct hdrpacket hdr;
+    struct datapacket photon;
+};
 
 void FixOverflowTimestamps(struct hdrpacket* hdr, int fileNameTime, int tsOffs) {
     int fudgeFactor = 3; //account for early starts - misalign between FirstFile and real header timestamp
@@ -123,351 +129,927 @@ void InitializeBeamMap(uint32_t **BeamMap, uint32_t value, uint32_t beamCols, ui
             BeamMap[x][y] = value;
 }
 
-void ParseToMem(char *packet, uint64_t l, int tsOffs, int FirstFile, int iFile, int nFiles, uint32_t **BeamMap,
-                uint32_t **BeamFlag, int mapflag, char ***ResIdString, photon ***ptable, uint32_t **ptablect, uint32_t
-                beamCols, uint32_t beamRows, int verbose) {
-    uint64_t i,swp,swp1;
-    int64_t basetime;
-    struct hdrpacket *hdr;
-    struct datapacket *data;
-    long cursize;
-
-    // get info from header packet
-    swp = *((uint64_t *) (&packet[0]));
-    swp1 = __bswap_64(swp);
-    hdr = (struct hdrpacket *) (&swp1);
-    if (hdr->start != 0b11111111) {
-        if(verbose >= 1){
-            printf("Error - packet does not start with a correctly formatted header packet!\n");
+/*
+ * Maps fName read only for a sequential scan, setting fSize to its size in bytes. Returns NULL if the file can't be
+ * opened or mapped or is empty. The mapping is released with munmap(data, fSize).
+ */
+uint64_t *MapBinFile(const char *fName, long *fSize) {
+    int fd;
+    struct stat st;
+    void *map;
+
+    *fSize = 0;
+    fd = open(fName, O_RDONLY);
+    if(fd < 0) return NULL;
+    if(fstat(fd, &st) != 0 || st.st_size < 8) {
+        close(fd);
+        return NULL;
+    }
+    map = mmap(NULL, st.st_size, PROT_READ, MAP_PRIVATE, fd, 0);
+    close(fd);
+    if(map == MAP_FAILED) return NULL;
+    madvise(map, st.st_size, MADV_SEQUENTIAL);
+    *fSize = st.st_size;
+    return (uint64_t *) map;
+}
 
-        }
+static inline float BaselineDegrees(int32_t raw) {
+    return ((float) raw)*RAD2DEG/16384.0;
+}
 
-        return;
+/*
+ * Returns the median baseline of the nPhot photons in a histogram of their raw 17 bit baselines, the same value as
+ * np.median would give for the baselines in degrees.
+ */
+float BaselineMedian(const uint64_t *hist, uint64_t nPhot) {
+    uint64_t rank, seen = 0;
+    int32_t raw = 0, lo;
+
+    if(nPhot == 0) return 0;
+    // the photons of rank (nPhot-1)/2 and nPhot/2 are the median (the same photon if nPhot is odd)
+    rank = (nPhot-1)/2;
+    for(; seen + hist[raw] <= rank; raw++) seen += hist[raw];
+    lo = raw;
+    rank = nPhot/2;
+    for(; seen + hist[raw] <= rank; raw++) seen += hist[raw];
+    return (BaselineDegrees(lo - NBASELINE/2) + BaselineDegrees(raw - NBASELINE/2)) / 2.0f;
+}
 
+/*
+ * Photons are extracted with a counting sort. In the first pass each thread counts the photons it will keep for each
+ * pixel (and histograms their baselines), the counts are turned into per-thread offsets into the output, pixel by
+ * pixel in resID order, and in the second pass each thread writes its photons straight to their final place. In the
+ * last pass each thread sorts the photons of a block of pixels by time, which they almost always already are.
+ */
+#define PASS_COUNT 0
+#define PASS_WRITE 1
+#define PASS_SORT 2
+#define PASS_HISTOGRAM 3  // extractor_histogram's single pass, binning the photons rather than writing them
 
-    }
+/*
+ * A contiguous block of files [iStart, iStop) (relative to FirstFile) parsed by one thread. Blocks are handed out in
+ * file order and each pixel's output is laid out thread by thread, so the photon order is the same as parsing every
+ * file serially.
+ */
+struct parsejob {
+    const char *binpath;
+    long iStart, iStop;
+    int FirstFile, verbose, pass, subtract, useIndex;
+    int64_t tickStart, tickStop;
+    uint32_t tsOffs;
+    uint64_t tstart;             // header time of the start of the first file
+    const uint32_t *PixelResID;  // resID of each pixel to extract, NOPIXEL for the rest
+    uint32_t beamCols, beamRows;
+    uint64_t *count;             // photons per pixel
+    uint64_t *blhist;            // histogram of the raw baselines
+    uint64_t *offset;            // next output index per pixel
+    photon *otable;
+    float blmedian;
+    const uint64_t *pixStart;    // output index of the first photon of each laid out pixel, and the end
+    const uint32_t *LayoutPix;   // the laid out pixels, see extractor
+    uint32_t sortStart, sortStop; // block of laid out pixels [sortStart, sortStop) to sort by time, whole resIDs
+    uint32_t *hist;              // histogram of PASS_HISTOGRAM, see extractor_histogram
+    const double *wbins;
+    int nwbins, shared;          // shared if other threads write to hist
+    uint64_t tbinUs;
+    uint32_t ntbins;
+    uint64_t nBinned;
+    struct binfile *files;       // per file of the block, what the count pass read, see ParseFiles
+    int filesRead;               // set once the count pass has filled in files
+};
 
-    // if no start timestamp, store start timestamp
-    FixOverflowTimestamps(hdr, FirstFile + iFile, tsOffs); //TEMPORARY FOR 20180625 MEC - REMOVE LATER
-    basetime = hdr->timestamp - tstart; // time since start of first file, in half ms
-    //printf("Roach: %d; Offset: %d\n", hdr->roach, FirstFile - tsOffs - hdr->timestamp/2000);
+/*
+ * Header packet index of a bin file: the raw timestamp (half-ms since the start of the year) and word offset of every
+ * header. Every word between two headers is a photon of the first header's packet, so with an index the packets in
+ * a time window can be parsed without touching the rest of the file.
+ *
+ * Indexes are cached in a <file>.idx sidecar, which starts with INDEX_MAGIC and the size and mtime of the file it
+ * indexes (all uint64/int64) followed by the number of headers, then the timestamps (uint64) and offsets (uint32).
+ * An index that doesn't match the file is ignored and rebuilt.
+ */
+#define INDEX_MAGIC "MKIDIDX1"
 
-    //Abort if outside of required time range
-    if( (basetime < 0) || (basetime >= 2000*nFiles) ) return;
+struct binindex {
+    uint64_t nHeaders;
+    uint64_t *timestamp;
+    uint32_t *offset;
+};
 
-    for(i=1;i<l/8;i++) {
-        //printf("i=%ld\n",i); fflush(stdout);
-		swp = *((uint64_t *) (&packet[i*8]));
-		swp1 = __bswap_64(swp);
-		data = (struct datapacket *) (&swp1);
-		if( data->xcoord >= beamCols || data->ycoord >= beamRows ) continue;
-	    if( mapflag > 0 && BeamFlag[data->xcoord][data->ycoord] > 0) continue ; // if mapflag is set only record photons that were succesfully beammapped
+/*
+ * A file as the count pass of an extraction found it: its header index and the packets [first, last] in the window.
+ * Later passes parse exactly these packets, so a file still being written (e.g. by a live readout) can't grow between
+ * passes into more photons than were counted.
+ */
+struct binfile {
+    struct binindex idx;
+    uint64_t first, last;
+    int found;
+};
+
+void FreeBinIndex(struct binindex *idx) {
+    free(idx->timestamp);
+    free(idx->offset);
+    idx->timestamp = NULL;
+    idx->offset = NULL;
+    idx->nHeaders = 0;
+}
 
-		// When we have more than 2500 cts reallocate the memory for more
-		//if( ptablect[data->xcoord][data->ycoord] > 2500*5-1 ) continue;
-		if( ptablect[data->xcoord][data->ycoord] % MAX_CNT_RATE == (MAX_CNT_RATE-2) ) {
-		    cursize = (long) ceil(ptablect[data->xcoord][data->ycoord]/(float)MAX_CNT_RATE);
-		    //printf("cursize=%ld\n",cursize);
-		    ptable[data->xcoord][data->ycoord] = (photon *) realloc(ptable[data->xcoord][data->ycoord],MAX_CNT_RATE*sizeof(photon)*(cursize+1));
-		}
+/*
+ * Indexes the headers of the nWords of data. Returns 0 or -1 if out of memory.
+ */
+int BuildBinIndex(const uint64_t *data, long nWords, struct binindex *idx) {
+    long k;
+    uint64_t cap = 1024, raw;
+    void *ts, *offs;
+
+    idx->nHeaders = 0;
+    idx->timestamp = (uint64_t *) malloc(cap * sizeof(uint64_t));
+    idx->offset = (uint32_t *) malloc(cap * sizeof(uint32_t));
+    for(k=0; k < nWords && idx->timestamp && idx->offset; k++) {
+        raw = __bswap_64(data[k]);
+        if((raw >> 56) != 0b11111111) continue;
+        if(idx->nHeaders == cap) {
+            cap *= 2;
+            ts = realloc(idx->timestamp, cap * sizeof(uint64_t));
+            offs = realloc(idx->offset, cap * sizeof(uint32_t));
+            if(ts) idx->timestamp = (uint64_t *) ts;
+            if(offs) idx->offset = (uint32_t *) offs;
+            if(!ts || !offs) break;
+        }
+        idx->timestamp[idx->nHeaders] = raw & 0xfffffffffUL;
+        idx->offset[idx->nHeaders++] = (uint32_t) k;
+    }
+    if(k < nWords || !idx->timestamp || !idx->offset) {
+        FreeBinIndex(idx);
+        return -1;
+    }
+    return 0;
+}
 
-		// add the photon to ptable and increment the appropriate counter
-        ptable[data->xcoord][data->ycoord][ptablect[data->xcoord][data->ycoord]].resID = BeamMap[data->xcoord][data->ycoord];
-		ptable[data->xcoord][data->ycoord][ptablect[data->xcoord][data->ycoord]].time = (uint32_t) (basetime*500 + data->timestamp);
-		ptable[data->xcoord][data->ycoord][ptablect[data->xcoord][data->ycoord]].wavelength = ((float) data->wavelength)*RAD2DEG/32768.0;
-		ptable[data->xcoord][data->ycoord][ptablect[data->xcoord][data->ycoord]].baseline = ((float) data->baseline)*RAD2DEG/16384.0;
-		ptablect[data->xcoord][data->ycoord]++;
+/*
+ * Reads the index sidecar iName of a file with stat st into idx. Returns 1 if it was read and matches the file.
+ */
+int ReadBinIndex(const char *iName, const struct stat *st, struct binindex *idx) {
+    FILE *f;
+    char magic[8];
+    uint64_t size, n = 0;
+    int64_t sec, nsec;
+    int ok;
+
+    f = fopen(iName, "rb");
+    if(f == NULL) return 0;
+    ok = fread(magic, 1, 8, f) == 8 && memcmp(magic, INDEX_MAGIC, 8) == 0 &&
+         fread(&size, sizeof(size), 1, f) == 1 && fread(&sec, sizeof(sec), 1, f) == 1 &&
+         fread(&nsec, sizeof(nsec), 1, f) == 1 && fread(&n, sizeof(n), 1, f) == 1 &&
+         size == (uint64_t) st->st_size && sec == st->st_mtim.tv_sec && nsec == st->st_mtim.tv_nsec &&
+         n <= size/8;
+    if(ok) {
+        idx->nHeaders = n;
+        idx->timestamp = (uint64_t *) malloc((n+1) * sizeof(uint64_t));
+        idx->offset = (uint32_t *) malloc((n+1) * sizeof(uint32_t));
+        ok = idx->timestamp && idx->offset && fread(idx->timestamp, sizeof(uint64_t), n, f) == n &&
+             fread(idx->offset, sizeof(uint32_t), n, f) == n && (n == 0 || idx->offset[n-1] < size/8);
+        if(!ok) FreeBinIndex(idx);
     }
+    fclose(f);
+    return ok;
+}
 
+/*
+ * Writes idx to the sidecar iName of a file with stat st, via a temporary file so readers never see a partial index.
+ * Failures (e.g. a read only data directory) are ignored, the index will just be rebuilt next time.
+ */
+void WriteBinIndex(const char *iName, const struct stat *st, const struct binindex *idx) {
+    char tmp[STR_SIZE + 64];
+    FILE *f;
+    uint64_t size = st->st_size, n = idx->nHeaders;
+    int64_t sec = st->st_mtim.tv_sec, nsec = st->st_mtim.tv_nsec;
+    int ok;
+
+    snprintf(tmp, sizeof(tmp), "%s.%d.%lu.tmp", iName, (int) getpid(), (unsigned long) pthread_self());
+    f = fopen(tmp, "wb");
+    if(f == NULL) return;
+    ok = fwrite(INDEX_MAGIC, 1, 8, f) == 8 && fwrite(&size, sizeof(size), 1, f) == 1 &&
+         fwrite(&sec, sizeof(sec), 1, f) == 1 && fwrite(&nsec, sizeof(nsec), 1, f) == 1 &&
+         fwrite(&n, sizeof(n), 1, f) == 1 && fwrite(idx->timestamp, sizeof(uint64_t), n, f) == n &&
+         fwrite(idx->offset, sizeof(uint32_t), n, f) == n;
+    ok = (fclose(f) == 0) && ok;
+    if(!ok || rename(tmp, iName) != 0) unlink(tmp);
 }
 
+/*
+ * Returns the time of header i of a file, in half-ms since the start of the first file.
+ */
+static inline int64_t HeaderTime(const struct binindex *idx, uint64_t i, long iFile, const struct parsejob *job) {
+    union binword w;
+    w.raw = idx->timestamp[i];
+    FixOverflowTimestamps(&w.hdr, job->FirstFile + iFile, job->tsOffs); //TEMPORARY FOR 20180625 MEC - REMOVE LATER
+    return w.hdr.timestamp - job->tstart;
+}
 
-long extract_photons(const char *binpath, unsigned long start_timestamp, unsigned long integration_time,
-                     long *DiskBeamMap, int n_bm_entries, unsigned int bmap_ncol, unsigned int bmap_nrow,
-                     unsigned long n_max_photons, photon* otable, int verbose) {
+/*
+ * Finds the packets of file iFile with header times in the job's window. Photons before the first header have no
+ * time and those after the last header may be part of an incomplete packet, so neither are ever kept. Returns 0 if
+ * there are none, otherwise sets [first, last] to the range of packets spanning them.
+ */
+int PacketRange(const struct binindex *idx, long iFile, const struct parsejob *job, uint64_t *first, uint64_t *last) {
+    uint64_t i;
+    int64_t basetime;
+    int found = 0;
+
+    for(i=0; i+1 < idx->nHeaders; i++) {
+        if(((idx->offset[i+1] - idx->offset[i])*8 > 816) && (job->verbose >= 1) && (job->pass == PASS_COUNT)) {
+            printf("Packet too long - %u bytes\n", (idx->offset[i+1] - idx->offset[i])*8); fflush(stdout);}
+        basetime = HeaderTime(idx, i, iFile, job);
+        if((basetime < job->tickStart) || (basetime >= job->tickStop)) continue;
+        if(!found) *first = i;
+        *last = i;
+        found = 1;
+    }
+    return found;
+}
 
+/*
+ * Returns the bin of value in the n bins with ascending edges, the last bin closed, or -1 if it's outside them. The
+ * search is branchless, photon wavelengths are too random for a branchy one to be predicted.
+ */
+static inline long EdgeBin(const double *edges, int n, double value) {
+    long base = 0, len = n + 1, half;
+    if(!(value >= edges[0] && value <= edges[n])) return -1;
+    while(len > 1) {  // edges[base] <= value, the last such edge is in [base, base + len)
+        half = len / 2;
+        base += (edges[base + half] <= value) * half;
+        len -= half;
+    }
+    return base < n ? base : n - 1;
+}
 
-    char fName[STR_SIZE];
-    int FirstFile, mapflag, nRoaches;
-    uint32_t beamCols, beamRows, nFiles;
-    long fSize, rd, i, j, k, x, y;
-    struct stat st;
-    FILE *fp;
-    clock_t start, diff, olddiff;
-    uint64_t swp, swp1, pstart, pcount, firstHeader;
-    long nPhot;
-    struct hdrpacket *hdr;
-    char packet[808*16];
-    uint64_t *frame;
-    uint32_t **BeamMap;
-    uint32_t **BeamFlag;
-    uint32_t *toWriteBeamMap;
-    uint32_t *toWriteBeamFlag;
-    uint32_t beamMapInitVal = (uint32_t)(-1);
-    char ***ResIdString;
-    photon ***ptable;
-    uint32_t **ptablect;
+/*
+ * Adds the photon w of pixel pix in the packet at basetime to the job's histogram
+ */
+static inline void HistogramPhoton(struct parsejob *job, uint32_t pix, int64_t basetime, const union binword *w) {
+    uint64_t i = pix, dt;
+    long b;
+    float wavelength;
+
+    if(job->nwbins > 0) {
+        wavelength = ((float) w->photon.wavelength)*RAD2DEG/32768.0;
+        if(job->subtract) wavelength += BaselineDegrees(w->photon.baseline) - job->blmedian;
+        b = EdgeBin(job->wbins, job->nwbins, (double) wavelength);
+        if(b < 0) return;
+        i = i*job->nwbins + b;
+    }
+    if(job->ntbins > 0) {
+        dt = (uint64_t) ((basetime - job->tickStart)*500 + w->photon.timestamp);
+        if(dt/job->tbinUs >= job->ntbins) return;
+        i = i*job->ntbins + dt/job->tbinUs;
+    }
+    if(job->shared) __atomic_fetch_add(&job->hist[i], 1, __ATOMIC_RELAXED);
+    else job->hist[i]++;
+    job->nBinned++;
+}
+
+/*
+ * Parses packets [first, last] of file iFile, directly over the (big-endian) file data, each photon is byte swapped
+ * once and decoded. Photons are kept if their header time is in the job's window and they land on an extracted
+ * pixel. Depending on the pass they are counted, written out or histogrammed.
+ */
+void ParseToMem(const uint64_t *data, const struct binindex *idx, uint64_t first, uint64_t last, long iFile,
+                struct parsejob *job) {
+    uint64_t i, k;
+    int64_t basetime;
+    union binword w;
+    uint32_t resID, pix;
+    photon *p;
+    // local copies, the compiler can't tell the photon stores don't alias the job
+    const int64_t tickStart = job->tickStart, tickStop = job->tickStop;
+    const uint32_t beamCols = job->beamCols, beamRows = job->beamRows;
+    const uint32_t *PixelResID = job->PixelResID;
+    const int pass = job->pass, subtract = job->subtract;
+    const float blmedian = job->blmedian;
+    uint64_t *count = job->count, *blhist = job->blhist, *offset = job->offset;
+    photon *otable = job->otable;
+
+    for(i=first; i <= last; i++) {
+        basetime = HeaderTime(idx, i, iFile, job);
+        if((basetime < tickStart) || (basetime >= tickStop)) continue;
+
+        for(k=idx->offset[i]+1; k < idx->offset[i+1]; k++) {
+            w.raw = __bswap_64(data[k]);
+            if( w.photon.xcoord >= beamCols || w.photon.ycoord >= beamRows ) continue;
+            pix = w.photon.xcoord*beamRows + w.photon.ycoord;
+            resID = PixelResID[pix];
+            if( resID == NOPIXEL ) continue;  // only record photons that were succesfully beammapped
+
+            if(pass == PASS_COUNT) {
+                count[pix]++;
+                blhist[w.photon.baseline + NBASELINE/2]++;
+                continue;
+            }
+            if(pass == PASS_HISTOGRAM) {
+                HistogramPhoton(job, pix, basetime, &w);
+                continue;
+            }
+
+            if(count[pix] == 0) continue;  // never write more photons than were counted (and laid out) for pix
+            count[pix]--;
+            p = &otable[offset[pix]++];
+            p->resID = resID;
+            p->time = (uint32_t) (basetime*500 + w.photon.timestamp);
+            p->wavelength = ((float) w.photon.wavelength)*RAD2DEG/32768.0;
+            if(subtract) p->wavelength += BaselineDegrees(w.photon.baseline) - blmedian;
+            p->weight = 1.0;
+        }
+    }
+}
+
+/*
+ * Parses the job's block of files. Each file's header index is read from its sidecar if the job uses them, otherwise
+ * (or if the sidecar is missing or stale) it is built from the file and, if the job uses sidecars, saved. Files with
+ * no packets in the window are never mapped, and in the others only the packets in the window are read. The count
+ * pass keeps each file's index and packet range in job->files and the passes after it parse just those packets.
+ */
+void *ParseFiles(void *arg) {
+    struct parsejob *job = (struct parsejob *) arg;
+    char fName[STR_SIZE], iName[STR_SIZE + 8];
+    long fSize, i;
+    uint64_t first, last;
     uint64_t *data;
-    const unsigned long DATA_BUFFER_SIZE_BYTES = 1.1*MAX_CNT_RATE*bmap_ncol*bmap_nrow*8;
-    int checkExists;
-    int nBMEntries;
+    struct stat st;
+    struct binindex idx;
+    struct binfile *file;
+
+    for(i=job->iStart; i < job->iStop; i++) {
+        snprintf(fName, STR_SIZE, "%s/%ld.bin", job->binpath, job->FirstFile+i);
+        snprintf(iName, sizeof(iName), "%s.idx", fName);
+        data = NULL;
+        fSize = 0;
+        file = job->files + (i - job->iStart);
+        if(job->filesRead) {
+            if(!file->found) continue;
+            data = MapBinFile(fName, &fSize);
+            if(data != NULL && (uint64_t) fSize/8 > file->idx.offset[file->last+1])
+                ParseToMem(data, &file->idx, file->first, file->last, i, job);
+            if(data != NULL) munmap(data, fSize);
+            continue;
+        }
+        if(stat(fName, &st) != 0 || st.st_size < 8 ||
+           !(job->useIndex && ReadBinIndex(iName, &st, &idx))) {
+            data = MapBinFile(fName, &fSize);
+            if(data == NULL){
+                if(job->verbose >= 1 && job->pass == PASS_COUNT){
+                    printf("Warning: %s does not exist or is empty\n", fName);
+                    fflush(stdout);
+                }
+                continue;
+            }
+            if(BuildBinIndex(data, fSize/8, &idx) != 0) {
+                if(job->verbose >= 1 && job->pass == PASS_COUNT){
+                    printf("Warning: out of memory indexing %s\n", fName); fflush(stdout);}
+                munmap(data, fSize);
+                continue;
+            }
+            if(job->useIndex && fSize == st.st_size) WriteBinIndex(iName, &st, &idx);
+        }
 
-    //Timing variables
-    struct tm *startTime;
-    struct tm *yearStartTime; //Jan 1 00:00 UTC of current year
-    int year;
-    uint32_t tsOffs; //UTC timestamp for yearStartTime
-    time_t startTs;
+        if(idx.nHeaders && idx.offset[0] != 0 && (job->verbose >= 2) && (job->pass == PASS_COUNT)) {
+            printf("First header at %u\n", idx.offset[0]); fflush(stdout);}
+
+        if(PacketRange(&idx, i, job, &first, &last)) {
+            if(data == NULL) data = MapBinFile(fName, &fSize);
+            if(data != NULL && (uint64_t) fSize/8 > idx.offset[last+1]) {
+                if(job->verbose >= 2 && job->pass == PASS_COUNT){
+                    printf("Reading %s - %ld Mb\n",fName,fSize/1024/1024);
+                    fflush(stdout);
+                }
+                ParseToMem(data, &idx, first, last, i, job);
+                if(job->pass == PASS_COUNT) {
+                    file->idx = idx;
+                    file->first = first;
+                    file->last = last;
+                    file->found = 1;
+                    idx.timestamp = NULL;
+                    idx.offset = NULL;
+                }
+            }
+        }
+        FreeBinIndex(&idx);
+        if(data != NULL) munmap(data, fSize);
+    }
+    if(job->pass == PASS_COUNT) job->filesRead = 1;
 
-    start = clock();
+    return NULL;
+}
 
-    memset(packet, 0, sizeof(packet[0]) * 808 * 16);    // zero out array
+/*
+ * Stable sort of n photons by time, tmp must have room for n/2 photons.
+ */
+void MergeSortTime(photon *p, photon *tmp, uint64_t n) {
+    uint64_t i, j, k, h;
+    photon q;
+
+    if(n <= 32) {
+        for(i=1; i < n; i++) {
+            q = p[i];
+            for(j=i; j > 0 && p[j-1].time > q.time; j--) p[j] = p[j-1];
+            p[j] = q;
+        }
+        return;
+    }
+    h = n/2;
+    MergeSortTime(p, tmp, h);
+    MergeSortTime(p + h, tmp, n - h);
+    if(p[h-1].time <= p[h].time) return;
+    memcpy(tmp, p, h*sizeof(photon));
+    for(i=0, j=h, k=0; i < h && j < n; k++) p[k] = (p[j].time < tmp[i].time) ? p[j++] : tmp[i++];
+    for(; i < h; k++) p[k] = tmp[i++];
+}
 
-	FirstFile=start_timestamp;
-	nFiles=integration_time+1;
-	mapflag=1;
-	beamCols = bmap_ncol;
-	beamRows = bmap_nrow;
-    nBMEntries = n_bm_entries;
+/*
+ * Sorts the photons of each resID of the job's block of pixels by time, merging the pixels sharing a resID. Photons
+ * with equal times keep their pixel then file order.
+ */
+void *SortPixels(struct parsejob *job) {
+    uint32_t j, k;
+    uint64_t i, n, nTmp = 0;
+    photon *p, *tmp = NULL, *grown;
+
+    for(j=job->sortStart; j < job->sortStop; j=k) {
+        for(k=j+1; k < job->sortStop &&
+                   job->PixelResID[job->LayoutPix[k]] == job->PixelResID[job->LayoutPix[j]]; k++);
+        p = job->otable + job->pixStart[j];
+        n = job->pixStart[k] - job->pixStart[j];
+        for(i=1; i < n && p[i-1].time <= p[i].time; i++);
+        if(i >= n) continue;
+        if(n/2 > nTmp) {
+            grown = (photon *) realloc(tmp, (n/2)*sizeof(photon));
+            if(grown == NULL) {
+                if(job->verbose >= 1){
+                    printf("Warning: out of memory sorting photons by time\n"); fflush(stdout);}
+                continue;
+            }
+            tmp = grown;
+            nTmp = n/2;
+        }
+        MergeSortTime(p, tmp, n);
+    }
+    free(tmp);
+    return NULL;
+}
 
-	 // check whether binpath exists
-    DIR* dir = opendir(binpath);
-    if (ENOENT == errno) return -1;
-    closedir(dir);
+void *RunJob(void *arg) {
+    struct parsejob *job = (struct parsejob *) arg;
+    if(job->pass == PASS_SORT) return SortPixels(job);
+    return ParseFiles(job);
+}
 
-    // check nFiles
-    if(verbose >= 2){
-        printf("nFiles = %d\n", nFiles); fflush(stdout);}
-    if(nFiles < 1 || nFiles > 1800) return -1; // limiting number of files to 30 minutes
+/*
+ * Runs every job, on its own thread if there is more than one.
+ */
+void RunJobs(struct parsejob *jobs, int nthreads) {
+    int t;
+    pthread_t *threads;
+    int *started;
 
+    if(nthreads == 1) {
+        RunJob(&jobs[0]);
+        return;
+    }
+    threads = (pthread_t *) malloc(nthreads * sizeof(pthread_t));
+    started = (int *) calloc(nthreads, sizeof(int));
+    for(t=0; t < nthreads; t++) {
+        started[t] = pthread_create(&threads[t], NULL, RunJob, &jobs[t]) == 0;
+        if(!started[t]) RunJob(&jobs[t]);  // fall back to running this job on the calling thread
+    }
+    for(t=0; t < nthreads; t++) if(started[t]) pthread_join(threads[t], NULL);
+    free(threads);
+    free(started);
+}
 
-    startTs = (time_t)FirstFile;
-    startTime = gmtime(&startTs);
-    year = startTime->tm_year;
-    yearStartTime = calloc(1, sizeof(struct tm));
-    yearStartTime->tm_year = year;
-    yearStartTime->tm_mday = 1;
-    tsOffs = timegm(yearStartTime);
-    tstart = (uint64_t)(FirstFile-tsOffs)*2000;
 
-    if(verbose >= 2){
-        printf("Start time = %ld\n",tstart); fflush(stdout);}
+/*
+ * The beammap lookup tables of an extraction, built once by extractor_create and then only read, so one extractor
+ * can be used by any number of extractions at once.
+ */
+struct extractor {
+    uint32_t beamCols, beamRows;
+    uint32_t *PixelResID;  // resID of each pixel to extract, NOPIXEL for the rest
+    uint32_t *LayoutPix;   // the pixels to extract in output order, by resID (then pixel)
+    uint32_t nLayout;
+};
+
+static int CompareUint64(const void *a, const void *b) {
+    uint64_t x = *(const uint64_t *) a, y = *(const uint64_t *) b;
+    return (x > y) - (x < y);
+}
 
-    //initialize nRoaches
-    nRoaches = beamRows*beamCols/1000;
-    frame = (uint64_t*)malloc(nRoaches*sizeof(uint64_t));
+/*
+ * Builds the lookup tables for the nPix x 4 (resID, flag, x, y) beammap DiskBeamMap of a bmap_ncol x bmap_nrow
+ * array. Pixels are extracted if they are beammapped, unflagged and not at (0,0). Returns NULL if out of memory.
+ */
+extractor *extractor_create(long *DiskBeamMap, int n_bm_entries, unsigned int bmap_ncol, unsigned int bmap_nrow,
+                            int verbose) {
+    int mapflag = 1;
+    uint32_t beamCols = bmap_ncol, beamRows = bmap_nrow, pix;
+    long i, j, x, y;
+    uint32_t **BeamMap;
+    uint32_t **BeamFlag;
+    uint8_t *laidOut;
+    uint64_t *order;
+    uint32_t beamMapInitVal = (uint32_t)(-1);
+    extractor *ext;
+
+    ext = (extractor *) calloc(1, sizeof(extractor));
+    if(ext == NULL) return NULL;
+    ext->beamCols = beamCols;
+    ext->beamRows = beamRows;
+    ext->PixelResID = (uint32_t *) malloc(beamCols * beamRows * sizeof(uint32_t) + 1);
+    ext->LayoutPix = (uint32_t *) malloc(beamCols * beamRows * sizeof(uint32_t) + 1);
+    laidOut = (uint8_t *) calloc(beamCols * beamRows + 1, sizeof(uint8_t));
+    if(ext->PixelResID == NULL || ext->LayoutPix == NULL || laidOut == NULL) {
+        free(laidOut);
+        extractor_free(ext);
+        return NULL;
+    }
 
-    // Allocate memory
     // Set up memory structure for 2D "beammap" arrays
     BeamMap = (uint32_t**)malloc(beamCols * sizeof(uint32_t*));
     BeamFlag = (uint32_t**)malloc(beamCols * sizeof(uint32_t*));
-    ptable = (photon***)malloc(beamCols * sizeof(photon**));
-    ptablect = (uint32_t**)malloc(beamCols * sizeof(uint32_t*));
-    ResIdString = (char***)malloc(beamCols * sizeof(char**));
-    toWriteBeamMap = (uint32_t*)malloc(beamCols * beamRows * sizeof(uint32_t));
-    toWriteBeamFlag = (uint32_t*)malloc(beamCols * beamRows * sizeof(uint32_t));
-    data = (uint64_t *) malloc(DATA_BUFFER_SIZE_BYTES);
-
-    if(verbose >= 3){
-        printf("Allocated flag maps.\n"); fflush(stdout);}
-
     for(i=0; i<beamCols; i++) {
         BeamMap[i] = (uint32_t*)malloc(beamRows * sizeof(uint32_t));
         BeamFlag[i] = (uint32_t*)malloc(beamRows * sizeof(uint32_t));
-        ptable[i] = (photon**)malloc(beamRows * sizeof(photon*));
-        ptablect[i] = (uint32_t*)calloc(beamRows , sizeof(uint32_t));
-        ResIdString[i] = (char**)malloc(beamRows * sizeof(char*));
-        for(j=0; j<beamRows; j++) ResIdString[i][j] = (char*)malloc(20 * sizeof(char));
     }
 
-    if(verbose >= 3){
-        printf("Allocated ptable.\n"); fflush(stdout);}
-
-
     // Read in beam map and parse it make 2D beam map and flag arrays
     InitializeBeamMap(BeamMap, beamMapInitVal, beamCols, beamRows); //initialize to out of bounds resID
     InitializeBeamMap(BeamFlag, 1, beamCols, beamRows); //initialize flag to one
-    PopulateBeamMapImage(DiskBeamMap, BeamMap, BeamFlag, nBMEntries, beamCols, beamRows);
+    PopulateBeamMapImage(DiskBeamMap, BeamMap, BeamFlag, n_bm_entries, beamCols, beamRows);
 
+    // Flatten to the resIDs of the pixels to extract: beammapped, good (if mapflag is set) and not at (0,0)
     for(i=0; i < beamCols; i++) {
 		for(j=0; j < beamRows; j++) {
-			if( BeamMap[i][j] == 0 ) {
-                if(verbose >= 3){
-                    printf("ResID 0 at (%d,%d)\n", i, j); fflush(stdout);}
-            }
-
-            if(BeamMap[i][j] == beamMapInitVal) {
-                if(verbose >= 3){
-                    printf("ResID N/A at (%d,%d)\n", i, j); fflush(stdout);}
-                continue;
-            }
+            if(verbose >= 3 && BeamMap[i][j] == 0) printf("ResID 0 at (%ld,%ld)\n", i, j);
+            if(verbose >= 3 && BeamMap[i][j] == beamMapInitVal) printf("ResID N/A at (%ld,%ld)\n", i, j);
+            if(mapflag > 0 && BeamFlag[i][j] > 0) ext->PixelResID[i*beamRows + j] = NOPIXEL;
+            else ext->PixelResID[i*beamRows + j] = BeamMap[i][j];
+        }
+        free(BeamMap[i]);
+        free(BeamFlag[i]);
+    }
+    if(beamCols * beamRows > 0) ext->PixelResID[0] = NOPIXEL;
+    free(BeamMap);
+    free(BeamFlag);
 
-			ptable[i][j] = (photon *) malloc( MAX_CNT_RATE * sizeof(photon) );	// allocate memory for ptable
-		}
+    // The output is laid out pixel by pixel in resID order, pixels sharing a resID in pixel order
+    order = (uint64_t *) malloc(beamCols * beamRows * sizeof(uint64_t) + 1);
+    if(order == NULL) {
+        free(laidOut);
+        extractor_free(ext);
+        return NULL;
+    }
+    for(j=0; j < n_bm_entries; j++) {
+        x = DiskBeamMap[NBMFIELD*j + 2];
+        y = DiskBeamMap[NBMFIELD*j + 3];
+        if(x < 0 || y < 0 || x >= beamCols || y >= beamRows) continue;
+        pix = x*beamRows + y;
+        if( ext->PixelResID[pix] == NOPIXEL || laidOut[pix] ) continue;
+        laidOut[pix] = 1;
+        order[ext->nLayout++] = ((uint64_t) ext->PixelResID[pix] << 32) | pix;
 	}
+    free(laidOut);
+    qsort(order, ext->nLayout, sizeof(uint64_t), CompareUint64);
+    for(j=0; j < ext->nLayout; j++) ext->LayoutPix[j] = (uint32_t) order[j];
+    free(order);
 
-    // put the beam map into the h5 file
+    if(verbose >= 3){
+        printf("\nParsed beam map.\n"); fflush(stdout);}
+    return ext;
+}
 
-    for(i=0; i<beamCols; i++) {
-        for(j=0; j<beamRows; j++) {
-            toWriteBeamMap[beamRows*i + j] = BeamMap[i][j];
-            toWriteBeamFlag[beamRows*i + j] = BeamFlag[i][j];
-        }
-    }
+/*
+ * Returns the number of pixels ext extracts and, if resids isn't NULL, writes their resIDs in output order to it.
+ */
+uint32_t extractor_layout(const extractor *ext, uint32_t *resids) {
+    uint32_t j;
+    if(resids != NULL)
+        for(j=0; j < ext->nLayout; j++) resids[j] = ext->PixelResID[ext->LayoutPix[j]];
+    return ext->nLayout;
+}
 
-    if(verbose >= 3){
-        printf("\nParsed beam map.\n"); fflush(stdout);
-	    printf("Made individual photon data tables.\n"); fflush(stdout);
+void extractor_free(extractor *ext) {
+    if(ext == NULL) return;
+    free(ext->PixelResID);
+    free(ext->LayoutPix);
+    free(ext);
+}
 
+void FreeJobs(struct parsejob *jobs, int nthreads) {
+    int t;
+    long i;
+    for(t=0; t < nthreads; t++) {
+        free(jobs[t].count);
+        free(jobs[t].blhist);
+        free(jobs[t].offset);
+        if(jobs[t].files != NULL)
+            for(i=0; i < jobs[t].iStop - jobs[t].iStart; i++) FreeBinIndex(&jobs[t].files[i].idx);
+        free(jobs[t].files);
     }
+    free(jobs);
+}
 
-    // Loop through the data files and parse the packets into separate data tables
-
-    for(i=-1; i < nFiles+1; i++) {
-        sprintf(fName,"%s/%ld.bin",binpath,FirstFile+i);
-        checkExists = stat(fName, &st);
-        if(checkExists != 0){
-            if(verbose >= 1){
-                printf("Warning: %s does not exist\n", fName);
-                fflush(stdout);
+/*
+ * Sets up the jobs of an extraction of the photons with header times in [tick_start, tick_stop), in half-ms since
+ * start_timestamp: one per thread, each with a contiguous block of the files spanning the window plus one to either
+ * side. nthreads is reduced if there are fewer files than threads. Returns NULL if the directory doesn't exist, the
+ * window is invalid (or over 30 minutes) or out of memory.
+ */
+struct parsejob *MakeJobs(const extractor *ext, const char *binpath, unsigned long start_timestamp,
+                          unsigned long tick_start, unsigned long tick_stop, int subtract_baseline, int use_index,
+                          int *nthreads, int verbose) {
+    int FirstFile, ok = 1;
+    uint32_t beamCols = ext->beamCols, beamRows = ext->beamRows;
+    long t, firstFileIndex, nFilesRead;
+    struct parsejob *jobs;
 
-            }
-            continue;
-        }
+    //Timing variables
+    struct tm startTime;
+    struct tm yearStartTime; //Jan 1 00:00 UTC of current year
+    uint32_t tsOffs; //UTC timestamp for yearStartTime
+    time_t startTs;
+    uint64_t tstart;
 
-        fSize = st.st_size;
+	FirstFile=start_timestamp;
 
-        if(verbose >= 2){
-            printf("Reading %s - %ld Mb\n",fName,fSize/1024/1024);
-            fflush(stdout);
+	 // check whether binpath exists
+    DIR* dir = opendir(binpath);
+    if (dir == NULL) return NULL;
+    closedir(dir);
 
-        }
+    // check the window
+    if(verbose >= 2){
+        printf("Window = %lu to %lu\n", tick_start, tick_stop); fflush(stdout);}
+    if(tick_stop <= tick_start || tick_stop - tick_start > 2000*1800) return NULL; // limiting to 30 minutes
 
-        if (DATA_BUFFER_SIZE_BYTES<fSize) {
-            if(verbose >= 1){
-                printf("Bin file too large for buffer, did the max counts increase from 2500 cts/s\n");
-                fflush(stdout);
+    // the files spanning the window plus one to either side are read, each thread gets a contiguous block of them
+    firstFileIndex = (long)(tick_start/2000) - 1;
+    nFilesRead = (long)((tick_stop + 1999)/2000) + 1 - firstFileIndex;
+    if(*nthreads < 1) *nthreads = 1;
+    if(*nthreads > nFilesRead) *nthreads = nFilesRead;
 
-            }
-            //TODO free all the crap
-            return -1;
-        }
+    startTs = (time_t)FirstFile;
+    gmtime_r(&startTs, &startTime);
+    memset(&yearStartTime, 0, sizeof(yearStartTime));
+    yearStartTime.tm_year = startTime.tm_year;
+    yearStartTime.tm_mday = 1;
+    tsOffs = timegm(&yearStartTime);
+    tstart = (uint64_t)(FirstFile-tsOffs)*2000;
 
-        fp = fopen(fName, "rb");
-        rd = fread(data, 1, fSize, fp);
-        if((rd != fSize) && (verbose >= 1)) {printf("Didn't read the entire file %s\n",fName); fflush(stdout);}
-        fclose(fp);
+    if(verbose >= 2){
+        printf("Start time = %ld\n",tstart); fflush(stdout);}
 
-        // parse the data into photon tables in memory
-        for( j=0; j<fSize/8; j++) {
-            swp = *((uint64_t *) (&data[j]));
-            swp1 = __bswap_64(swp);
-            hdr = (struct hdrpacket *) (&swp1);
-            if (hdr->start == 0b11111111) {
-                firstHeader = j;
-                pstart = j;
-                if((firstHeader != 0) && (verbose >= 2)) { printf("First header at %ld\n",firstHeader); fflush(stdout);}
-                break;
-            }
-        }
+    jobs = (struct parsejob *) calloc(*nthreads, sizeof(struct parsejob));
+    if(jobs == NULL) return NULL;
+    for(t=0; t < *nthreads; t++) {
+        jobs[t].binpath = binpath;
+        jobs[t].iStart = firstFileIndex + (t * nFilesRead) / *nthreads;
+        jobs[t].iStop = firstFileIndex + ((t + 1) * nFilesRead) / *nthreads;
+        jobs[t].FirstFile = FirstFile;
+        jobs[t].verbose = verbose;
+        jobs[t].pass = PASS_COUNT;
+        jobs[t].subtract = subtract_baseline;
+        jobs[t].useIndex = use_index;
+        jobs[t].tickStart = tick_start;
+        jobs[t].tickStop = tick_stop;
+        jobs[t].tsOffs = tsOffs;
+        jobs[t].tstart = tstart;
+        jobs[t].PixelResID = ext->PixelResID;
+        jobs[t].LayoutPix = ext->LayoutPix;
+        jobs[t].beamCols = beamCols;
+        jobs[t].beamRows = beamRows;
+        jobs[t].count = (uint64_t *) calloc(beamCols * beamRows + 1, sizeof(uint64_t));
+        jobs[t].blhist = (uint64_t *) calloc(NBASELINE, sizeof(uint64_t));
+        jobs[t].offset = (uint64_t *) malloc((beamCols * beamRows + 1) * sizeof(uint64_t));
+        jobs[t].files = (struct binfile *) calloc(jobs[t].iStop - jobs[t].iStart + 1, sizeof(struct binfile));
+        if(!jobs[t].count || !jobs[t].blhist || !jobs[t].offset || !jobs[t].files) ok = 0;
+    }
+    if(!ok) {
+        FreeJobs(jobs, *nthreads);
+        return NULL;
+    }
+    return jobs;
+}
 
-        // reformat all the packets into memory then dump to disk for speed
-        for( k=firstHeader+1; k<(fSize/8); k++) {
-            swp = *((uint64_t *) (&data[k]));
-            swp1 = __bswap_64(swp);
-            hdr = (struct hdrpacket *) (&swp1);
+/*
+ * Returns the median baseline of the photons counted by the jobs, merging their baseline histograms into the first's.
+ */
+float JobsBaselineMedian(struct parsejob *jobs, int nthreads, uint64_t nPhot) {
+    long i, t;
+    for(t=1; t < nthreads; t++)
+        for(i=0; i < NBASELINE; i++) jobs[0].blhist[i] += jobs[t].blhist[i];
+    return BaselineMedian(jobs[0].blhist, nPhot);
+}
 
-            if (hdr->start == 0b11111111) {        // found new packet header!
-                //fill packet and parse
-                if((k*8 - pstart > 816) && (verbose >= 1)) { printf("Packet too long - %ld bytes\n",k*8 - pstart); fflush(stdout);}
-                memmove(packet, &data[pstart/8], k*8 - pstart);
-                pcount++;
-                // add to HDF5 file
-     	        ParseToMem(packet,k*8-pstart,tsOffs,FirstFile,i,nFiles,BeamMap,BeamFlag,mapflag,ResIdString,ptable,ptablect,beamCols,beamRows,verbose);
-		        pstart = k*8;   // move start location for next packet
-		        //if( pcount%1000 == 0 ) { printf("."); fflush(stdout);}
-            }
-        }
+/*
+ * Adds the raw 17 bit baselines of the photons extractor_extract would extract to the NBASELINE bin histogram blhist,
+ * offset by NBASELINE/2, with a count-only pass. Windows longer than extractor_extract allows can be histogrammed
+ * piece by piece and BaselineMedian taken of the total, to subtract one median from all of them. Returns the number
+ * of photons or a negative error.
+ */
+long extractor_baseline_histogram(const extractor *ext, const char *binpath, unsigned long start_timestamp,
+                                  unsigned long tick_start, unsigned long tick_stop, uint64_t *blhist, int use_index,
+                                  int nthreads, int verbose) {
+    long i, t, pix;
+    uint64_t nPhot = 0;
+    struct parsejob *jobs;
+
+    jobs = MakeJobs(ext, binpath, start_timestamp, tick_start, tick_stop, 1, use_index, &nthreads, verbose);
+    if(jobs == NULL) return -1;
+    RunJobs(jobs, nthreads);
+    for(t=0; t < nthreads; t++) {
+        for(pix=0; pix < ext->beamCols * ext->beamRows; pix++) nPhot += jobs[t].count[pix];
+        for(i=0; i < NBASELINE; i++) blhist[i] += jobs[t].blhist[i];
     }
+    FreeJobs(jobs, nthreads);
+    return (long) nPhot;
+}
 
-    diff = clock()-start;
-    olddiff = diff;
+/*
+ * Extracts the photons with header times in [tick_start, tick_stop), in half-ms since start_timestamp, into otable.
+ * Photon times are in microseconds since start_timestamp. Photons are sorted by resID then time (the photons of
+ * pixels sharing a resID are merged). If pix_offsets isn't NULL the output index of the first photon of each of the
+ * extractor_layout pixels, and the total, are written to it. If subtract_baseline is set the median baseline of the
+ * extracted photons is subtracted, or *baseline_median if it isn't NULL.
+ * If use_index is set the header indexes of the files are cached in .idx sidecars (see struct binindex).
+ * All state is local to the call, so extractions can run concurrently. Returns the number of photons or a negative
+ * error.
+ */
+long extractor_extract(const extractor *ext, const char *binpath, unsigned long start_timestamp,
+                       unsigned long tick_start, unsigned long tick_stop, unsigned long n_max_photons, photon* otable,
+                       uint64_t *pix_offsets, int subtract_baseline, const float *baseline_median, int use_index,
+                       int nthreads, int verbose) {
+    uint32_t pix;
+    long j, t, status;
+    clock_t start, diff;
+    uint64_t nPhot, *pixStart;
+    struct parsejob *jobs;
+    float blmedian;
 
-    if(verbose >= 2){
-        printf("Read and parsed data in memory in %f s.\n",(float)diff/CLOCKS_PER_SEC);  fflush(stdout);
+    start = clock();
 
+    // Set up one job per thread
+    jobs = MakeJobs(ext, binpath, start_timestamp, tick_start, tick_stop, subtract_baseline, use_index, &nthreads,
+                    verbose);
+    if(jobs == NULL) return -1;
+    pixStart = pix_offsets != NULL ? pix_offsets : (uint64_t *) malloc((ext->nLayout + 1) * sizeof(uint64_t));
+    if(pixStart == NULL) {
+        FreeJobs(jobs, nthreads);
+        return -1;
+    }
+    for(t=0; t < nthreads; t++) {
+        jobs[t].otable = otable;
+        jobs[t].pixStart = pixStart;
     }
 
-    nPhot=0;
-    for(j=0; j < nBMEntries; j++) {
-        x = DiskBeamMap[NBMFIELD*j + 2];
-        y = DiskBeamMap[NBMFIELD*j + 3];
-        if(verbose >= 3){
-            printf("memcpy %d: %d %d\n", j, x, y); fflush(stdout);
+    // Count
+    RunJobs(jobs, nthreads);
 
+    diff = clock()-start;
+    if(verbose >= 2){
+        printf("Counted photons in %f s.\n",(float)diff/CLOCKS_PER_SEC);  fflush(stdout);}
+
+    // Lay out the output pixel by pixel in resID order, each pixel thread by thread
+    nPhot = 0;
+    for(j=0; j < ext->nLayout; j++) {
+        pix = ext->LayoutPix[j];
+        pixStart[j] = nPhot;
+        for(t=0; t < nthreads; t++) {
+            jobs[t].offset[pix] = nPhot;
+            nPhot += jobs[t].count[pix];
         }
-        if(x==0 && y==0) continue;
-        if(x >= beamCols || y >= beamRows) continue;
-        if( BeamMap[x][y] == beamMapInitVal ) continue;
-        if( ptablect[x][y] == 0 ) continue;
-        memcpy(&otable[nPhot], ptable[x][y], ptablect[x][y] * sizeof(photon));
-        nPhot +=  ptablect[x][y];
-	}
-
-    if(verbose >= 3){
-	    printf("Memcopy done.\n"); fflush(stdout);
-
     }
+    pixStart[ext->nLayout] = nPhot;
 
-	// free photon tables for every resid
-    for(i=0; i < beamCols; i++) {
-		for(j=0; j < beamRows; j++) {
-			if( BeamMap[i][j] == 0 ) continue;
-            if(verbose >= 3){
-                printf("freeing %d %d\n", i, j); fflush(stdout);
-
-            }
-
-			free(ptable[i][j]);
-		}
-	}
-
-    if(verbose >= 3){
-	    printf("Done freeing beammap.\n"); fflush(stdout);
+    status = 0;
+    if(nPhot > n_max_photons) {
+        if(verbose >= 1){
+            printf("Output table too small for %lu photons\n", nPhot); fflush(stdout);}
+        status = -1;
+    }
 
+    if(status == 0) {
+        // Write
+        blmedian = baseline_median != NULL ? *baseline_median : JobsBaselineMedian(jobs, nthreads, nPhot);
+        if(verbose >= 2){
+            printf("Baseline median is %f\n", blmedian); fflush(stdout);}
+        for(t=0; t < nthreads; t++) {
+            jobs[t].pass = PASS_WRITE;
+            jobs[t].blmedian = blmedian;
+        }
+        RunJobs(jobs, nthreads);
+
+        // every counted photon must have been written, or some output slots hold garbage (a file was rewritten)
+        for(t=0; t < nthreads && status == 0; t++)
+            for(pix=0; pix < ext->beamCols * ext->beamRows; pix++)
+                if(jobs[t].count[pix] != 0) {
+                    if(verbose >= 1){
+                        printf("Warning: bin files changed while extracting\n"); fflush(stdout);}
+                    status = -1;
+                    break;
+                }
+
+        // Sort each resID by time, splitting the pixels between threads by photon count without splitting a resID
+        for(t=0, j=0; t < nthreads; t++) {
+            jobs[t].pass = PASS_SORT;
+            jobs[t].sortStart = j;
+            while(j < ext->nLayout && pixStart[j] < ((t + 1) * nPhot) / nthreads) j++;
+            while(j > 0 && j < ext->nLayout &&
+                  ext->PixelResID[ext->LayoutPix[j]] == ext->PixelResID[ext->LayoutPix[j-1]]) j++;
+            jobs[t].sortStop = t == nthreads - 1 ? ext->nLayout : j;
+        }
+        RunJobs(jobs, nthreads);
     }
 
+    FreeJobs(jobs, nthreads);
+    if(pix_offsets == NULL) free(pixStart);
 
     diff = clock()-start;
-    if(verbose >= 2){
-        printf("Parsed %ld photons in %f seconds: %9.1f kphotons/sec.\n",nPhot,((float)diff)/CLOCKS_PER_SEC,
+    if(verbose >= 2 && status == 0){
+        printf("Parsed %lu photons in %f seconds (CPU): %9.1f kphotons/sec.\n",nPhot,((float)diff)/CLOCKS_PER_SEC,
             ((float)nPhot)/((float)(diff)/CLOCKS_PER_SEC)/1000); fflush(stdout);
 
     }
 
-    free(data);
+    return status == 0 ? (long) nPhot : status;
+}
 
-    for(i=0; i<beamCols; i++)
-    {
-        free(BeamMap[i]);
-        free(BeamFlag[i]);
-        free(ptable[i]);
-        free(ptablect[i]);
-        free(ResIdString[i]);
+/*
+ * Histograms the photons extractor_extract would extract into counts, without keeping them. counts is a C order
+ * beamCols x beamRows [x nwbins] [x ntbins] array, the wavelength axis is there if nwbins > 0 and the time axis if
+ * ntbins > 0. The wavelength bins are [wbins[i], wbins[i+1]) for the nwbins+1 ascending edges wbins, the last bin
+ * closed as for np.histogram. The time bins are tbin_us wide from tick_start, photons outside the bins are skipped.
+ * The baseline median is only needed (and a counting pass made) for wavelength bins of baseline subtracted photons.
+ * Returns the number of photons binned or a negative error.
+ */
+long extractor_histogram(const extractor *ext, const char *binpath, unsigned long start_timestamp,
+                         unsigned long tick_start, unsigned long tick_stop, uint32_t *counts, const double *wbins,
+                         int nwbins, unsigned long tbin_us, unsigned int ntbins, int subtract_baseline,
+                         int use_index, int nthreads, int verbose) {
+    long t, pix;
+    uint64_t nPhot = 0;
+    struct parsejob *jobs;
+    float blmedian = 0;
+
+    if(nwbins < 0 || (ntbins > 0 && tbin_us == 0)) return -1;
+    subtract_baseline = subtract_baseline && nwbins > 0;
+    jobs = MakeJobs(ext, binpath, start_timestamp, tick_start, tick_stop, subtract_baseline, use_index, &nthreads,
+                    verbose);
+    if(jobs == NULL) return -1;
+
+    if(subtract_baseline) {
+        RunJobs(jobs, nthreads);
+        for(t=0; t < nthreads; t++)
+            for(pix=0; pix < ext->beamCols * ext->beamRows; pix++) nPhot += jobs[t].count[pix];
+        blmedian = JobsBaselineMedian(jobs, nthreads, nPhot);
+        if(verbose >= 2){
+            printf("Baseline median is %f\n", blmedian); fflush(stdout);}
     }
 
+    for(t=0; t < nthreads; t++) {
+        jobs[t].pass = PASS_HISTOGRAM;
+        jobs[t].blmedian = blmedian;
+        jobs[t].hist = counts;
+        jobs[t].wbins = wbins;
+        jobs[t].nwbins = nwbins;
+        jobs[t].tbinUs = tbin_us;
+        jobs[t].ntbins = ntbins;
+        jobs[t].shared = nthreads > 1;
+    }
+    RunJobs(jobs, nthreads);
 
-    free(BeamMap);
-    free(BeamFlag);
-    free(ptable);
-    free(ptablect);
-    free(ResIdString);
-    free(toWriteBeamMap);
-    free(toWriteBeamFlag);
-
-    free(yearStartTime);
+    nPhot = 0;
+    for(t=0; t < nthreads; t++) nPhot += jobs[t].nBinned;
+    FreeJobs(jobs, nthreads);
+    if(verbose >= 2){
+        printf("Binned %lu photons\n", nPhot); fflush(stdout);}
+    return (long) nPhot;
+}
 
-    return nPhot;
+/*
+ * extractor_extract with an extractor for DiskBeamMap made just for this call.
+ */
+long extract_photons(const char *binpath, unsigned long start_timestamp, unsigned long tick_start,
+                     unsigned long tick_stop, long *DiskBeamMap, int n_bm_entries, unsigned int bmap_ncol, unsigned int bmap_nrow,
+                     unsigned long n_max_photons, photon* otable, int subtract_baseline, int use_index, int nthreads,
+                     int verbose) {
+    long ret;
+    extractor *ext;
+
+    ext = extractor_create(DiskBeamMap, n_bm_entries, bmap_ncol, bmap_nrow, verbose);
+    if(ext == NULL) return -1;
+    ret = extractor_extract(ext, binpath, start_timestamp, tick_start, tick_stop, n_max_photons, otable, NULL,
+                            subtract_baseline, NULL, use_index, nthreads, verbose);
+    extractor_free(ext);
+    return ret;
 }
 
 
@@ -514,54 +1096,66 @@ long extract_photons_dummy(const char *binpath, unsigned long start_timestamp, u
 }
 
 
-long cparsebin(const char *fName, unsigned long max_len,
-                       float* baseline, float* wavelength, unsigned long long* time,
-                       unsigned int* ycoord, unsigned int* xcoord, unsigned int* roach) {
+long cparsebin(const char *fName, unsigned long max_len, parsedphoton* photons, unsigned long *resume) {
     /*
-    The function returns the number of packet in the file. If the file turns out to have more packets than max_len,
-    the arrays are populated with the first max_len-1 records and the last record.
+    The function writes the real photons of the file to photons, fake photons (x=511, which end frames closed by
+    the 0.5 ms clock) are skipped. Parsing starts at word *resume, 0 for the start of the file. If photons fills up
+    (max_len) *resume is set to the word to carry on from with a bigger buffer, otherwise to 0, so a file is only
+    ever parsed once. The function returns the number of photons written.
     If there are errors (e.g. file not found) return appropriate error numbers as - return values.
     */
-    unsigned long out_i=0, pcount=0;
-	FILE *fp;
+    unsigned long pcount=0, nWords, i, start;
 	struct stat st;
-	long fSize,rd;
+	long fSize;
 	uint64_t *data;
-	uint64_t swp,swp1,firstHeader,pstart,curtime=0,curroach=0;
+	uint64_t swp,swp1,firstHeader,curtime=0,curroach=0;
 	struct hdrpacket *hdr;
 	struct datapacket *photondata;
-	char packet[808*16];
-
-    //open up file
-	stat(fName, &st);
-	fSize = st.st_size;
-	//printf("\nReading %s - %ld bytes\n",fName,fSize);
-	data = (uint64_t *) malloc(fSize);
-    fp = fopen(fName, "rb");
-    rd = fread( data, 1, fSize, fp);
-    if( rd != fSize) {printf("Didn't read the entire file %s\n",fName);fflush(stdout);}
-    fclose(fp);
-
-    //if not open
-    if (rd < 0 ) return -1;
-
-	// Find the first header packet
-	for(unsigned long i=0; i<fSize/8; i++) {
-		swp = *((uint64_t *) (&data[i]));
-		swp1 = __bswap_64(swp);
-		hdr = (struct hdrpacket *) (&swp1);
-		if (hdr->start == 0b11111111) {
-			firstHeader = i;
-			pstart = i;
-			curtime = (uint64_t)hdr->timestamp*500;
-			curroach = hdr->roach;
-			if( firstHeader != 0 ) {printf("First header at %ld\n",firstHeader);fflush(stdout);}
-			break;
-		}
+	parsedphoton *p;
+
+    //map the file, an empty file has no photons
+	if(stat(fName, &st) != 0) return -1;
+	data = MapBinFile(fName, &fSize);
+	if(data == NULL) {
+	    *resume = 0;
+	    return st.st_size < 8 ? 0 : -1;
 	}
+	nWords = fSize/8;
+
+	if(*resume == 0) {
+        // Find the first header packet
+        firstHeader = nWords;
+        for(i=0; i<nWords; i++) {
+            swp = *((uint64_t *) (&data[i]));
+            swp1 = __bswap_64(swp);
+            hdr = (struct hdrpacket *) (&swp1);
+            if (hdr->start == 0b11111111) {
+                firstHeader = i;
+                curtime = (uint64_t)hdr->timestamp*500;
+                curroach = hdr->roach;
+                if( firstHeader != 0 ) {printf("First header at %ld\n",firstHeader);fflush(stdout);}
+                break;
+            }
+        }
+        start = firstHeader+1;
+    }
+    else {
+        // Carry on in the packet we stopped in, its header is the last one before *resume
+        start = *resume;
+        for(i=start < nWords ? start : nWords; i-- > 0;) {
+            swp1 = __bswap_64(data[i]);
+            hdr = (struct hdrpacket *) (&swp1);
+            if (hdr->start == 0b11111111) {
+                curtime = (uint64_t)hdr->timestamp*500;
+                curroach = hdr->roach;
+                break;
+            }
+        }
+    }
 
 	// New approach - do it all in this function
-    for(unsigned long i=firstHeader+1; i<fSize/8; i++) {
+	*resume = 0;
+    for(i=start; i<nWords; i++) {
         swp = *((uint64_t *) (&data[i]));
         swp1 = __bswap_64(swp);
         hdr = (struct hdrpacket *) (&swp1);
@@ -569,23 +1163,26 @@ long cparsebin(const char *fName, unsigned long max_len,
 			curtime = (uint64_t)hdr->timestamp*500;     // convert units from 1/2 millisecond to microsecond.
 			                                  // curtime is the number of us from the beginning of the year.
 			curroach = hdr->roach;
-		}
-		else {                              // must be data. Save as photondata struct
-		    out_i = pcount >= max_len ? max_len: pcount;
-			photondata = (struct datapacket *) (&swp1);
-			baseline[out_i] = ((float) photondata->baseline)*RAD2DEG/16384.0;
-			wavelength[out_i] = ((float) photondata->wavelength)*RAD2DEG/32768.0;
-            //printf("photon timestamp %u\n", photondata->timestamp);
-			time[out_i] = photondata->timestamp + curtime; // units are microseconds elapsed from beginning of year.
-			ycoord[out_i] = photondata->ycoord;
-			xcoord[out_i] = photondata->xcoord;
-			roach[out_i] = curroach;
-			pcount++;
+			continue;
 		}
 
+		// must be data. Save as photondata struct
+		photondata = (struct datapacket *) (&swp1);
+		if (photondata->xcoord == FAKE_PHOTON_X) continue;
+		if (pcount == max_len) {
+		    *resume = i;
+		    break;
+		}
+		p = &photons[pcount++];
+		p->baseline = ((float) photondata->baseline)*RAD2DEG/16384.0;
+		p->phase = ((float) photondata->wavelength)*RAD2DEG/32768.0;
+		p->tstamp = photondata->timestamp + curtime; // units are microseconds elapsed from beginning of year.
+		p->y = photondata->ycoord;
+		p->x = photondata->xcoord;
+		p->roach = curroach;
 	}
     //close up file
-	free(data);
+	munmap(data, fSize);
 
     return pcount;
 }
@@ -2,16 +2,52 @@ typedef struct photon {
     uint32_t resID;
     uint32_t time;
     float wavelength;
-    float baseline;
+    float weight;
 } photon;
 
-long extract_photons(const char *dname, unsigned long start, unsigned long inttime,
+// a photon as returned by cparsebin, ParsedPhotonCompactType in mkidcore.headers
+typedef struct parsedphoton {
+    float baseline;
+    float phase;
+    uint64_t tstamp;
+    uint16_t y;
+    uint16_t x;
+    uint16_t roach;
+} parsedphoton;
+
+// beammap lookup tables that can be reused across (and shared by concurrent) extractions
+typedef struct extractor extractor;
+
+extractor *extractor_create(long *DiskBeamMap, int n_bm_entries, unsigned int bmap_ncol, unsigned int bmap_nrow,
+                            int verbose);
+
+uint32_t extractor_layout(const extractor *ext, uint32_t *resids);
+
+void extractor_free(extractor *ext);
+
+long extractor_extract(const extractor *ext, const char *dname, unsigned long start, unsigned long tick_start,
+                       unsigned long tick_stop, unsigned long n_max_photons, photon* photons, uint64_t *pix_offsets,
+                       int subtract_baseline, const float *baseline_median, int use_index, int nthreads,
+                       int verbose);
+
+long extractor_baseline_histogram(const extractor *ext, const char *dname, unsigned long start,
+                                  unsigned long tick_start, unsigned long tick_stop, uint64_t *blhist, int use_index,
+                                  int nthreads, int verbose);
+
+float BaselineMedian(const uint64_t *hist, uint64_t nPhot);
+
+long extractor_histogram(const extractor *ext, const char *dname, unsigned long start, unsigned long tick_start,
+                         unsigned long tick_stop, uint32_t *counts, const double *wbins, int nwbins,
+                         unsigned long tbin_us, unsigned int ntbins, int subtract_baseline, int use_index,
+                         int nthreads, int verbose);
+
+long extract_photons(const char *dname, unsigned long start, unsigned long tick_start, unsigned long tick_stop,
                      long *DiskBeamMap, int n_bm_entries, unsigned int bmap_ncol,
-                     unsigned int bmap_nrow, unsigned long n_max_photons, photon* photons, int verbose);
+                     unsigned int bmap_nrow, unsigned long n_max_photons, photon* photons, int subtract_baseline,
+                     int use_index, int nthreads, int verbose);
 
 long extract_photons_dummy(const char *dname, unsigned long start, unsigned long inttime,
                      const char *bmap, unsigned int bmap_ncol, unsigned int bmap_nrow,
                      unsigned long n_max_photons, photon* photons);
 
-long cparsebin(const char *fName, unsigned long max_len, float* baseline, float* wavelength, unsigned long long* time,
-               unsigned int* ycoord, unsigned int* xcoord, unsigned int* roach);
+long cparsebin(const char *fName, unsigned long max_len, parsedphoton* photons, unsigned long *resume);
@@ -9,98 +9,300 @@ import numpy as np
 cimport numpy as np
 import os
 from mkidcore.corelog import getLogger
-from mkidcore.objects import Beammap
-# from mkidcore.headers import PhotonNumpyType as np_photon
-# from mkidcore.headers import PhotonNumpyTypeBin as np_photon_bin
-import ctypes
+from mkidcore.headers import (PhotonNumpyType, PhotonNumpyTypeBin, PhotonCType, ParsedPhotonType,
+                              ParsedPhotonCompactType, TICKS_PER_SECOND, US_PER_TICK)
+from mkidcore.binfile.npbin import (extract_fake, _beammap_array, _resid_csr, _trim_window, _max_photons, _check_out,
+                                    MAX_WINDOW_TICKS, NBASELINE)
 
 PHOTON_BIN_SIZE_BYTES = 8
 PHOTON_SIZE_BYTES = 4*4
 
-
-# This what is in the binprocessor.c
-PhotonNumpyTypeBin = np.dtype([('resID', np.uint32),
-                               ('time', np.uint32),
-                               ('wavelength', np.float32),
-                               ('baseline', np.float32)
-                               ], align=True)
-
-# PhotonNumpyType and PhotonCType are based on what we get back from an H5 file (based on PhotonDescription)
-PhotonNumpyType = np.dtype([('resID', np.uint32),
-                            ('time', np.uint32),
-                            ('wavelength', np.float32),
-                            ('weight', np.float32)])
-
-
-class PhotonCType(ctypes.Structure):
-    _fields_ = [('resID', ctypes.c_uint32),
-                ('time', ctypes.c_uint32),
-                ('wavelength', ctypes.c_float),
-                ('weight', ctypes.c_float)]
-
 np_photon = PhotonNumpyType
 np_photon_bin = PhotonNumpyTypeBin
 
 cdef extern from "binprocessor.h":
     struct photon
-    long extract_photons(const char *dname, unsigned long start, unsigned long inttime,
+    long extract_photons(const char *dname, unsigned long start, unsigned long tick_start, unsigned long tick_stop,
                      long *DiskBeamMap, int n_bm_entries, unsigned int bmap_ncol,
-                     unsigned int bmap_nrow, unsigned long n_max_photons, photon* photons, int verbose);
+                     unsigned int bmap_nrow, unsigned long n_max_photons, photon* photons, int subtract_baseline,
+                     int use_index, int nthreads, int verbose) nogil
     long extract_photons_dummy(const char *dname, unsigned long start, unsigned long inttime, const char *bmap,
                                unsigned int x, unsigned int y, unsigned long n_max_photons, photon* photons)
-    long cparsebin(const char *fName, unsigned long max_len, float* baseline, float* wavelength,
-                   unsigned long long* timestamp, unsigned int* ycoord, unsigned int* xcoord, unsigned int* roach)
-
-
-def extract(directory, start, inttime, beammap, x, y, include_baseline=False, verbose=0):
-    files = [os.path.join(directory, '{}.bin'.format(t)) for t in range(start-1, start+inttime+1)]
-    files = filter(os.path.exists, files)
-    if isinstance(beammap, str):
-        beammap = Beammap(beammap, xydim=(x, y))
-
-    if np.ceil(inttime*1e6) > 2**32:
-        raise ValueError('Integration times longer than 4294 s are not supported due to uint32 rollover')
-
-    bmarr = np.vstack((beammap.resIDs, beammap.flags, beammap.xCoords, beammap.yCoords)).T
-    if np.any(np.isnan(bmarr)):
-        raise Exception('NaNs in beammap')
-    if np.any((beammap.xCoords >= x) | (beammap.xCoords < 0) | (beammap.yCoords >= y) | (beammap.yCoords < 0)):
-        raise Exception('Beammap coords out of range')
-    bmarr = np.ascontiguousarray(bmarr.astype(int)) #bmarr is nPix x 4
-    n_bm_entries = int(bmarr.shape[0])
-
-    n_max_photons = int(np.ceil(sum([os.stat(f).st_size for f in files])/PHOTON_BIN_SIZE_BYTES))
-    getLogger(__name__).debug('Calling C to extract ~{:g} photons, will require ~{:.1f}GB of RAM'.format(n_max_photons,
-                                                                                   n_max_photons*PHOTON_SIZE_BYTES/1024/1024/1024))
-    photons = np.zeros(n_max_photons, dtype=np_photon_bin)
-    photons = np.ascontiguousarray(photons)
-    nphotons = extract_photons(directory.encode('UTF-8'), start, inttime, <long*>np.PyArray_DATA(bmarr), n_bm_entries,
-                            x, y, n_max_photons, <photon*> np.PyArray_DATA(photons), verbose)
-    getLogger(__name__).debug('C code returned {} photons'.format(nphotons))
-    photons = photons[:nphotons]
-
-    baselines = photons['baseline']
-    baseline_median = np.median(baselines)
-    getLogger(__name__).debug('BL median is ' + str(baseline_median))
-    photons2 = np.zeros(nphotons, dtype=np_photon)
-
-    photons2['wavelength'] = photons['wavelength']
-    if not include_baseline:
-        photons2['wavelength'] += photons['baseline'] - baseline_median
-    photons2['resID'] = photons['resID']
-    photons2['time'] = photons['time']
-    photons2['weight'] = 1.0
-    return photons2
-
-
-def extract_fake(nphotons, start=1547683242, intt=150, nres=20000):
-    photons = np.zeros(nphotons, dtype=np_photon)
-    photons['resID'] = np.random.randint(0, nres, nphotons, np.uint32)
-    photons['time'] = np.random.randint(start,start+intt, nphotons, np.uint32)
-    photons['wavelength'] = np.random.random(nphotons)
-    photons['weight'] = 1.0
-    photons['baseline'] = np.random.random(nphotons)
-    return photons
+    struct parsedphoton
+    struct extractor
+    extractor *extractor_create(long *DiskBeamMap, int n_bm_entries, unsigned int bmap_ncol, unsigned int bmap_nrow,
+                                int verbose) nogil
+    void extractor_free(extractor *ext) nogil
+    unsigned int extractor_layout(const extractor *ext, unsigned int *resids) nogil
+    long extractor_extract(const extractor *ext, const char *dname, unsigned long start, unsigned long tick_start,
+                           unsigned long tick_stop, unsigned long n_max_photons, photon* photons,
+                           np.uint64_t *pix_offsets, int subtract_baseline, const float *baseline_median,
+                           int use_index, int nthreads, int verbose) nogil
+    long extractor_baseline_histogram(const extractor *ext, const char *dname, unsigned long start,
+                                      unsigned long tick_start, unsigned long tick_stop, np.uint64_t *blhist,
+                                      int use_index, int nthreads, int verbose) nogil
+    float BaselineMedian(const np.uint64_t *hist, np.uint64_t nPhot) nogil
+    long extractor_histogram(const extractor *ext, const char *dname, unsigned long start, unsigned long tick_start,
+                             unsigned long tick_stop, np.uint32_t *counts, const double *wbins, int nwbins,
+                             unsigned long tbin_us, unsigned int ntbins, int subtract_baseline, int use_index,
+                             int nthreads, int verbose) nogil
+    long cparsebin(const char *fName, unsigned long max_len, parsedphoton* photons, unsigned long *resume) nogil
+
+
+cdef class Extractor:
+    """
+    A beammap prepared for photon extraction.
+
+    The beammap's pixel lookup tables are built once, rather than on every call, so repeated extractions with
+    the same beammap (e.g. iter_extract chunks or quick-look windows) skip that work. An Extractor holds no
+    per-call state, so one can be shared by threads extracting concurrently. Changes to the beammap after the
+    Extractor is made are not seen by it. x and y default to the beammap's ncols and nrows.
+
+    Photons are sorted by resID then time. With resid_offsets the extractions also return the resIDs and a CSR
+    style index into the photons, the photons of resids[i] are photons[offsets[i]:offsets[i+1]].
+    """
+    cdef extractor *_ext
+    cdef readonly unsigned int x, y
+    cdef readonly object resids  # resIDs of the extracted pixels, in output order
+
+    def __cinit__(self, beammap, x=None, y=None, verbose=0):
+        cdef long *bm
+        cdef int n_bm_entries, cverbose = verbose
+        if x is None or y is None:
+            x, y = beammap.ncols, beammap.nrows
+        self.x, self.y = x, y
+        bmarr = _beammap_array(beammap, x, y)
+        bm, n_bm_entries = <long*>np.PyArray_DATA(bmarr), int(bmarr.shape[0])
+        with nogil:
+            self._ext = extractor_create(bm, n_bm_entries, self.x, self.y, cverbose)
+        if self._ext == NULL:
+            raise MemoryError('Unable to allocate the beammap tables for a {}x{} array'.format(x, y))
+        self.resids = np.empty(extractor_layout(self._ext, NULL), dtype=np.uint32)
+        extractor_layout(self._ext, <unsigned int*> np.PyArray_DATA(self.resids))
+
+    def __dealloc__(self):
+        extractor_free(self._ext)
+
+    def _baseline_median(self, directory, start, tick_start, tick_stop, verbose=0, nthreads=1, use_index=True):
+        """
+        The median baseline, in degrees, of the photons with header times in [tick_start, tick_stop), in half-ms
+        from start. Only the photons are counted, so the window can be any length.
+        """
+        cdef long n
+        cdef np.uint64_t nphotons = 0
+        cdef unsigned long cstart = start, ctick_start, ctick_stop
+        cdef int cuse_index = bool(use_index), cthreads = max(int(nthreads), 1), cverbose = verbose
+        cdef bytes dname = directory.encode('UTF-8')
+        cdef const char *cdname = dname
+        blhist = np.zeros(NBASELINE, dtype=np.uint64)
+        cdef np.uint64_t *hist = <np.uint64_t*> np.PyArray_DATA(blhist)
+        for tick in range(tick_start, tick_stop, MAX_WINDOW_TICKS):
+            ctick_start, ctick_stop = tick, min(tick + MAX_WINDOW_TICKS, tick_stop)
+            with nogil:
+                n = extractor_baseline_histogram(self._ext, cdname, cstart, ctick_start, ctick_stop, hist,
+                                                 cuse_index, cthreads, cverbose)
+            if n < 0:
+                raise RuntimeError('Baseline histogram of {} failed ({})'.format(directory, n))
+            nphotons += n
+        return BaselineMedian(hist, nphotons)
+
+    def _extract_window(self, directory, start, tick_start, tick_stop, include_baseline=False, verbose=0, nthreads=1,
+                        use_index=True, resid_offsets=False, baseline_median=None, out=None):
+        """
+        Extract the photons with header times in [tick_start, tick_stop), in half-ms from start. Photon times are in
+        us from start. The median baseline of the window is subtracted unless include_baseline, or baseline_median
+        if given. With out the photons are written to the start of it and a view returned.
+        """
+        cdef long nphotons
+        cdef unsigned long cstart = start, ctick_start = tick_start, ctick_stop = tick_stop, n_max_photons
+        cdef int subtract = not include_baseline, cuse_index = bool(use_index), cthreads = max(int(nthreads), 1)
+        cdef int cverbose = verbose
+        cdef float blmedian = 0
+        cdef const float *pblmedian = NULL
+        cdef photon *buf
+        cdef np.uint64_t *offsets
+        cdef bytes dname = directory.encode('UTF-8')
+        cdef const char *cdname = dname
+        if out is not None:
+            _check_out(out)
+            n_max_photons = out.size
+        else:
+            n_max_photons = _max_photons(directory, start, tick_start, tick_stop)
+        getLogger(__name__).debug('Calling C to extract ~{:g} photons, will require ~{:.1f}GB of RAM'.format(n_max_photons,
+                                                                                       n_max_photons*PHOTON_SIZE_BYTES/1024/1024/1024))
+        # The C code writes the final PhotonNumpyType layout and subtracts the baseline itself, using an exact
+        # histogram median, so the buffer is the output. Shrinking it reallocs in place rather than copying.
+        # The GIL is released while the C code runs so other threads, e.g. other extractions, carry on.
+        photons = np.empty(n_max_photons, dtype=np_photon) if out is None else out
+        buf = <photon*> np.PyArray_DATA(photons)
+        pix_offsets = np.empty(self.resids.size + 1, dtype=np.uint64)
+        offsets = <np.uint64_t*> np.PyArray_DATA(pix_offsets)
+        if baseline_median is not None:
+            blmedian = baseline_median
+            pblmedian = &blmedian
+        with nogil:
+            nphotons = extractor_extract(self._ext, cdname, cstart, ctick_start, ctick_stop, n_max_photons, buf,
+                                         offsets, subtract, pblmedian, cuse_index, cthreads, cverbose)
+        getLogger(__name__).debug('C code returned {} photons'.format(nphotons))
+        if nphotons < 0:
+            raise RuntimeError('Photon extraction from {} failed ({})'.format(directory, nphotons))
+        if out is None:
+            photons.resize(nphotons, refcheck=False)
+        else:
+            photons = out[:nphotons]
+        if resid_offsets:
+            return (photons,) + _resid_csr(self.resids, pix_offsets)
+        return photons
+
+    def extract(self, directory, start, inttime, include_baseline=False, verbose=0, nthreads=1, use_index=True,
+                resid_offsets=False, out=None):
+        """
+        Extract the photons from start to start+inttime, see the module level extract.
+
+        out, if given, is a PhotonNumpyType array to extract into rather than a new one, e.g. shared memory. It must
+        have room for every word of the bin files read, _max_photons, and a view of the start of it is returned.
+        """
+        if np.ceil(inttime*1e6) > 2**32:
+            raise ValueError('Integration times longer than 4294 s are not supported due to uint32 rollover')
+        return self._extract_window(directory, start, 0, (inttime + 1) * TICKS_PER_SECOND, include_baseline,
+                                    verbose, nthreads, use_index, resid_offsets, out=out)
+
+    def extract_window(self, directory, start, t0, t1, include_baseline=False, verbose=0, nthreads=1,
+                       use_index=True, resid_offsets=False):
+        """Extract the photons from t0 to t1 seconds after start, see the module level extract_window"""
+        if not 0 <= t0 < t1:
+            raise ValueError('The window must have 0 <= t0 < t1')
+        if np.ceil(t1*1e6) > 2**32:
+            raise ValueError('Windows ending more than 4294 s after start are not supported due to uint32 rollover')
+        # a photon's time is up to 511 us after its header, so the packets of the tick before t0 can reach into it
+        result = self._extract_window(directory, start, max(int(np.floor(t0 * TICKS_PER_SECOND)) - 1, 0),
+                                      int(np.ceil(t1 * TICKS_PER_SECOND)), include_baseline, verbose, nthreads,
+                                      use_index, resid_offsets)
+        return _trim_window(result, t0, t1, resid_offsets)
+
+    def iter_extract(self, directory, start, inttime, chunk_seconds=10, include_baseline=False, verbose=0,
+                     nthreads=1, use_index=True, resid_offsets=False):
+        """Generator yielding the photons extract would return in chunks, see the module level iter_extract"""
+        if np.ceil(inttime*1e6) > 2**32:
+            raise ValueError('Integration times longer than 4294 s are not supported due to uint32 rollover')
+        if chunk_seconds <= 0:
+            raise ValueError('chunk_seconds must be positive')
+
+        chunk = max(int(round(chunk_seconds * TICKS_PER_SECOND)), 1)
+        tick_stop = (inttime + 1) * TICKS_PER_SECOND
+        # One median for the whole integration, as extract subtracts, found with a count-only pass
+        blmedian = None
+        if not include_baseline:
+            blmedian = self._baseline_median(directory, start, 0, tick_stop, verbose, nthreads, use_index)
+        for tick in range(0, tick_stop, chunk):
+            yield self._extract_window(directory, start, tick, min(tick + chunk, tick_stop), include_baseline,
+                                       verbose, nthreads, use_index, resid_offsets, blmedian)
+
+    def histogram(self, directory, start, inttime, wavelength_bins=None, time_bin=None, include_baseline=False,
+                  verbose=0, nthreads=1, use_index=True):
+        """Histogram the photons extract would return without keeping them, see the module level histogram"""
+        cdef long nphotons
+        cdef unsigned long cstart = start, ctick_stop, tbin_us = 0
+        cdef unsigned int ntbins = 0
+        cdef int nwbins = 0, subtract = not include_baseline, cuse_index = bool(use_index)
+        cdef int cthreads = max(int(nthreads), 1), cverbose = verbose
+        cdef const double *wbins = NULL
+        cdef np.uint32_t *buf
+        cdef bytes dname = directory.encode('UTF-8')
+        cdef const char *cdname = dname
+
+        if np.ceil(inttime*1e6) > 2**32:
+            raise ValueError('Integration times longer than 4294 s are not supported due to uint32 rollover')
+        ctick_stop = (inttime + 1) * TICKS_PER_SECOND
+        shape = [self.x, self.y]
+        if wavelength_bins is not None:
+            edges = np.ascontiguousarray(wavelength_bins, dtype=np.float64)
+            if edges.ndim != 1 or edges.size < 2 or np.any(np.diff(edges) <= 0):
+                raise ValueError('wavelength_bins must be at least two increasing bin edges')
+            nwbins = edges.size - 1
+            wbins = <const double*> np.PyArray_DATA(edges)
+            shape.append(nwbins)
+        if time_bin is not None:
+            tbin_us = int(round(time_bin * 1e6))
+            if tbin_us <= 0:
+                raise ValueError('time_bin must be at least 1 us')
+            ntbins = (ctick_stop * US_PER_TICK + tbin_us - 1) // tbin_us
+            shape.append(ntbins)
+
+        counts = np.zeros(shape, dtype=np.uint32)
+        buf = <np.uint32_t*> np.PyArray_DATA(counts)
+        with nogil:
+            nphotons = extractor_histogram(self._ext, cdname, cstart, 0, ctick_stop, buf, wbins, nwbins, tbin_us,
+                                           ntbins, subtract, cuse_index, cthreads, cverbose)
+        if nphotons < 0:
+            raise RuntimeError('Photon histogram of {} failed ({})'.format(directory, nphotons))
+        getLogger(__name__).debug('C code binned {} photons'.format(nphotons))
+        return counts
+
+
+def extract(directory, start, inttime, beammap, x, y, include_baseline=False, verbose=0, nthreads=1,
+            use_index=True, resid_offsets=False):
+    """
+    Extract the photons in the bin files of directory from start to start+inttime.
+
+    The photons are sorted by resID and then time (the photons of pixels sharing a resID in the beammap are
+    merged). With resid_offsets (photons, resids, offsets) is returned, where the photons of resids[i] are
+    photons[offsets[i]:offsets[i+1]], so a pixel's photons can be sliced out without a search.
+
+    The bin files are parsed by nthreads threads, each taking a contiguous block of files. The output is
+    identical regardless of the number of threads. With use_index the header index of each bin file is cached
+    in a .idx file next to it, so later extractions only read the packets in their time window. Use an
+    Extractor to extract repeatedly with the same beammap.
+    """
+    return Extractor(beammap, x, y, verbose=verbose).extract(directory, start, inttime, include_baseline, verbose,
+                                                             nthreads, use_index, resid_offsets)
+
+
+def extract_window(directory, start, t0, t1, beammap, x=None, y=None, include_baseline=False, verbose=0, nthreads=1,
+                   use_index=True, resid_offsets=False):
+    """
+    Extract the photons from t0 to t1 seconds after start, e.g. a sub-second slice for a quick look.
+
+    Only the photons with times in [t0, t1) are returned, to the us. Photon times are in us from start, as for
+    extract. With the header indexes cached only the packets around the window are read.
+    x and y default to the beammap's ncols and nrows.
+    """
+    return Extractor(beammap, x, y, verbose=verbose).extract_window(directory, start, t0, t1, include_baseline,
+                                                                    verbose, nthreads, use_index, resid_offsets)
+
+
+def iter_extract(directory, start, inttime, beammap, chunk_seconds=10, x=None, y=None, include_baseline=False,
+                 verbose=0, nthreads=1, use_index=True, resid_offsets=False):
+    """
+    Generator yielding the photons extract would return, in PhotonNumpyType chunks of chunk_seconds.
+
+    Only the bin files of one chunk are parsed at a time, so memory is bounded by the chunk size rather than
+    the integration time. Photon times are relative to start, as for extract. The baseline median of the whole
+    integration is found first with a counting pass, so the chunks join up to exactly what extract returns. x and
+    y default to the beammap's ncols and nrows. The beammap tables are built once for all the
+    chunks.
+    """
+    return Extractor(beammap, x, y, verbose=verbose).iter_extract(directory, start, inttime, chunk_seconds,
+                                                                  include_baseline, verbose, nthreads, use_index,
+                                                                  resid_offsets)
+
+
+def histogram(directory, start, inttime, beammap, x=None, y=None, wavelength_bins=None, time_bin=None,
+              include_baseline=False, verbose=0, nthreads=1, use_index=True):
+    """
+    Histogram the photons extract would return into an image, spectral cube or lightcurves while parsing, without
+    ever holding the photon list.
+
+    Returns x by y uint32 counts, with a wavelength axis binned by the edges wavelength_bins (as for np.histogram)
+    if they are given and a time axis of time_bin second bins from start if it is. Photons outside the bins are
+    not counted. So
+        histogram(d, start, 1800, bmap)                             is a 30 minute image
+        histogram(d, start, 10, bmap, wavelength_bins=edges)        is a x, y, len(edges)-1 spectral cube
+        histogram(d, start, 10, bmap, time_bin=1e-3)                is a lightcurve of every pixel
+    x and y default to the beammap's ncols and nrows.
+    """
+    return Extractor(beammap, x, y, verbose=verbose).histogram(directory, start, inttime, wavelength_bins, time_bin,
+                                                               include_baseline, verbose, nthreads, use_index)
 
 
 def test(nphot=10):
@@ -115,7 +317,6 @@ def test(nphot=10):
     photons['time'] = np.arange(nphot)*2
     photons['wavelength'] = np.ones(nphot)
     photons['weight'] = np.ones(nphot)*2
-    photons['baseline'] = np.ones(nphot)*4
 
     ret = extract_photons_dummy('/a/test/dir/'.encode('UTF-8'), 123456789, 54321, '/a/test/beammap'.encode('UTF-8'),
                                 111, 222, nphot, <photon*> np.PyArray_DATA(photons))
@@ -124,7 +325,7 @@ def test(nphot=10):
     return photons
 
 
-def parse(file,_n=0):
+def parse(file, compact=False, columns=False):
     """
     Created by KD and JB Sept 2018
     This cython function will take an input .bin file and send it to be parsed to
@@ -137,11 +338,10 @@ def parse(file,_n=0):
     ethernet frame. The firmware is set to end a fframe either when there are
     100 photons in the frame or the clock reaches the next 0.5 ms. In the latter
     casse, the firmware MUST generate a fake photon to end the frame. These
-    fake photons are not removed in the binlib.c code (they could be. We remove
-    them here in the cython file. We have to create a new array, even though it is memory
-    intensive, because you cannot change a numpy array's shape (easily).
+    fake photons are skipped by the C code, which writes the real photons straight
+    into a ParsedPhotonCompactType array (float32 phases, uint16 coordinates).
     File is called by:
-    p = mkidbin.parse("fname.bin",n)
+    p = mkidbin.parse("fname.bin")
     Returns
     p.base = baseline
     p.phase = phase
@@ -149,49 +349,43 @@ def parse(file,_n=0):
     p.y = ycoord
     p.x = xcoord
     p.roach = roachnum
+    as a ParsedPhotonType recarray, or the compact one if compact is set. With columns a dict of the fields
+    (views, not copies) is returned instead.
+    """
+    p = _cparse(file, os.stat(file).st_size // 8)
+    if not compact:
+        p = p.astype(ParsedPhotonType)
+    if columns:
+        return {name: p[name] for name in p.dtype.names}
+    return p.view(np.recarray)
+
+
+def _cparse(file, capacity):
+    """
+    Parse file into a ParsedPhotonCompactType array, starting with room for capacity photons. If the file has more
+    (it is being written to) the array is grown and the C code carries on where it stopped.
     """
+    cdef unsigned long resume = 0, room
+    cdef long nphotons = 0, ret, itemsize = ParsedPhotonCompactType.itemsize
+    cdef bytes fname = file.encode('UTF-8')
+    cdef const char *cfname = fname
+    cdef parsedphoton *buf
+    p = np.empty(max(int(capacity), 1), dtype=ParsedPhotonCompactType)
+    while True:
+        room = p.size - nphotons
+        buf = <parsedphoton*>(<char*>np.PyArray_DATA(p) + nphotons * itemsize)
+        with nogil:
+            ret = cparsebin(cfname, room, buf, &resume)
+        if ret < 0:
+            errors = {-1:'Data not found'}
+            raise RuntimeError(errors.get(ret, 'Unknown Error: {}'.format(ret)))
+        nphotons += ret
+        if not resume:
+            break
+        getLogger(__name__).debug('{} has more than {} photons, growing'.format(file, p.size))
+        p.resize(2 * p.size, refcheck=False)
+    getLogger(__name__).debug("number of parsed photons = {}".format(nphotons))
 
-    # Creating pointers to memory bocks that the binlib.c code will fill
-    n = int(max(os.stat(file).st_size/8, _n))
-    baseline   = np.empty(n, dtype=np.float32)
-    wavelength = np.empty(n, dtype=np.float32)
-    time  = np.empty(n, dtype=np.uint64)
-    y = np.empty(n, dtype=np.uint32)
-    x = np.empty(n, dtype=np.uint32)
-    roachnum = np.empty(n, dtype=np.uint32)
-
-    # Calling parsebin from binlib.c
-    # npackets is the number of real+fake photons processed by binlib.c
-    npackets = cparsebin(file.encode('UTF-8'), n,
-                 <float*>np.PyArray_DATA(baseline),
-                 <float*>np.PyArray_DATA(wavelength),
-                 <unsigned long long*>np.PyArray_DATA(time),
-                 <unsigned int*>np.PyArray_DATA(y),
-                 <unsigned int*>np.PyArray_DATA(x),
-                 <unsigned int*>np.PyArray_DATA(roachnum))
-    getLogger(__name__).debug("number of parsed photons = {}".format(npackets))
-
-    if npackets>n:
-        return parse(file,abs(npackets))
-    elif npackets<0:
-        errors = {-1:'Data not found'}
-        raise RuntimeError(errors.get(npackets, 'Unknown Error: {}'.format(npackets)))
-
-    # Create new struct from output from binlib.c
-    # What this does is only grab the elements of the arrays that are real valued
-    # This essentially clips the data since we declared it to be as long as the .bin
-    #  file, but some of those lines were headers, which are now empty in the returned arrays
-    #  We also combine the arrays into a single struct. It's a for loop, but its actually a fast one
-    dt  = np.dtype([('baseline', float),('phase', float), ('tstamp', np.uint64),('y', int), ('x', int),('roach', int)])
-    cdef p = np.zeros(npackets,dtype=dt)
-    for name, x in zip(dt.names, [baseline[:npackets],wavelength[:npackets],
-                                  time[:npackets],y[:npackets],x[:npackets],roachnum[:npackets]]):
-        p[name] = x
-    p = p.view(np.recarray)
-
-    # Remove Fake Photons
-    #   fake photons translate to x=511 when you read the bitvalues as numbers
-    #   we just throw them away since they aren't useful to anybody
-    ret = p[p.x != 511]
-
-    return ret
+    # Shrinking reallocs in place rather than copying
+    p.resize(nphotons, refcheck=False)
+    return p
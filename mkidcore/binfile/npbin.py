@@ -0,0 +1,550 @@
+"""
+Pure NumPy reader for Gen2 readout .bin files, for installs where the mkidbin extension didn't compile.
+
+Files are viewed as big-endian uint64 words, headers are found with a boolean mask on the top byte and the photon
+bitfields are decoded with vectorised shifts and masks. parse, extract, extract_window and iter_extract return
+exactly what their mkidbin counterparts do, and share the same .idx header index sidecars.
+"""
+import functools
+import os
+import threading
+
+import numpy as np
+
+from mkidcore.corelog import getLogger
+from mkidcore.objects import Beammap
+from mkidcore.headers import (PhotonNumpyType, ParsedPhotonType, ParsedPhotonCompactType, HEADER_START,
+                              FAKE_PHOTON_X, TICKS_PER_SECOND, US_PER_TICK, RAD2DEG, HEADER_WRAP_SECONDS,
+                              year_start)
+
+NOPIXEL = np.uint32(0xffffffff)
+HEADER_TIMESTAMP_MASK = (1 << 36) - 1
+MAX_WINDOW_TICKS = 1800 * TICKS_PER_SECOND  # extract_photons limits windows to 30 minutes
+NBASELINE = 1 << 17  # bins of a histogram of the raw 17 bit baselines
+
+# Header of the .idx sidecar of a bin file, followed by the header timestamps (<u8) and word offsets (<u4). See
+# struct binindex in binprocessor.c.
+INDEX_MAGIC = b'MKIDIDX1'
+_IndexHeaderType = np.dtype([('magic', 'S8'), ('size', '<u8'), ('mtime_s', '<i8'), ('mtime_ns', '<i8'),
+                             ('nheaders', '<u8')])
+
+# PhotonNumpyType with the raw baseline in place of the weight until the baseline median is known
+_RawPhotonType = np.dtype([('resID', np.uint32), ('time', np.uint32), ('wavelength', np.float32),
+                           ('baseline', np.int32)])
+
+
+def _read_words(file, start=0, stop=None):
+    """
+    Return words [start, stop) of a bin file in native byte order, nothing if it is missing or shorter than a
+    word
+    """
+    try:
+        nwords = os.stat(file).st_size // 8
+    except OSError:
+        nwords = 0
+    stop = nwords if stop is None else min(stop, nwords)
+    if stop <= start:
+        return np.empty(0, dtype=np.uint64)
+    return np.asarray(np.memmap(file, dtype='>u8', mode='r', offset=start * 8, shape=stop - start).astype(np.uint64))
+
+
+def _read_index(iname, st):
+    """Return the timestamps and offsets of index sidecar iname if it matches a bin file with stat st, else None"""
+    try:
+        with open(iname, 'rb') as f:
+            head = np.frombuffer(f.read(_IndexHeaderType.itemsize), dtype=_IndexHeaderType)
+            if head.size != 1:
+                return None
+            head = head[0]
+            n = int(head['nheaders'])
+            if (head['magic'] != INDEX_MAGIC or int(head['size']) != st.st_size or n > st.st_size // 8 or
+                    int(head['mtime_s']) * 10**9 + int(head['mtime_ns']) != st.st_mtime_ns):
+                return None
+            timestamp = np.fromfile(f, dtype='<u8', count=n)
+            offset = np.fromfile(f, dtype='<u4', count=n)
+    except OSError:
+        return None
+    if timestamp.size != n or offset.size != n or (n and offset[-1] >= st.st_size // 8):
+        return None
+    return timestamp.astype(np.uint64), offset.astype(np.uint32)
+
+
+def _write_index(iname, st, timestamp, offset):
+    """Save an index sidecar via a temporary file, failures (e.g. a read only directory) are ignored"""
+    tmp = '{}.{}.{}.tmp'.format(iname, os.getpid(), threading.get_ident())
+    head = np.array([(INDEX_MAGIC, st.st_size, st.st_mtime_ns // 10**9, st.st_mtime_ns % 10**9, timestamp.size)],
+                    dtype=_IndexHeaderType)
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(head.tobytes())
+            f.write(timestamp.astype('<u8').tobytes())
+            f.write(offset.astype('<u4').tobytes())
+        os.replace(tmp, iname)
+    except OSError:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+
+def header_index(file, cache=True):
+    """
+    Return the raw timestamp (half-ms since the start of the year) and word offset of every header packet of a
+    bin file.
+
+    The index is the one extract_photons uses. It is read from the file's .idx sidecar if that is up to date,
+    otherwise it is built and, if cache is set, saved there for next time.
+    """
+    st = os.stat(file)
+    index = _read_index(file + '.idx', st) if cache else None
+    if index is not None:
+        return index
+
+    nwords = st.st_size // 8
+    if nwords:
+        # the top byte of a big-endian word is its first
+        offset = np.flatnonzero(np.memmap(file, dtype=np.uint8, mode='r', shape=nwords * 8)[::8] == HEADER_START)
+    else:
+        offset = np.empty(0, dtype=np.int64)
+    timestamp = np.zeros(offset.size, dtype=np.uint64)
+    if offset.size:
+        words = np.memmap(file, dtype='>u8', mode='r', shape=nwords)
+        timestamp = words[offset].astype(np.uint64) & np.uint64(HEADER_TIMESTAMP_MASK)
+    offset = offset.astype(np.uint32)
+    if cache:
+        _write_index(file + '.idx', st, timestamp, offset)
+    return timestamp, offset
+
+
+def _is_header(words):
+    return (words >> np.uint64(56)) == HEADER_START
+
+
+def _photon_fields(words):
+    """Decode photon words into x, y, timestamp (us after the header), raw wavelength and raw baseline"""
+    signed = words.view(np.int64)
+    x = (words >> np.uint64(54)).astype(np.uint32)
+    y = ((words >> np.uint64(44)) & np.uint64(0x3ff)).astype(np.uint32)
+    timestamp = ((words >> np.uint64(35)) & np.uint64(0x1ff)).astype(np.uint32)
+    wavelength = ((signed << 29) >> 46).astype(np.int32)  # sign extend the 18 bits above the baseline
+    baseline = ((signed << 47) >> 47).astype(np.int32)  # sign extend the low 17 bits
+    return x, y, timestamp, wavelength, baseline
+
+
+def _wavelength_degrees(raw):
+    return (raw.astype(np.float64) * RAD2DEG / 32768.0).astype(np.float32)
+
+
+def _baseline_degrees(raw):
+    return (np.asarray(raw, dtype=np.float64) * RAD2DEG / 16384.0).astype(np.float32)
+
+
+def _fix_overflow_timestamps(timestamp, file_time, tsoffs):
+    """Vectorised FixOverflowTimestamps, timestamp is the header time in half-ms since the start of the year"""
+    diff = file_time - tsoffs - timestamp // TICKS_PER_SECOND + 3
+    nwraps = np.sign(diff) * (np.abs(diff) // HEADER_WRAP_SECONDS)  # C division truncates
+    return (timestamp + TICKS_PER_SECOND * HEADER_WRAP_SECONDS * nwraps) & HEADER_TIMESTAMP_MASK
+
+
+@functools.lru_cache(maxsize=8)
+def _load_beammap(file, x, y, mtime_ns, size):
+    """Load the beammap file, cached by its modification time and size so edited files are reloaded"""
+    return Beammap(file, xydim=(x, y))
+
+
+def _beammap_array(beammap, x, y):
+    """Return the validated nPix x 4 (resID, flag, x, y) array extract_photons expects, see Beammap.extraction_array"""
+    if isinstance(beammap, str):
+        st = os.stat(beammap)
+        beammap = _load_beammap(beammap, x, y, st.st_mtime_ns, st.st_size)
+    return beammap.extraction_array(x, y)
+
+
+def _pixel_tables(bmarr, x, y):
+    """
+    Return the resID of each pixel (NOPIXEL unless it is beammapped, unflagged and not (0,0)), the rank of
+    each extracted pixel in the output, by resID then pixel, and the extracted pixels in that order.
+    """
+    resid, flag, xc, yc = bmarr.T
+    inrange = (xc >= 0) & (xc < x) & (yc >= 0) & (yc < y)
+    pix = (xc * y + yc)[inrange]
+
+    # later beammap entries for a pixel override earlier ones
+    lastpix, lastidx = np.unique(pix[::-1], return_index=True)
+    lastidx = pix.size - 1 - lastidx
+    pixel_resid = np.full(x * y, NOPIXEL, dtype=np.uint32)
+    good = flag[inrange][lastidx] == 0
+    pixel_resid[lastpix[good]] = resid[inrange][lastidx[good]].astype(np.uint32)
+    pixel_resid[0] = NOPIXEL
+
+    extracted = np.unique(pix)
+    extracted = extracted[pixel_resid[extracted] != NOPIXEL]
+    extracted = extracted[np.argsort(pixel_resid[extracted], kind='stable')]
+    rank = np.zeros(x * y, dtype=np.uint16 if extracted.size <= 1 << 16 else np.uint32)
+    rank[extracted] = np.arange(extracted.size)
+    return pixel_resid, rank, extracted
+
+
+def _resid_csr(resids, pix_offsets):
+    """
+    Return the CSR index (resids, offsets) of photons laid out pixel by pixel, resids of the pixels in output order
+    and pix_offsets the index of the first photon of each and the total. Pixels sharing a resID are merged.
+    """
+    first = np.ones(resids.size, dtype=bool)
+    first[1:] = resids[1:] != resids[:-1]
+    return resids[first], np.append(pix_offsets[:-1][first], pix_offsets[-1]).astype(np.uint64)
+
+
+def _trim_window(result, t0, t1, resid_offsets):
+    """
+    Keep the photons of an extraction (and its CSR index with resid_offsets) with times in [t0, t1) seconds. The
+    extraction selects whole header ticks, so it can start and end up to a tick either side of the window.
+    """
+    photons = result[0] if resid_offsets else result
+    keep = (photons['time'] >= t0 * 1e6) & (photons['time'] < t1 * 1e6)
+    if keep.all():
+        return result
+    if not resid_offsets:
+        return photons[keep]
+    kept = np.zeros(keep.size + 1, dtype=np.uint64)
+    np.cumsum(keep, out=kept[1:])
+    return photons[keep], result[1], kept[result[2]]
+
+
+def _window_files(directory, start, tick_start, tick_stop):
+    """The times and paths of the bin files that may hold packets with header times in [tick_start, tick_stop)"""
+    first = start + tick_start // TICKS_PER_SECOND - 1
+    last = start + -(-tick_stop // TICKS_PER_SECOND)
+    return [(t, os.path.join(directory, '{}.bin'.format(t))) for t in range(first, last + 1)]
+
+
+def _max_photons(directory, start, tick_start, tick_stop):
+    """An upper bound on the number of photons with header times in [tick_start, tick_stop), in half-ms from start"""
+    files = _window_files(directory, start, tick_start, tick_stop)
+    return int(np.ceil(sum([os.stat(f).st_size for _, f in files if os.path.exists(f)]) / 8))
+
+
+def _check_out(out):
+    """Raise a ValueError unless out is an array extract can write photons into"""
+    if (not isinstance(out, np.ndarray) or out.dtype != PhotonNumpyType or out.ndim != 1 or
+            not out.flags.c_contiguous or not out.flags.writeable):
+        raise ValueError('out must be a writeable, contiguous, one dimensional PhotonNumpyType array')
+
+
+def _histogram_median(blhist):
+    """The median in degrees of the photons in a NBASELINE bin histogram of their raw baselines, as BaselineMedian"""
+    nphotons = int(blhist.sum())
+    if not nphotons:
+        return np.float32(0)
+    lo, hi = np.searchsorted(np.cumsum(blhist), [(nphotons - 1) // 2 + 1, nphotons // 2 + 1]) - NBASELINE // 2
+    return (_baseline_degrees(lo) + _baseline_degrees(hi)) / np.float32(2)
+
+
+def _parse_window(file, file_time, tsoffs, tstart, tick_start, tick_stop, pixel_resid, rank, x, y, photons, keys,
+                  use_index):
+    """
+    Write the photons of one file in the window to the start of photons (_RawPhotonType) and their output rank to
+    keys, returning how many there were. Photons before the first and after the last header are skipped, as
+    extract_photons does. Only the packets spanning the window are read.
+    """
+    try:
+        timestamp, offset = header_index(file, cache=use_index)
+    except OSError:
+        return 0
+    if timestamp.size < 2:
+        return 0
+
+    basetime = _fix_overflow_timestamps(timestamp[:-1].astype(np.int64), file_time, tsoffs) - tstart
+    kept = np.flatnonzero((basetime >= tick_start) & (basetime < tick_stop))
+    if not kept.size:
+        return 0
+    first, last = kept[0], kept[-1] + 1
+    words = _read_words(file, int(offset[first]), int(offset[last]))
+    if words.size != offset[last] - offset[first]:
+        return 0
+
+    # the header time of each word, dropping the headers and the packets outside the window
+    length = np.diff(offset[first:last + 1].astype(np.int64))
+    basetime = basetime[first:last]
+    keep = (basetime >= tick_start) & (basetime < tick_stop)
+    photon = np.repeat(keep, length)
+    photon[offset[first:last] - offset[first]] = False
+    words, basetime = words[photon], np.repeat(basetime, length)[photon]
+
+    xc, yc, timestamp, wavelength, baseline = _photon_fields(words)
+    pix = xc * np.uint32(y) + yc
+    pix[(xc >= x) | (yc >= y)] = 0  # pixel (0,0) is never extracted
+    resid = pixel_resid[pix]
+    use = resid != NOPIXEL
+
+    n = np.count_nonzero(use)
+    photons = photons[:n]
+    photons['resID'] = resid[use]
+    photons['time'] = (basetime[use] * US_PER_TICK + timestamp[use]).astype(np.uint32)
+    photons['wavelength'] = _wavelength_degrees(wavelength[use])
+    photons['baseline'] = baseline[use]
+    keys[:n] = rank[pix[use]]
+    return n
+
+
+class Extractor(object):
+    """
+    A beammap prepared for photon extraction, see mkidbin.Extractor.
+
+    The pixel tables are built once and only read afterwards, so an Extractor can be shared across threads.
+    nthreads is accepted for compatibility and ignored.
+    """
+    def __init__(self, beammap, x=None, y=None, verbose=0):
+        if x is None or y is None:
+            x, y = beammap.ncols, beammap.nrows
+        self.x, self.y = x, y
+        self._pixel_resid, self._rank, self._pixels = _pixel_tables(_beammap_array(beammap, x, y), x, y)
+        self.resids = self._pixel_resid[self._pixels]
+
+    def _baseline_median(self, directory, start, tick_start, tick_stop, verbose=0, nthreads=1, use_index=True):
+        """
+        The median baseline, in degrees, of the photons with header times in [tick_start, tick_stop), in half-ms
+        from start. The files are parsed one at a time and only the baselines kept, so the window can be any length.
+        """
+        tsoffs = year_start(start)
+        tstart = (start - tsoffs) * TICKS_PER_SECOND
+        blhist = np.zeros(NBASELINE, dtype=np.uint64)
+        for t, f in _window_files(directory, start, tick_start, tick_stop):
+            if not os.path.exists(f):
+                continue
+            raw = np.empty(os.stat(f).st_size // 8, dtype=_RawPhotonType)
+            keys = np.empty(raw.size, dtype=self._rank.dtype)
+            n = _parse_window(f, t, tsoffs, tstart, tick_start, tick_stop, self._pixel_resid, self._rank, self.x,
+                              self.y, raw, keys, use_index)
+            blhist += np.bincount(raw['baseline'][:n] + NBASELINE // 2, minlength=NBASELINE).astype(np.uint64)
+        return _histogram_median(blhist)
+
+    def _extract_window(self, directory, start, tick_start, tick_stop, include_baseline=False, verbose=0, nthreads=1,
+                        use_index=True, resid_offsets=False, baseline_median=None, out=None):
+        """
+        Extract the photons with header times in [tick_start, tick_stop), in half-ms from start. Photon times are in
+        us from start. The median baseline of the window is subtracted unless include_baseline, or baseline_median
+        if given. With out the photons are copied to the start of it and a view returned.
+        """
+        if out is not None:
+            _check_out(out)
+        photons, pix_offsets = self._extract_pixels(directory, start, tick_start, tick_stop, include_baseline,
+                                                    use_index, baseline_median)
+        if out is not None:
+            if photons.size > out.size:
+                raise RuntimeError('Photon extraction from {} failed ({})'.format(directory, -1))
+            out[:photons.size] = photons
+            photons = out[:photons.size]
+        if resid_offsets:
+            return (photons,) + _resid_csr(self.resids, pix_offsets)
+        return photons
+
+    def _extract_pixels(self, directory, start, tick_start, tick_stop, include_baseline, use_index,
+                        baseline_median=None):
+        """
+        _extract_window, also returning the index of the first photon of each of the extracted pixels, and the total
+        """
+        if not os.path.isdir(directory) or tick_stop <= tick_start or tick_stop - tick_start > MAX_WINDOW_TICKS:
+            raise RuntimeError('Photon extraction from {} failed ({})'.format(directory, -1))
+
+        tsoffs = year_start(start)
+        tstart = (start - tsoffs) * TICKS_PER_SECOND
+        pixel_resid, rank = self._pixel_resid, self._rank
+
+        files = _window_files(directory, start, tick_start, tick_stop)
+        n_max_photons = _max_photons(directory, start, tick_start, tick_stop)
+        raw = np.empty(n_max_photons, dtype=_RawPhotonType)
+        keys = np.empty(n_max_photons, dtype=rank.dtype)
+        nphotons = 0
+        for t, f in files:
+            nphotons += _parse_window(f, t, tsoffs, tstart, tick_start, tick_stop, pixel_resid, rank, self.x, self.y,
+                                      raw[nphotons:], keys[nphotons:], use_index)
+
+        # group by pixel in resID order, then sort each resID by time keeping pixel, file and word order for equal
+        # times. Pixels are almost always already in time order and rarely share a resID, so the second sort is
+        # rarely needed.
+        keys = keys[:nphotons]
+        order = np.argsort(keys, kind='stable')
+        raw = raw[order]
+        group = np.cumsum(np.r_[True, self.resids[1:] != self.resids[:-1]]) - 1
+        pixtime = (group[keys[order]].astype(np.uint64) << np.uint64(32)) | raw['time']
+        del order, group
+        if np.any(pixtime[1:] < pixtime[:-1]):
+            raw = raw[np.argsort(pixtime, kind='stable')]
+        del pixtime
+        pix_offsets = np.zeros(self.resids.size + 1, dtype=np.uint64)
+        np.cumsum(np.bincount(keys, minlength=self.resids.size), out=pix_offsets[1:])
+        del keys
+        photons = raw.view(PhotonNumpyType)
+        if not include_baseline and nphotons:
+            if baseline_median is not None:
+                median = np.float32(baseline_median)
+            else:
+                # the median of the raw baselines is the median in degrees, the conversion is monotonic
+                lo, hi = (nphotons - 1) // 2, nphotons // 2
+                part = np.partition(raw['baseline'], (lo, hi))
+                median = (_baseline_degrees(part[lo]) + _baseline_degrees(part[hi])) / np.float32(2)
+                del part
+            photons['wavelength'] += _baseline_degrees(raw['baseline']) - median
+        photons['weight'] = 1.0
+        getLogger(__name__).debug('NumPy parser returned {} photons'.format(nphotons))
+        return photons, pix_offsets
+
+    def extract(self, directory, start, inttime, include_baseline=False, verbose=0, nthreads=1, use_index=True,
+                resid_offsets=False, out=None):
+        """Extract the photons from start to start+inttime, see mkidbin.Extractor.extract"""
+        if np.ceil(inttime*1e6) > 2**32:
+            raise ValueError('Integration times longer than 4294 s are not supported due to uint32 rollover')
+        return self._extract_window(directory, start, 0, (inttime + 1) * TICKS_PER_SECOND, include_baseline,
+                                    verbose, nthreads, use_index, resid_offsets, out=out)
+
+    def extract_window(self, directory, start, t0, t1, include_baseline=False, verbose=0, nthreads=1,
+                       use_index=True, resid_offsets=False):
+        """Extract the photons from t0 to t1 seconds after start, see mkidbin.extract_window"""
+        if not 0 <= t0 < t1:
+            raise ValueError('The window must have 0 <= t0 < t1')
+        if np.ceil(t1*1e6) > 2**32:
+            raise ValueError('Windows ending more than 4294 s after start are not supported due to uint32 rollover')
+        # a photon's time is up to 511 us after its header, so the packets of the tick before t0 can reach into it
+        result = self._extract_window(directory, start, max(int(np.floor(t0 * TICKS_PER_SECOND)) - 1, 0),
+                                      int(np.ceil(t1 * TICKS_PER_SECOND)), include_baseline, verbose, nthreads,
+                                      use_index, resid_offsets)
+        return _trim_window(result, t0, t1, resid_offsets)
+
+    def iter_extract(self, directory, start, inttime, chunk_seconds=10, include_baseline=False, verbose=0,
+                     nthreads=1, use_index=True, resid_offsets=False):
+        """Generator yielding the photons extract would return in chunks of chunk_seconds, see mkidbin.iter_extract"""
+        if np.ceil(inttime*1e6) > 2**32:
+            raise ValueError('Integration times longer than 4294 s are not supported due to uint32 rollover')
+        if chunk_seconds <= 0:
+            raise ValueError('chunk_seconds must be positive')
+
+        chunk = max(int(round(chunk_seconds * TICKS_PER_SECOND)), 1)
+        tick_stop = (inttime + 1) * TICKS_PER_SECOND
+        blmedian = None
+        if not include_baseline:
+            blmedian = self._baseline_median(directory, start, 0, tick_stop, verbose, nthreads, use_index)
+        for tick in range(0, tick_stop, chunk):
+            yield self._extract_window(directory, start, tick, min(tick + chunk, tick_stop), include_baseline,
+                                       verbose, nthreads, use_index, resid_offsets, blmedian)
+
+    def histogram(self, directory, start, inttime, wavelength_bins=None, time_bin=None, include_baseline=False,
+                  verbose=0, nthreads=1, use_index=True):
+        """Histogram the photons extract would return, see mkidbin.histogram. The photons are extracted first."""
+        if np.ceil(inttime*1e6) > 2**32:
+            raise ValueError('Integration times longer than 4294 s are not supported due to uint32 rollover')
+        tick_stop = (inttime + 1) * TICKS_PER_SECOND
+        shape = [self.x, self.y]
+        if wavelength_bins is not None:
+            edges = np.asarray(wavelength_bins, dtype=np.float64)
+            if edges.ndim != 1 or edges.size < 2 or np.any(np.diff(edges) <= 0):
+                raise ValueError('wavelength_bins must be at least two increasing bin edges')
+            shape.append(edges.size - 1)
+        if time_bin is not None:
+            tbin_us = int(round(time_bin * 1e6))
+            if tbin_us <= 0:
+                raise ValueError('time_bin must be at least 1 us')
+            shape.append(-(-tick_stop * US_PER_TICK // tbin_us))
+
+        photons, pix_offsets = self._extract_pixels(directory, start, 0, tick_stop,
+                                                    include_baseline or wavelength_bins is None, use_index)
+        index = np.repeat(self._pixels.astype(np.int64), np.diff(pix_offsets).astype(np.int64))
+        keep = np.ones(index.size, dtype=bool)
+        if wavelength_bins is not None:
+            wavelength = photons['wavelength'].astype(np.float64)
+            b = np.searchsorted(edges, wavelength, 'right') - 1
+            b[wavelength == edges[-1]] = edges.size - 2
+            keep &= (b >= 0) & (b < edges.size - 1)
+            index = index * (edges.size - 1) + b
+        if time_bin is not None:
+            b = photons['time'].astype(np.int64) // tbin_us
+            keep &= b < shape[-1]
+            index = index * shape[-1] + b
+        counts = np.bincount(index[keep], minlength=int(np.prod(shape)))
+        return counts.astype(np.uint32).reshape(shape)
+
+
+def extract(directory, start, inttime, beammap, x, y, include_baseline=False, verbose=0, nthreads=1,
+            use_index=True, resid_offsets=False):
+    """
+    Extract the photons in the bin files of directory from start to start+inttime, see mkidbin.extract.
+
+    nthreads is accepted for compatibility and ignored.
+    """
+    return Extractor(beammap, x, y).extract(directory, start, inttime, include_baseline, verbose, nthreads, use_index,
+                                            resid_offsets)
+
+
+def extract_window(directory, start, t0, t1, beammap, x=None, y=None, include_baseline=False, verbose=0, nthreads=1,
+                   use_index=True, resid_offsets=False):
+    """Extract the photons from t0 to t1 seconds after start, see mkidbin.extract_window"""
+    return Extractor(beammap, x, y).extract_window(directory, start, t0, t1, include_baseline, verbose, nthreads,
+                                                   use_index, resid_offsets)
+
+
+def iter_extract(directory, start, inttime, beammap, chunk_seconds=10, x=None, y=None, include_baseline=False,
+                 verbose=0, nthreads=1, use_index=True, resid_offsets=False):
+    """Generator yielding the photons extract would return in chunks of chunk_seconds, see mkidbin.iter_extract"""
+    return Extractor(beammap, x, y).iter_extract(directory, start, inttime, chunk_seconds, include_baseline, verbose,
+                                                 nthreads, use_index, resid_offsets)
+
+
+def histogram(directory, start, inttime, beammap, x=None, y=None, wavelength_bins=None, time_bin=None,
+              include_baseline=False, verbose=0, nthreads=1, use_index=True):
+    """Histogram the photons extract would return into an image or cube, see mkidbin.histogram"""
+    return Extractor(beammap, x, y).histogram(directory, start, inttime, wavelength_bins, time_bin, include_baseline,
+                                              verbose, nthreads, use_index)
+
+
+def extract_fake(nphotons, start=1547683242, intt=150, nres=20000):
+    photons = np.zeros(nphotons, dtype=PhotonNumpyType)
+    photons['resID'] = np.random.randint(0, nres, nphotons, np.uint32)
+    photons['time'] = np.random.randint(start,start+intt, nphotons, np.uint32)
+    photons['wavelength'] = np.random.random(nphotons)
+    photons['weight'] = 1.0
+    return photons
+
+
+def _parse_words(words, header=None, compact=False):
+    """
+    Decode a stream of words into a ParsedPhotonType (or ParsedPhotonCompactType) array of its real photons.
+
+    Photons before the first header in words belong to the packet of header, the last header word before them,
+    and are dropped if it is None. Returns the photons and the last header word, to carry on with the next words.
+    """
+    ishdr = _is_header(words)
+    hdr = words[ishdr]
+    packet = np.cumsum(ishdr) - 1
+    if header is not None:
+        hdr = np.concatenate(([np.uint64(header)], hdr))
+        packet += 1
+    photon = ~ishdr & (packet >= 0)
+    xc, yc, timestamp, wavelength, baseline = _photon_fields(words[photon])
+
+    real = xc != FAKE_PHOTON_X
+    packet = packet[photon][real]
+    p = np.empty(packet.size, dtype=ParsedPhotonCompactType if compact else ParsedPhotonType)
+    p['baseline'] = _baseline_degrees(baseline[real])
+    p['phase'] = _wavelength_degrees(wavelength[real])
+    p['tstamp'] = (hdr[packet] & np.uint64(HEADER_TIMESTAMP_MASK)) * np.uint64(US_PER_TICK) + timestamp[real]
+    p['y'] = yc[real]
+    p['x'] = xc[real]
+    p['roach'] = (hdr[packet] >> np.uint64(48)) & np.uint64(0xff)
+    return p, (hdr[-1] if hdr.size else None)
+
+
+def parse(file, compact=False, columns=False):
+    """
+    Parse a .bin file into a recarray of its real photons, see mkidbin.parse.
+
+    Every photon after the first header is returned, with its full timestamp in us since the start of the year
+    and the roach of its packet. Fake photons (x=511) are dropped. The recarray is ParsedPhotonCompactType if
+    compact is set and ParsedPhotonType otherwise, with columns a dict of its fields is returned instead.
+    """
+    if not os.path.exists(file):
+        raise RuntimeError('Data not found')
+    p, _ = _parse_words(_read_words(file), compact=compact)
+    getLogger(__name__).debug("number of parsed photons = {}".format(p.size))
+    if columns:
+        return {name: p[name] for name in p.dtype.names}
+    return p.view(np.recarray)
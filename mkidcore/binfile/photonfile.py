@@ -0,0 +1,195 @@
+"""
+A compact on-disk format for extracted (PhotonNumpyType) photons, sorted by resID then time as extract returns
+them.
+
+The resIDs are stored once, as a run-length table of each resID and the index of its first photon, and the rest
+in blocks of block_size photons. In a block the times are stored as differences from the previous photon of the
+same resID, the wavelengths as float32 or, if a wavelength_step is given, rounded to integer multiples of it
+and the weights as a single value if they are all the same. Each column of a block is byte shuffled and zlib
+compressed on its own, so blocks (and so a single resID's photons) decompress independently. Files are memory
+mapped for reading and only the blocks asked for are read.
+
+    write_photons('photons.phz', extract(...))
+    photons = read_photons('photons.phz')
+    f = PhotonFile('photons.phz'); f.resid(10234)
+"""
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from mkidcore.headers import PhotonNumpyType
+
+MAGIC = b'MKIDPHZ1'
+
+_HeaderType = np.dtype([('magic', 'S8'), ('nphotons', '<u8'), ('nresids', '<u8'), ('nblocks', '<u8'),
+                        ('block_size', '<u8'), ('wavelength_step', '<f8')])
+# the byte offset and length of each of a block's time, wavelength and weight columns. A weight column of 4 bytes
+# is the weight of every photon in the block.
+_BlockType = np.dtype([('offset', '<u8', 3), ('nbytes', '<u8', 3)])
+
+
+def _shuffle(a):
+    """Byte shuffle a, so the bytes of equal significance are together and compress well"""
+    return np.ascontiguousarray(a.view(np.uint8).reshape(a.size, a.itemsize).T).tobytes()
+
+
+def _unshuffle(data, dtype, n):
+    dtype = np.dtype(dtype)
+    return np.ascontiguousarray(np.frombuffer(data, np.uint8).reshape(dtype.itemsize, n).T).view(dtype).ravel()
+
+
+def _segment_deltas(values, starts):
+    """Differences of values from the previous one, values at the starts of segments (a bool mask) are kept"""
+    deltas = values.copy()
+    deltas[1:] -= values[:-1]
+    deltas[starts] = values[starts]
+    return deltas
+
+
+def _segment_cumsum(deltas, starts):
+    """Undo _segment_deltas"""
+    total = np.cumsum(deltas, dtype=np.uint64)
+    base = np.where(starts, total - deltas, 0)
+    return (total - np.maximum.accumulate(base)).astype(np.uint32)
+
+
+def write_photons(file, photons, block_size=1 << 20, wavelength_step=None, level=1):
+    """
+    Write PhotonNumpyType photons, sorted by resID then time, to file in the compressed format.
+
+    With wavelength_step the wavelengths are stored rounded to the nearest multiple of it (in the photons'
+    units), which compresses far better, otherwise exactly. level is the zlib compression level.
+    """
+    photons = np.asarray(photons)
+    if photons.dtype != PhotonNumpyType:
+        raise TypeError('photons must be PhotonNumpyType, not {}'.format(photons.dtype))
+    resid, time = photons['resID'], photons['time']
+    if np.any((resid[1:] < resid[:-1]) | ((resid[1:] == resid[:-1]) & (time[1:] < time[:-1]))):
+        raise ValueError('photons must be sorted by resID then time, as extract returns them')
+    if wavelength_step is not None and wavelength_step <= 0:
+        raise ValueError('wavelength_step must be positive')
+
+    newresid = np.ones(photons.size, dtype=bool)
+    newresid[1:] = resid[1:] != resid[:-1]
+    resids = resid[newresid]
+    offsets = np.append(np.flatnonzero(newresid), photons.size).astype('<u8')
+
+    nblocks = -(-photons.size // block_size)
+    header = np.zeros(1, dtype=_HeaderType)
+    header['magic'] = MAGIC
+    header['nphotons'] = photons.size
+    header['nresids'] = resids.size
+    header['nblocks'] = nblocks
+    header['block_size'] = block_size
+    header['wavelength_step'] = wavelength_step or 0
+    blocks = np.zeros(nblocks, dtype=_BlockType)
+
+    with open(file, 'wb') as f:
+        f.write(header.tobytes())
+        f.write(resids.astype('<u4').tobytes())
+        f.write(offsets.tobytes())
+        f.write(blocks.tobytes())  # filled in below
+        pos = f.tell()
+        for b in range(nblocks):
+            block = photons[b * block_size:(b + 1) * block_size]
+            starts = newresid[b * block_size:(b + 1) * block_size].copy()
+            starts[0] = True
+            columns = [_segment_deltas(block['time'].astype('<u4'), starts)]
+            if wavelength_step:
+                columns.append(np.round(block['wavelength'] / wavelength_step).astype('<i4'))
+            else:
+                columns.append(block['wavelength'].astype('<f4'))
+            weight = block['weight'].astype('<f4')
+            columns.append(weight[:1] if np.all(weight == weight[0]) else weight)
+            for i, column in enumerate(columns):
+                data = zlib.compress(_shuffle(column), level)
+                blocks[b]['offset'][i], blocks[b]['nbytes'][i] = pos, len(data)
+                f.write(data)
+                pos += len(data)
+        f.seek(_HeaderType.itemsize + resids.size * 4 + offsets.size * 8)
+        f.write(blocks.tobytes())
+
+
+class PhotonFile(object):
+    """
+    A memory mapped compressed photon file, see write_photons.
+
+    resids and offsets are the run-length resID table, the photons of resids[i] are [offsets[i], offsets[i+1]).
+    Photons are decompressed a block at a time, by read, read_block or resid.
+    """
+    def __init__(self, file):
+        self.file = file
+        self._map = np.memmap(file, dtype=np.uint8, mode='r')
+        header = self._map[:_HeaderType.itemsize].view(_HeaderType)[0]
+        if header['magic'] != MAGIC:
+            raise IOError('{} is not a compressed photon file'.format(file))
+        self.nphotons = int(header['nphotons'])
+        self.nblocks = int(header['nblocks'])
+        self.block_size = int(header['block_size'])
+        self.wavelength_step = float(header['wavelength_step']) or None
+        pos = _HeaderType.itemsize
+        nresids = int(header['nresids'])
+        self.resids = self._map[pos:pos + 4 * nresids].view('<u4')
+        pos += 4 * nresids
+        self.offsets = self._map[pos:pos + 8 * (nresids + 1)].view('<u8')
+        pos += 8 * (nresids + 1)
+        self._blocks = self._map[pos:pos + _BlockType.itemsize * self.nblocks].view(_BlockType)
+
+    def __len__(self):
+        return self.nphotons
+
+    def _column(self, block, i):
+        offset, nbytes = int(self._blocks[block]['offset'][i]), int(self._blocks[block]['nbytes'][i])
+        return zlib.decompress(self._map[offset:offset + nbytes])
+
+    def read_block(self, block):
+        """Return the photons of block"""
+        start = block * self.block_size
+        stop = min(start + self.block_size, self.nphotons)
+        n = stop - start
+        photons = np.empty(n, dtype=PhotonNumpyType)
+
+        # the resIDs are the runs of the resID table overlapping the block
+        first = np.searchsorted(self.offsets, start, 'right') - 1
+        last = np.searchsorted(self.offsets, stop, 'left')
+        bounds = np.clip(self.offsets[first:last + 1].astype(np.int64), start, stop) - start
+        photons['resID'] = np.repeat(self.resids[first:last], np.diff(bounds))
+
+        starts = np.zeros(n, dtype=bool)
+        starts[bounds[:-1][bounds[:-1] < n]] = True
+        starts[0] = True
+        photons['time'] = _segment_cumsum(_unshuffle(self._column(block, 0), '<u4', n), starts)
+        if self.wavelength_step:
+            photons['wavelength'] = _unshuffle(self._column(block, 1), '<i4', n) * self.wavelength_step
+        else:
+            photons['wavelength'] = _unshuffle(self._column(block, 1), '<f4', n)
+        weight = self._column(block, 2)
+        photons['weight'] = _unshuffle(weight, '<f4', len(weight) // 4)
+        return photons
+
+    def read(self, start=0, stop=None, nthreads=1):
+        """Return photons [start, stop), decompressing the blocks spanning them on nthreads threads"""
+        stop = self.nphotons if stop is None else min(stop, self.nphotons)
+        if stop <= start:
+            return np.empty(0, dtype=PhotonNumpyType)
+        first, last = start // self.block_size, (stop - 1) // self.block_size
+        if nthreads > 1 and last > first:
+            with ThreadPoolExecutor(nthreads) as pool:  # zlib releases the GIL
+                blocks = list(pool.map(self.read_block, range(first, last + 1)))
+        else:
+            blocks = [self.read_block(b) for b in range(first, last + 1)]
+        photons = np.concatenate(blocks) if len(blocks) > 1 else blocks[0]
+        return photons[start - first * self.block_size:stop - first * self.block_size]
+
+    def resid(self, resid):
+        """Return the photons of resid, only decompressing the blocks they are in"""
+        i = np.searchsorted(self.resids, resid)
+        if i == self.resids.size or self.resids[i] != resid:
+            return np.empty(0, dtype=PhotonNumpyType)
+        return self.read(int(self.offsets[i]), int(self.offsets[i + 1]))
+
+
+def read_photons(file, nthreads=1):
+    """Read all the photons of a compressed photon file"""
+    return PhotonFile(file).read(nthreads=nthreads)
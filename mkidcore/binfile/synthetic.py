@@ -0,0 +1,129 @@
+"""
+Tools for writing synthetic Gen2 readout .bin files.
+
+A bin file is a stream of big-endian 64 bit words. Each packet is a header word (top byte 0xff) carrying
+the roach number and a timestamp in half-milliseconds since the start of the UTC year, followed by up to 100
+photon words. Packets closed by the 0.5 ms clock rather than by filling up end with a fake photon (x=511).
+Header timestamps wrap every HEADER_WRAP_SECONDS, which the readers undo using the file names.
+"""
+import os
+
+import numpy as np
+
+from mkidcore.headers import (HEADER_START, FAKE_PHOTON_X, TICKS_PER_SECOND, US_PER_TICK, HEADER_WRAP_SECONDS,
+                              year_start)
+
+PHOTONS_PER_PACKET = 100
+
+
+def header_words(timestamp, roach, frame=0):
+    """Encode header packets, timestamp is in half-ms since the start of the year"""
+    timestamp = np.asarray(timestamp, dtype=np.uint64)
+    return ((np.uint64(HEADER_START) << np.uint64(56)) |
+            ((np.asarray(roach, dtype=np.uint64) & np.uint64(0xff)) << np.uint64(48)) |
+            ((np.asarray(frame, dtype=np.uint64) & np.uint64(0xfff)) << np.uint64(36)) |
+            (timestamp & np.uint64(0xfffffffff)))
+
+
+def photon_words(x, y, timestamp, wavelength, baseline):
+    """
+    Encode photon packets. timestamp is in us from the packet header, wavelength and baseline are the raw
+    signed 18 and 17 bit phase values.
+    """
+    u = np.uint64
+    return (((np.asarray(x, dtype=u) & u(0x3ff)) << u(54)) |
+            ((np.asarray(y, dtype=u) & u(0x3ff)) << u(44)) |
+            ((np.asarray(timestamp, dtype=u) & u(0x1ff)) << u(35)) |
+            ((np.asarray(wavelength, dtype=np.int64).astype(u) & u(0x3ffff)) << u(17)) |
+            (np.asarray(baseline, dtype=np.int64).astype(u) & u(0x1ffff)))
+
+
+def packetize(pixel_x, pixel_y, time, wavelength, baseline, roach, tick0, wrap=False):
+    """
+    Pack one second of photons into a stream of words.
+
+    time is in us from the start of the file, tick0 the header timestamp of the start of the file. Photons are
+    grouped into packets by 0.5 ms frame and roach, at most 100 photons to a packet, and the last packet of each
+    frame gets a fake photon. Each roach numbers its packets in the header frame counter. With wrap the header
+    timestamps wrap every HEADER_WRAP_SECONDS, as the readout's do.
+    """
+    time = np.asarray(time, dtype=np.int64)
+    tick = time // US_PER_TICK
+    order = np.lexsort((time, roach, tick))
+    pixel_x, pixel_y, time = np.asarray(pixel_x)[order], np.asarray(pixel_y)[order], time[order]
+    wavelength, baseline = np.asarray(wavelength)[order], np.asarray(baseline)[order]
+    roach, tick = np.asarray(roach)[order], tick[order]
+    n = time.size
+
+    # Group by (tick, roach) and split groups into packets of at most 100 photons
+    newgroup = np.ones(n, dtype=bool)
+    newgroup[1:] = (tick[1:] != tick[:-1]) | (roach[1:] != roach[:-1])
+    group = np.cumsum(newgroup) - 1
+    groupstart = np.flatnonzero(newgroup)
+    rank = np.arange(n) - groupstart[group]
+    newpacket = newgroup | (rank % PHOTONS_PER_PACKET == 0)
+    packet = np.cumsum(newpacket) - 1
+    lastofgroup = np.ones(n, dtype=bool)
+    lastofgroup[:-1] = newgroup[1:]
+
+    # Every photon is preceded by one header per packet so far and one fake photon per finished group
+    photonpos = np.arange(n) + packet + 1 + group
+    out = np.zeros(n + packet[-1] + 1 + group[-1] + 1 if n else 0, dtype=np.uint64)
+    out[photonpos] = photon_words(pixel_x, pixel_y, time - tick * US_PER_TICK, wavelength, baseline)
+    # the frame counter of each packet counts the packets of its roach
+    proach = roach[newpacket]
+    byroach = np.argsort(proach, kind='stable')
+    frame = np.empty(proach.size, dtype=np.int64)
+    first = np.searchsorted(proach[byroach], proach[byroach])
+    frame[byroach] = np.arange(proach.size) - first
+    htime = tick0 + tick[newpacket]
+    if wrap:
+        htime %= TICKS_PER_SECOND * HEADER_WRAP_SECONDS
+    out[photonpos[newpacket] - 1] = header_words(htime, proach, frame)
+    out[photonpos[lastofgroup] + 1] = photon_words(FAKE_PHOTON_X, 0, US_PER_TICK - 1, 0, 0)
+    return out
+
+
+def write_bin(filename, words):
+    """Write words to filename in the readout's big-endian byte order"""
+    np.asarray(words, dtype='>u8').tofile(filename)
+
+
+def pixel_rates(ncols, nrows, mean=100, dead=0.15, hot=0.002, seed=None):
+    """
+    Return a ncols x nrows array of count rates resembling a real array: log-normally distributed about mean
+    counts/s, with a fraction dead of pixels not reading out and a fraction hot at 50 times the mean.
+    """
+    rng = np.random.default_rng(seed)
+    rates = mean * rng.lognormal(-0.5, 1, (ncols, nrows))  # a lognormal(-s^2/2, s) has mean 1
+    rates[rng.random((ncols, nrows)) < dead] = 0
+    rates[rng.random((ncols, nrows)) < hot] = 50 * mean
+    return rates
+
+
+def generate(directory, start, nseconds, ncols, nrows, rate=100, seed=None, wrap=False):
+    """
+    Write nseconds of bin files, start.bin, start+1.bin, ..., for a ncols x nrows array into directory.
+
+    Each pixel has Poisson photon arrivals at rate counts/s with random phases and baselines. rate is a number
+    or a ncols x nrows array of per-pixel rates, e.g. from pixel_rates. Pixels are read out by roaches of 1000
+    pixels in x-major order. With wrap the header timestamps wrap as the readout's do. Returns the list of files
+    written.
+    """
+    rng = np.random.default_rng(seed)
+    npix = ncols * nrows
+    rate = np.broadcast_to(rate, (ncols, nrows)).ravel()
+    tsoffs = year_start(start)
+    files = []
+    for second in range(start, start + nseconds):
+        counts = rng.poisson(rate)
+        pix = np.repeat(np.arange(npix), counts)
+        time = rng.integers(0, 1000000, pix.size)
+        wavelength = rng.integers(-2**17, 2**17, pix.size)
+        baseline = rng.integers(-2**16, 2**16, pix.size)
+        words = packetize(pix // nrows, pix % nrows, time, wavelength, baseline, pix // 1000,
+                          (second - tsoffs) * TICKS_PER_SECOND, wrap=wrap)
+        file = os.path.join(directory, '{}.bin'.format(second))
+        write_bin(file, words)
+        files.append(file)
+    return files
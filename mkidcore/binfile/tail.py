@@ -0,0 +1,158 @@
+"""
+Live reading of the bin files the readout is writing.
+
+The readout writes one file a second, <unix time>.bin, appending packets as they arrive. BinTailReader polls
+the newest file for complete packets and parses only what is new, carrying the current header over from one read
+(and file) to the next, so photons are available within a poll interval of being written.
+"""
+import os
+import re
+import time
+
+import numpy as np
+
+from mkidcore.corelog import getLogger
+from mkidcore.binfile.npbin import _is_header, _parse_words
+
+_BIN_FILE = re.compile(r'^(\d+)\.bin$')
+
+
+def _newest_bin(directory):
+    """Return the time of the newest bin file in directory, None if there are none"""
+    times = [int(m.group(1)) for m in map(_BIN_FILE.match, os.listdir(directory)) if m]
+    return max(times) if times else None
+
+
+class BinTailReader(object):
+    """
+    Follow the bin files of directory as they are written, returning the photons of each newly completed packet.
+
+    Reading starts at the last packet of the newest file, or at the start of file start (a unix time) if given.
+    read() returns the photons written since the last read, as parse would return them, and iterating yields
+    non-empty batches as they appear, polling every poll_interval seconds. Iteration stops once nothing has been
+    written for idle_timeout seconds, if it is set.
+
+    A packet is complete once the next header has been written, or the readout has moved on to the next file. The
+    last packet of a file is returned when the next file appears, files are assumed complete once a newer one
+    exists. The directory is polled rather than watched, the newest file is only searched for (listing the
+    directory) when the next second's file hasn't appeared and the current one has stopped growing for
+    rescan_after seconds.
+    """
+    def __init__(self, directory, start=None, poll_interval=0.01, idle_timeout=None, compact=True, rescan_after=2.0):
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self.idle_timeout = idle_timeout
+        self.compact = compact
+        self.rescan_after = rescan_after
+        self.file_time = None  # the file being followed
+        self._file = None
+        self._pos = 0  # bytes of the file consumed, always whole words
+        self._pending = np.empty(0, dtype=np.uint64)  # words of the last, possibly incomplete, packet
+        self._header = None
+        self._last_growth = time.monotonic()
+
+        if start is not None:
+            self._open(int(start))
+        else:
+            newest = _newest_bin(directory)
+            if newest is not None:
+                self._open(newest)
+                self._seek_last_packet()
+
+    def _path(self, file_time):
+        return os.path.join(self.directory, '{}.bin'.format(file_time))
+
+    def _open(self, file_time):
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self._path(file_time), 'rb')
+        self.file_time = file_time
+        self._pos = 0
+        self._last_growth = time.monotonic()
+
+    def _seek_last_packet(self):
+        """Skip to the last header of the current file, so reading starts with the packet being written"""
+        size = os.fstat(self._file.fileno()).st_size // 8 * 8
+        chunk = 1 << 16
+        end = size
+        while end > 0:
+            start = max(end - chunk, 0)
+            self._file.seek(start)
+            words = np.frombuffer(self._file.read(end - start), dtype='>u8')
+            header = np.flatnonzero(_is_header(words))
+            if header.size:
+                self._pos = start + 8 * int(header[-1])
+                return
+            end = start
+        self._pos = size
+
+    def _read_new(self):
+        """Return the complete words appended to the current file since the last read"""
+        size = os.fstat(self._file.fileno()).st_size // 8 * 8
+        if size <= self._pos:
+            return np.empty(0, dtype=np.uint64)
+        self._file.seek(self._pos)
+        data = self._file.read(size - self._pos)
+        data = data[:len(data) // 8 * 8]
+        self._pos += len(data)
+        self._last_growth = time.monotonic()
+        return np.frombuffer(data, dtype='>u8').astype(np.uint64)
+
+    def _next_file(self):
+        """Return the time of the file after the current one, if the readout has started it"""
+        if os.path.exists(self._path(self.file_time + 1)):
+            return self.file_time + 1
+        if time.monotonic() - self._last_growth < self.rescan_after:
+            return None
+        self._last_growth = time.monotonic()
+        newest = _newest_bin(self.directory)
+        return newest if newest is not None and newest > self.file_time else None
+
+    def read(self):
+        """Return the photons of the packets completed since the last read, possibly none"""
+        if self._file is None:
+            newest = _newest_bin(self.directory)
+            if newest is None:
+                return _parse_words(self._pending[:0], compact=self.compact)[0]
+            self._open(newest)
+
+        words = [self._pending, self._read_new()]
+        nextfile = self._next_file()
+        if nextfile is not None:
+            # the readout has moved on, so the current file is complete, including its last packet
+            words.append(self._read_new())
+            complete = np.concatenate(words)
+            self._pending = np.empty(0, dtype=np.uint64)
+            getLogger(__name__).debug('Following {} after {}'.format(self._path(nextfile), self._path(self.file_time)))
+            self._open(nextfile)
+        else:
+            words = np.concatenate(words)
+            header = np.flatnonzero(_is_header(words))
+            split = int(header[-1]) if header.size else 0
+            complete, self._pending = words[:split], words[split:]
+
+        photons, self._header = _parse_words(complete, self._header, compact=self.compact)
+        return photons
+
+    def __iter__(self):
+        idle = time.monotonic()
+        while True:
+            photons = self.read()
+            if photons.size:
+                idle = time.monotonic()
+                yield photons
+                continue
+            if self.idle_timeout is not None and time.monotonic() - idle > self.idle_timeout:
+                return
+            time.sleep(self.poll_interval)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,59 @@
+"""
+Photon data types and the constants of the Gen2 readout .bin file format, shared by the compiled and
+pure NumPy bin file readers.
+"""
+import calendar
+import ctypes
+from datetime import datetime, timezone
+
+import numpy as np
+
+# Bin files are big-endian 64 bit words. Headers have HEADER_START in the top byte and a timestamp in
+# half-milliseconds (ticks) since the start of the UTC year, photons have a time in us from their header.
+HEADER_START = 0xff
+FAKE_PHOTON_X = 511
+TICKS_PER_SECOND = 2000
+US_PER_TICK = 500
+# Header timestamps wrap every HEADER_WRAP_SECONDS, the readers unwrap them using the file name
+HEADER_WRAP_SECONDS = 1048576
+RAD2DEG = 57.2957795131
+
+
+def year_start(timestamp):
+    """Return the unix time of Jan 1 00:00 UTC of the year containing timestamp, the zero of the header timestamps"""
+    year = datetime.fromtimestamp(timestamp, tz=timezone.utc).year
+    return calendar.timegm((year, 1, 1, 0, 0, 0))
+
+
+# The layout binprocessor.c used before it wrote PhotonNumpyType directly
+PhotonNumpyTypeBin = np.dtype([('resID', np.uint32),
+                               ('time', np.uint32),
+                               ('wavelength', np.float32),
+                               ('baseline', np.float32)
+                               ], align=True)
+
+# PhotonNumpyType and PhotonCType are based on what we get back from an H5 file (based on PhotonDescription)
+PhotonNumpyType = np.dtype([('resID', np.uint32),
+                            ('time', np.uint32),
+                            ('wavelength', np.float32),
+                            ('weight', np.float32)])
+
+
+class PhotonCType(ctypes.Structure):
+    _fields_ = [('resID', ctypes.c_uint32),
+                ('time', ctypes.c_uint32),
+                ('wavelength', ctypes.c_float),
+                ('weight', ctypes.c_float)]
+
+
+# What parse returns, one record per real photon in the file
+ParsedPhotonType = np.dtype([('baseline', float), ('phase', float), ('tstamp', np.uint64), ('y', int), ('x', int),
+                             ('roach', int)])
+
+# The same in native sizes, the layout cparsebin writes (struct parsedphoton)
+ParsedPhotonCompactType = np.dtype([('baseline', np.float32),
+                                    ('phase', np.float32),
+                                    ('tstamp', np.uint64),
+                                    ('y', np.uint16),
+                                    ('x', np.uint16),
+                                    ('roach', np.uint16)], align=True)
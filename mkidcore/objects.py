@@ -1,4 +1,8 @@
 import os
+import functools
+import hashlib
+import tempfile
+import threading
 import numpy as np
 from mkidcore.instruments import DEFAULT_ARRAY_SIZES
 from glob import glob
@@ -18,18 +22,25 @@ class TimeStream(object):
 
     Args:
         file_path: string
-            The file name containing the phase time-stream.
+            The file name containing the phase time-stream. .npy files, and raw files if dtype is given, are
+            memory mapped rather than read, anything else is read as an .npz.
         phase: numpy.ndarray (optional)
             The phase data to use if 'file_path' doesn't exist yet.
         name: any (optional)
             An object that can be used to identify the time stream. It is not
             used directly by this class.
+        dtype: numpy.dtype (optional)
+            The sample type of a raw (headerless) file_path.
+
+    Slicing (ts[i0:i1], in samples) and iter_chunks only read the samples asked for from memory mapped files, so
+    streams larger than memory can be processed a piece at a time.
     """
     yaml_tag = u'!ts'
 
-    def __init__(self, file_path, phase=None, name=None):
+    def __init__(self, file_path, phase=None, name=None, dtype=None):
         self.file_path = file_path
         self.name = name if name is not None else os.path.splitext(os.path.basename(file_path))[0]
+        self.dtype = np.dtype(dtype) if dtype is not None else None
 
         # defer loading data
         self.zip = None
@@ -39,7 +50,12 @@ class TimeStream(object):
     def phase(self):
         """The phase time-stream of the resonator."""
         if self._phase is None:
-            self._phase = self.zip[self.zip.keys()[0]]
+            if self.dtype is not None:
+                self._phase = np.memmap(self.file_path, dtype=self.dtype, mode='r')
+            elif self.file_path.endswith('.npy'):
+                self._phase = np.load(self.file_path, mmap_mode='r')
+            else:
+                self._phase = self.zip[self.zip.files[0]]
         return self._phase
 
     @phase.setter
@@ -57,26 +73,56 @@ class TimeStream(object):
     def zip(self, value):
         self._npz = value
 
+    def __len__(self):
+        return len(self.phase)
+
+    def __getitem__(self, item):
+        return self.phase[item]
+
+    def iter_chunks(self, n):
+        """Yield the phase time-stream n samples at a time, each chunk read into memory"""
+        phase = self.phase
+        for i in range(0, len(phase), n):
+            yield np.array(phase[i:i + n])
+
     def clear(self):
         """Free memory by removing all file bound attributes."""
         self.phase = None
         self.zip = None
 
+    def _save(self, file):
+        if self.dtype is not None:
+            np.asarray(self.phase, dtype=self.dtype).tofile(file)
+        elif self.file_path.endswith('.npy'):
+            np.save(file, self.phase)
+        else:
+            np.savez(file, self.phase)
+
     def save(self):
-        """Save the time-stream data to the object's file path."""
+        """
+        Save the time-stream data to the object's file path, in the format it is read in. The phase may be memory
+        mapped from that file, so it is written to a temporary file that then replaces it.
+        """
+        directory = os.path.dirname(self.file_path)
+        if directory and not os.path.isdir(directory):
+            getLogger(__name__).info('Making directory: ' + directory)
+            os.makedirs(directory, exist_ok=True)
+        tmp = '{}.{}.{}.tmp'.format(self.file_path, os.getpid(), threading.get_ident())
         try:
-            np.savez(self.file_path, self.phase)
-        except IOError:
-            path = self.file_path.rsplit('/', 1)
-            if len(path) <= 1:
-                raise
-            getLogger(__name__).info('Making directory: ' + path[0])
-            os.mkdir(path[0])
-            np.savez(self.file_path, self.phase)
+            with open(tmp, 'wb') as f:
+                self._save(f)
+            os.replace(tmp, self.file_path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
 
     @classmethod
     def to_yaml(cls, representer, node):
-        return representer.represent_mapping(cls.yaml_tag, dict(file=node.file, name=node.name))
+        d = dict(file=node.file_path, name=node.name)
+        if node.dtype is not None:
+            d['dtype'] = node.dtype.str
+        return representer.represent_mapping(cls.yaml_tag, d)
 
     @classmethod
     def from_yaml(cls, constructor, node):
@@ -103,6 +149,119 @@ class DashboardState(dict):
         return json.dumps(self._json)
 
 
+def _cache_dir():
+    """The directory for mkidcore's on disk caches, $MKIDCORE_CACHE_DIR or mkidcore in the user's cache directory"""
+    return os.environ.get('MKIDCORE_CACHE_DIR') or os.path.join(os.environ.get('XDG_CACHE_HOME') or
+                                                               os.path.join(os.path.expanduser('~'), '.cache'),
+                                                               'mkidcore')
+
+
+@functools.lru_cache(maxsize=16)
+def _read_beammap(filename, mtime_ns, size):
+    """
+    Return the read only 4 x nPix (resID, flag, x, y) data of the beammap file filename (an absolute path).
+
+    Beammaps are cached in memory and as .npy files in _cache_dir(), both keyed by the file's path, modification
+    time and size, so only the first load of a (changed) file parses the text.
+    """
+    key = hashlib.sha1(filename.encode('utf-8')).hexdigest()[:16]
+    cachedir = _cache_dir()
+    cache = os.path.join(cachedir, 'beammap-{}-{}-{}.npy'.format(key, mtime_ns, size))
+    try:
+        data = np.load(cache)
+    except (IOError, ValueError):
+        getLogger(__name__).debug('Reading {}'.format(filename))
+        data = np.loadtxt(filename, unpack=True, ndmin=2)
+        try:
+            os.makedirs(cachedir, exist_ok=True)
+            for old in glob(os.path.join(cachedir, 'beammap-{}-*.npy'.format(key))):
+                os.remove(old)
+            fd, tmp = tempfile.mkstemp(dir=cachedir, suffix='.npy')
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, data)
+            os.replace(tmp, cache)
+        except OSError:
+            getLogger(__name__).debug('Unable to cache {} in {}'.format(filename, cachedir), exc_info=True)
+    data.flags.writeable = False
+    return data
+
+
+def _last_index(keys, values):
+    """Return the index of the last occurrence in keys of each of values, -1 where there is none. NaNs never match."""
+    keys = np.asarray(keys)
+    values = np.asarray(values)
+    uniq, first = np.unique(keys[::-1], return_index=True)
+    if not uniq.size:
+        return np.full(values.shape, -1, dtype=int)
+    i = np.minimum(np.searchsorted(uniq, values), uniq.size - 1)
+    return np.where(uniq[i] == values, keys.size - 1 - first[i], -1)
+
+
+# A Beammap's data, one record per resonator. Frequencies are in MHz, NaN until loaded.
+_BeammapType = np.dtype([('resID', np.uint32), ('flag', np.uint8), ('x', np.float32), ('y', np.float32),
+                         ('frequency', np.float32), ('attenuation', np.float32)], align=True)
+
+
+def _beammap_data(n):
+    """Return the data for n resonators, with NaN coordinates, frequencies and attenuations"""
+    data = np.zeros(n, dtype=_BeammapType)
+    for field in ('x', 'y', 'frequency', 'attenuation'):
+        data[field] = np.nan
+    return data
+
+
+def _check_field(field, value):
+    """
+    Return value as an array for the field of _BeammapType, raising a ValueError if the field is an integer and
+    value isn't all whole numbers in its range, rather than letting them wrap or truncate
+    """
+    value = np.asarray(value)
+    dtype = _BeammapType.fields[field][0]
+    if dtype.kind != 'u' or value.dtype.kind == 'b':
+        return value
+    if value.dtype.kind not in 'iuf':
+        raise ValueError('Beammap {} values must be numbers, not {}'.format(field, value.dtype))
+    info = np.iinfo(dtype)
+    with np.errstate(invalid='ignore'):
+        bad = (value < info.min) | (value > info.max)
+        if value.dtype.kind == 'f':
+            bad |= ~np.isfinite(value) | (value != np.floor(value))
+    if np.any(bad):
+        raise ValueError('Beammap {} values must be integers from {} to {}, not {}'.format(
+            field, info.min, info.max, np.asarray(value[bad]).ravel()[0]))
+    return value
+
+
+class _BeammapField(object):
+    """
+    A Beammap data array, a view of a field of its data. Assigning an array of a different length replaces the data
+    with that many resonators (the other fields NaN or 0). If invalidates, assigning to it invalidates the arrays the
+    Beammap has derived from its data, and the view is read only so they can't go stale from an edit in place.
+    Values for the integer fields must be whole numbers that fit, rather than being wrapped or truncated.
+    """
+    def __init__(self, field, invalidates=True):
+        self.field = field
+        self.invalidates = invalidates
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        view = obj._data[self.field]
+        if self.invalidates:
+            view.flags.writeable = False
+        return view
+
+    def __set__(self, obj, value):
+        value = _check_field(self.field, value)
+        if value.ndim and value.size != obj._data.size:
+            obj._data = _beammap_data(value.size)
+            obj.changed()
+        obj._data[self.field] = value
+        if self.invalidates:
+            obj.changed()
+
+
+
 class Beammap(object):
     """
     Simple wrapper for beammap file.
@@ -111,9 +270,26 @@ class Beammap(object):
         flags
         xCoords
         yCoords
+        frequencies
+        attenuations
+
+    These are views of the fields of a single structured array (uint32 resID, uint8 flag and float32 coordinates,
+    frequency and attenuation), so copies of a Beammap are a single buffer copy.
+
+    Arrays derived from these (extraction_array, residmap, flagmap, failmask and the resID and pixel indexes behind
+    the lookups) are cached, and read only, until one is assigned to or changed() is called. So the cache can't go
+    stale resIDs, flags, xCoords and yCoords are read only, assign an edited copy to change them. Each change
+    increments version.
     """
     yaml_tag = u'!bmap'
 
+    resIDs = _BeammapField('resID')
+    flags = _BeammapField('flag')
+    xCoords = _BeammapField('x')
+    yCoords = _BeammapField('y')
+    frequencies = _BeammapField('frequency', invalidates=False)
+    attenuations = _BeammapField('attenuation', invalidates=False)
+
     def __init__(self, specifier='MEC', xydim=None, freqpath=''):
         """
         Constructor.
@@ -132,13 +308,10 @@ class Beammap(object):
         else:
             file = specifier
 
+        self._version = 0
+        self._cache = {}
+        self._data = _beammap_data(0)
         self.file = file
-        self.resIDs = None
-        self.flags = None
-        self.xCoords = None
-        self.yCoords = None
-        self.frequencies = None
-        self.attenuations = None
         self.freqpath = freqpath
 
         if file is not None:
@@ -191,52 +364,46 @@ class Beammap(object):
         INPUTS:
             bmData - Nx4 or Nx5 numpy array in same format as beammap file
         """
-        if bmData.shape[1] == 4:
-            self.resIDs = np.array(bmData[:, 0], dtype=int)
-            self.flags = np.array(bmData[:, 1], dtype=int)
-            self.xCoords = np.array(bmData[:, 2])
-            self.yCoords = np.array(bmData[:, 3])
-        elif bmData.shape[1] == 5:
-            self.resIDs = np.array(bmData[:, 0], dtype=int)
-            self.flags = np.array(bmData[:, 1], dtype=int)
-            self.xCoords = np.array(bmData[:, 2])
-            self.yCoords = np.array(bmData[:, 3])
-            self.frequencies = np.array(bmData[:, 4], dtype=float)
-        else:
+        if bmData.shape[1] not in (4, 5):
             raise Exception("This data is not in the proper format")
+        _check_field('resID', bmData[:, 0])
+        _check_field('flag', bmData[:, 1])
+        self.resIDs, self.flags, self.xCoords, self.yCoords = bmData[:, :4].T
+        if bmData.shape[1] == 5:
+            self.frequencies = bmData[:, 4]
 
     def _load(self, filename):
         """
         Loads beammap data from filename
         """
         self.file = filename
-        getLogger(__name__).debug('Reading {}'.format(self.file))
-        self.resIDs, self.flags, self.xCoords, self.yCoords = np.loadtxt(filename, unpack=True)
+        st = os.stat(filename)
+        data = _read_beammap(os.path.abspath(filename), st.st_mtime_ns, st.st_size)
+        _check_field('resID', data[0])
+        _check_field('flag', data[1])
+        self.resIDs, self.flags, self.xCoords, self.yCoords = data
 
     def loadFrequencies(self, filepath):
         self.freqpath = filepath
         powerSweeps = glob(filepath)
         if not powerSweeps:
             raise FileNotFoundError('No powersweeps found matching {}'.format(filepath))
-        psData = np.loadtxt(powerSweeps[0])
-        for sweep in powerSweeps[1:]:
-            psData = np.concatenate((psData, np.loadtxt(sweep)))
-        self.frequencies = np.full(self.resIDs.shape, np.nan)
-        self.attenuations = np.full(self.resIDs.shape, np.nan)
+        psData = np.concatenate([np.loadtxt(sweep, ndmin=2) for sweep in powerSweeps])
         # psData has the form [Resonator ID, Frequency (Hz), Attenuation (dB)]
         # TODO: move SweepMetadata to core and use that instead
         if psData.shape[1] == 3:
-            for rID, freq, atten in psData:
-                location = self.resIDs == rID
-                self.frequencies[location] = freq / (10 ** 6)
-                self.attenuations[location] = atten
+            rID, freq, atten = psData.T
         elif psData.shape[1] == 9:
-            for rID, _, _, _, _, freq, atten, _, _ in psData:
-                location = self.resIDs == rID
-                self.frequencies[location] = freq / (10 ** 6)
-                self.attenuations[location] = atten
+            rID, freq, atten = psData[:, 0], psData[:, 5], psData[:, 6]
         else:
             raise Exception('Freq file format not supported')
+        # the last sweep entry for a resonator wins
+        row = _last_index(rID, self.resIDs)
+        found = row >= 0
+        self.frequencies = np.full(self.resIDs.shape, np.nan)
+        self.attenuations = np.full(self.resIDs.shape, np.nan)
+        self.frequencies[found] = freq[row[found]] / (10 ** 6)
+        self.attenuations[found] = atten[row[found]]
 
     def save(self, filename, forceIntegerCoords=False):
         """
@@ -255,10 +422,104 @@ class Beammap(object):
         """
         Returns a deep copy of itself
         """
-        return copy.deepcopy(self)
+        new = object.__new__(type(self))
+        new.__dict__ = copy.deepcopy({k: v for k, v in self.__dict__.items() if k not in ('_data', '_cache')})
+        new._data = self._data.copy()
+        new._cache = dict(self._cache)  # the cached arrays are read only, so can be shared until either changes
+        return new
+
+    @property
+    def version(self):
+        """A counter incremented each time the beammap data change"""
+        return self._version
+
+    def changed(self):
+        """Note that the beammap data has changed, discarding the arrays cached from it. Assigning a field calls this."""
+        self._version += 1
+        self._cache = {}
+
+    def extraction_array(self, ncols=None, nrows=None):
+        """
+        Return the validated, C contiguous nPix x 4 integer (resID, flag, x, y) array the bin file extractors use for a
+        ncols x nrows array (default the beammap's). The array is cached, and read only, until the beammap changes.
+        """
+        if ncols is None or nrows is None:
+            ncols, nrows = self.ncols, self.nrows
+        key = ('extraction', ncols, nrows)
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        bmarr = np.column_stack((self.resIDs, self.flags, self.xCoords, self.yCoords))
+        if np.isnan(bmarr).any():
+            raise Exception('NaNs in beammap')
+        if ((self.xCoords >= ncols) | (self.xCoords < 0) | (self.yCoords >= nrows) | (self.yCoords < 0)).any():
+            raise Exception('Beammap coords out of range')
+        bmarr = np.ascontiguousarray(bmarr, dtype=int)
+        bmarr.flags.writeable = False
+        self._cache[key] = bmarr
+        return bmarr
+
+    def _resid_index(self):
+        """The rows of the beammap in resID order (stable) and the sorted resIDs"""
+        try:
+            return self._cache['resid']
+        except KeyError:
+            order = np.argsort(self.resIDs, kind='stable')
+            index = self._cache['resid'] = order, self.resIDs[order]
+            return index
+
+    def _pixel_index(self):
+        """
+        The rows of the beammap with coordinates in the array, in pixel order (stable), and the offset of each
+        pixel's (x * nrows + y) rows in that order.
+        """
+        key = ('pixel', self.ncols, self.nrows)
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        with np.errstate(invalid='ignore'):
+            x, y = np.floor(self.xCoords), np.floor(self.yCoords)
+            rows, = np.nonzero((x >= 0) & (x < self.ncols) & (y >= 0) & (y < self.nrows))
+        pixel = x[rows].astype(int) * self.nrows + y[rows].astype(int)
+        order = np.argsort(pixel, kind='stable')
+        offsets = np.searchsorted(pixel[order], np.arange(self.ncols * self.nrows + 1))
+        index = self._cache[key] = rows[order], offsets
+        return index
+
+    def rows_for_resids(self, resids):
+        """Return the beammap row of each of resids (the first if a resID is repeated), -1 if it isn't there"""
+        order, sorted_resids = self._resid_index()
+        resids = np.asarray(resids)
+        if not sorted_resids.size:
+            return np.full(resids.shape, -1, dtype=int)
+        i = np.minimum(np.searchsorted(sorted_resids, resids), sorted_resids.size - 1)
+        return np.where(sorted_resids[i] == resids, order[i], -1)
+
+    def resids_at(self, xs, ys, missing=-1):
+        """
+        Return the resID at each pixel (xs, ys), the last beammap entry there as in residmap, missing where there
+        is none.
+        """
+        rows, offsets = self._pixel_index()
+        xs, ys = np.broadcast_arrays(np.asarray(xs), np.asarray(ys))
+        inarray = (xs >= 0) & (xs < self.ncols) & (ys >= 0) & (ys < self.nrows) & (xs == np.floor(xs)) & \
+                  (ys == np.floor(ys))
+        pixel = np.where(inarray, xs, 0).astype(int) * self.nrows + np.where(inarray, ys, 0).astype(int)
+        found = inarray & (offsets[pixel + 1] > offsets[pixel])
+        result = np.full(xs.shape, missing, dtype=np.result_type(self.resIDs, np.min_scalar_type(missing)))
+        result[found] = self.resIDs[rows[offsets[pixel[found] + 1] - 1]]
+        return result
 
     def resIDat(self, x, y):
-        return self.resIDs[(np.floor(self.xCoords) == x) & (np.floor(self.yCoords) == y)]
+        if not (0 <= x < self.ncols and 0 <= y < self.nrows):
+            return self.resIDs[(np.floor(self.xCoords) == x) & (np.floor(self.yCoords) == y)]
+        if x != int(x) or y != int(y):
+            return self.resIDs[:0]
+        rows, offsets = self._pixel_index()
+        pixel = int(x) * self.nrows + int(y)
+        return self.resIDs[rows[offsets[pixel]:offsets[pixel + 1]]]
 
     def getResonatorsAtCoordinate(self, x, y):
         resonators = [self.getResonatorData(r) for r in  self.resIDat(x,y)]
@@ -303,9 +564,16 @@ class Beammap(object):
         else:
             raise Exception('This is not a valid Beammap attribute')
 
+    def _resid_rows(self, resID):
+        """The rows of resID, in beammap order"""
+        order, sorted_resids = self._resid_index()
+        return order[np.searchsorted(sorted_resids, resID, 'left'):np.searchsorted(sorted_resids, resID, 'right')]
+
     def getResonatorData(self, resID):
-        index, = np.where(self.resIDs == resID)[0]
-        if index.size>1:
+        index = self._resid_rows(resID)
+        if not index.size:
+            raise ValueError('resID {} is not in the beammap'.format(resID))
+        if index.size > 1:
             getLogger(__name__).warning('resID {} is not unique'.format(resID))
         index = index[0]
         resonator = [int(self.resIDs[index]), int(self.flags[index]), int(self.xCoords[index]), int(self.yCoords[index]),
@@ -313,7 +581,7 @@ class Beammap(object):
         return resonator
 
     def getResonatorFlag(self, resID):
-        return self.flags[self.resIDs == resID]
+        return self.flags[self._resid_rows(resID)]
 
     def retuneMap(self, newIDsboardA=None, newIDsboardB=None):
         """
@@ -335,43 +603,18 @@ class Beammap(object):
         feedlineBase = feedlineGuess * 10000
 
         if a is not None:
-            aMask = []
-            for i in range(len(a)):
-                if not np.isnan(a[i][0]) and not np.isnan(a[i][1]):
-                    if (a[i][0] <= feedlineBase + 1023) and (a[i][1] <= feedlineBase + 1023):
-                        aMask.append(True)
-                    else:
-                        aMask.append(False)
-                elif not np.isnan(a[i][0]) and np.isnan(a[i][1]):
-                    if (a[i][0] <= feedlineBase + 1023):
-                        aMask.append(True)
-                    else:
-                        aMask.append(False)
-                elif np.isnan(a[i][0]) and not np.isnan(a[i][1]):
-                    if (a[i][1] <= feedlineBase + 1023):
-                        aMask.append(True)
-                    else:
-                        aMask.append(False)
-            a = a[aMask]
+            with np.errstate(invalid='ignore'):
+                old, new = a[:, 0], a[:, 1]
+                ok = (np.isnan(old) | (old <= feedlineBase + 1023)) & (np.isnan(new) | (new <= feedlineBase + 1023))
+            a = a[ok & ~(np.isnan(old) & np.isnan(new))]
 
         if b is not None:
-            bMask = []
-            for i in range(len(b)):
-                if not np.isnan(b[i][0]) and not np.isnan(b[i][1]):
-                    if (b[i][0] >= feedlineBase + 1024) and (b[i][1] >= feedlineBase + 1024):
-                        bMask.append(True)
-                    else:
-                        bMask.append(False)
-                elif not np.isnan(b[i][0]) and np.isnan(b[i][1]):
-                    if (b[i][0] <= feedlineBase + 1024):
-                        bMask.append(True)
-                    else:
-                        bMask.append(False)
-                elif np.isnan(b[i][0]) and not np.isnan(b[i][1]):
-                    if (b[i][1] <= feedlineBase + 1024):
-                        bMask.append(True)
-                    else:
-                        bMask.append(False)
+            with np.errstate(invalid='ignore'):
+                old, new = b[:, 0], b[:, 1]
+                hasold, hasnew = ~np.isnan(old), ~np.isnan(new)
+                bMask = np.select([hasold & hasnew, hasold, hasnew],
+                                  [(old >= feedlineBase + 1024) & (new >= feedlineBase + 1024),
+                                   old <= feedlineBase + 1024, new <= feedlineBase + 1024], False)
             b = b[bMask]
 
         if a is not None and b is not None:
@@ -381,68 +624,46 @@ class Beammap(object):
         else:
             self.reassignmentList = a
 
-        self.newResIDs = np.full_like(self.resIDs, np.nan)
-        self.newFlags = np.full_like(self.flags, np.nan)  # TODO This isn't valid flags are assumed to be ints
-
-        for i in self.reassignmentList:
-            if i[2] == 1:
-                mask = self.resIDs == i[0]
-                self.newResIDs[mask] = i[1]
-                self.newFlags[mask] = beamMapFlags['good']
-            elif i[2] == 4:
-                mask = self.resIDs == i[0]
-                self.newResIDs[mask] = i[1]
-                self.newFlags[mask] = beamMapFlags['failed']
-
-        if a and b:
-            full = True
+        # float, so resonators not (yet) reassigned can be NaN whatever the dtype of resIDs and flags
+        self.newResIDs = np.full(self.resIDs.shape, np.nan)
+        self.newFlags = np.full(self.flags.shape, np.nan)
+
+        # the last good (1) or failed (4) reassignment of each resID wins
+        reassigned = self.reassignmentList[np.isin(self.reassignmentList[:, 2], (1, 4))]
+        row = _last_index(reassigned[:, 0], self.resIDs)
+        found = row >= 0
+        self.newResIDs[found] = reassigned[row[found], 1]
+        self.newFlags[found] = np.where(reassigned[row[found], 2] == 1, beamMapFlags['good'], beamMapFlags['failed'])
+
+        if a is not None and b is not None:
             mask = np.floor(self.resIDs / 10000) == feedlineGuess
-        elif a and not b:
-            full = False
+        elif a is not None:
             validIDs = [10000*feedlineGuess, 10000*feedlineGuess + 1023]
             mask = (self.resIDs >= validIDs[0]) & (self.resIDs <= validIDs[1])
         else:
-            full = False
             validIDs = [10000*feedlineGuess + 1024, 10000*feedlineGuess + 9999]
             mask = (self.resIDs >= validIDs[0]) & (self.resIDs <= validIDs[1])
         old = self.resIDs[mask]
         new = self.newResIDs[mask]
         unused = np.setdiff1d(old, new)
 
-        for i, j in enumerate(self.resIDs):
-            if full:
-                if (np.floor(j / 10000) == feedlineGuess) and np.isnan(self.newResIDs[i]):
-                    # print(unused[0])
-                    self.newResIDs[i] = unused[0]
-                    if unused[0] in self.reassignmentList[:, 1]:
-                        # print(f'noDacTon {unused[0]}')
-                        self.newFlags[i] = beamMapFlags['noDacTone']
-                    elif unused[0] in self.reassignmentList[:, 0]:
-                        # print(f'failed {unused[0]}')
-                        self.newFlags[i] = beamMapFlags['failed']
-                    else:
-                        # print(f'noDacTone2 {unused[0]}')
-                        self.newFlags[i] = beamMapFlags['noDacTone']
-                    unused = np.delete(unused, 0)
-            else:
-                if (j >= validIDs[0]) and (j <= validIDs[1]) and np.isnan(self.newResIDs[i]):
-                    # print(unused[0])
-                    self.newResIDs[i] = unused[0]
-                    if unused[0] in self.reassignmentList[:, 1]:
-                        # print(f'noDacTon {unused[0]}')
-                        self.newFlags[i] = beamMapFlags['noDacTone']
-                    elif unused[0] in self.reassignmentList[:, 0]:
-                        # print(f'failed {unused[0]}')
-                        self.newFlags[i] = beamMapFlags['failed']
-                    else:
-                        # print(f'noDacTone2 {unused[0]}')
-                        self.newFlags[i] = beamMapFlags['noDacTone']
-                    unused = np.delete(unused, 0)
+        # resonators of the feedline left without a resID take the unused ones in order
+        rows, = np.nonzero(mask & np.isnan(self.newResIDs))
+        if rows.size > unused.size:
+            raise ValueError('{} resonators to reassign but only {} unused resIDs'.format(rows.size, unused.size))
+        unused = unused[:rows.size]
+        self.newResIDs[rows] = unused
+        self.newFlags[rows] = np.where(~np.isin(unused, self.reassignmentList[:, 1]) &
+                                       np.isin(unused, self.reassignmentList[:, 0]),
+                                       beamMapFlags['failed'], beamMapFlags['noDacTone'])
 
         mask2 = mask & (self.flags == 0)
 
-        self.resIDs[mask] = self.newResIDs[mask]
-        self.flags[mask2] = self.newFlags[mask2]
+        # float, so a NaN left by a bad retune file is refused on assignment rather than cast
+        resIDs, flags = self.resIDs.astype(float), self.flags.astype(float)
+        resIDs[mask] = self.newResIDs[mask]
+        flags[mask2] = self.newFlags[mask2]
+        self.resIDs, self.flags = resIDs, flags
 
 
     def beammapDict(self):
@@ -453,26 +674,49 @@ class Beammap(object):
     def shape(self):
         return self.nrows, self.ncols
 
+    def _image(self, name):
+        """
+        The cached, read only ncols x nrows image of the resIDs ('residmap') or flags ('flagmap'), the last beammap entry
+        of each pixel, 0 where there is none
+        """
+        key = (name, self.ncols, self.nrows)
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        values = self.resIDs if name == 'residmap' else self.flags
+        with np.errstate(invalid='ignore'):
+            x, y = self.xCoords.astype(int), self.yCoords.astype(int)
+        use = (x >= 0) & (x < self.ncols) & (y >= 0) & (y < self.nrows)
+        image = np.zeros((self.ncols, self.nrows), dtype=values.dtype)
+        image[x[use], y[use]] = values[use]
+        image.flags.writeable = False
+        self._cache[key] = image
+        return image
+
     @property
     def failmask(self):
+        key = ('failmask', self.ncols, self.nrows)
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
         mask = np.ones((self.nrows, self.ncols), dtype=bool)
-        use = (self.yCoords.astype(int) < self.nrows) & (self.xCoords.astype(int) < self.ncols)
-        mask[self.yCoords[use].astype(int), self.xCoords[use].astype(int)] = self.flags[use] != 0
+        with np.errstate(invalid='ignore'):
+            x, y = self.xCoords.astype(int), self.yCoords.astype(int)
+        use = (x >= 0) & (x < self.ncols) & (y >= 0) & (y < self.nrows)
+        mask[y[use], x[use]] = self.flags[use] != 0
+        mask.flags.writeable = False
+        self._cache[key] = mask
         return mask
 
     @property
     def residmap(self):
-        map = np.zeros((self.ncols, self.nrows), dtype=self.resIDs.dtype)
-        use = (self.yCoords.astype(int) < self.nrows) & (self.xCoords.astype(int) < self.ncols)
-        map[self.xCoords[use].astype(int), self.yCoords[use].astype(int)] = self.resIDs
-        return map
+        return self._image('residmap')
 
     @property
     def flagmap(self):
-        map = np.zeros((self.ncols, self.nrows), dtype=self.flags.dtype)
-        use = (self.yCoords.astype(int) < self.nrows) & (self.xCoords.astype(int) < self.ncols)
-        map[self.xCoords[use].astype(int), self.yCoords[use].astype(int)] = self.flags
-        return map
+        return self._image('flagmap')
 
     def __repr__(self):
         return '<file={}, ncols={}, nrows={}, freqpath={}>'.format(self.file, self.ncols, self.nrows, self.freqpath)
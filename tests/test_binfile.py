@@ -0,0 +1,544 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import TestCase
+
+import numpy as np
+
+from mkidcore.objects import Beammap
+from mkidcore.binfile import synthetic
+
+START = 1547683242
+NCOLS, NROWS = 20, 15
+
+
+def small_beammap(ncols=NCOLS, nrows=NROWS):
+    bmap = Beammap('MEC')
+    x, y = np.meshgrid(np.arange(ncols), np.arange(nrows), indexing='ij')
+    resids = np.arange(ncols * nrows) + 10000
+    flags = np.zeros(ncols * nrows, dtype=int)
+    flags[::7] = 1
+    bmap.setData(np.column_stack((resids, flags, x.ravel(), y.ravel())))
+    bmap.ncols, bmap.nrows = ncols, nrows
+    return bmap
+
+
+class TestExtract(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        synthetic.generate(cls.dir, START - 1, 6, NCOLS, NROWS, rate=200, seed=0)
+        cls.bmap = small_beammap()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    def test_extract(self):
+        from mkidcore.binfile.mkidbin import extract
+        photons = extract(self.dir, START, 3, self.bmap, NCOLS, NROWS)
+        self.assertGreater(photons.size, 0)
+        good = self.bmap.resIDs[self.bmap.flags == 0]
+        self.assertTrue(np.isin(photons['resID'], good).all())
+        self.assertLess(photons['time'].max(), 4e6)
+
+    def test_threads_match_serial(self):
+        from mkidcore.binfile.mkidbin import extract
+        serial = extract(self.dir, START, 3, self.bmap, NCOLS, NROWS)
+        for nthreads in (2, 3, 16):
+            threaded = extract(self.dir, START, 3, self.bmap, NCOLS, NROWS, nthreads=nthreads)
+            self.assertEqual(serial.tobytes(), threaded.tobytes())
+
+    def test_duplicate_beammap_entry(self):
+        from mkidcore.binfile.mkidbin import extract
+        bmap = small_beammap()
+        photons = extract(self.dir, START, 1, bmap, NCOLS, NROWS)
+        dup = small_beammap()
+        dup.setData(np.vstack((np.column_stack((bmap.resIDs, bmap.flags, bmap.xCoords, bmap.yCoords)),
+                               [[bmap.resIDs[5], 0, bmap.xCoords[5], bmap.yCoords[5]]])))
+        self.assertEqual(photons.tobytes(), extract(self.dir, START, 1, dup, NCOLS, NROWS).tobytes())
+
+    def test_iter_extract(self):
+        from mkidcore.binfile.mkidbin import extract, iter_extract
+        full = extract(self.dir, START, 3, self.bmap, NCOLS, NROWS, include_baseline=True)
+        chunks = list(iter_extract(self.dir, START, 3, self.bmap, chunk_seconds=0.75, include_baseline=True))
+        self.assertEqual(len(chunks), 6)
+        for chunk, t0 in zip(chunks, np.arange(6) * 750000):
+            self.assertTrue(((chunk['time'] >= t0) & (chunk['time'] < t0 + 750000 + 500)).all())
+        joined = np.concatenate(chunks)
+        self.assertEqual(np.sort(full, order=('resID', 'time', 'wavelength')).tobytes(),
+                         np.sort(joined, order=('resID', 'time', 'wavelength')).tobytes())
+
+        # the median baseline of the whole integration is subtracted from every chunk, as extract does
+        full = extract(self.dir, START, 3, self.bmap, NCOLS, NROWS)
+        joined = np.concatenate(list(iter_extract(self.dir, START, 3, self.bmap, chunk_seconds=0.75)))
+        self.assertEqual(np.sort(full, order=('resID', 'time', 'wavelength')).tobytes(),
+                         np.sort(joined, order=('resID', 'time', 'wavelength')).tobytes())
+
+    def test_extract_window(self):
+        from mkidcore.binfile.mkidbin import extract, extract_window
+        full = extract(self.dir, START, 3, self.bmap, NCOLS, NROWS, include_baseline=True)
+        for t0, t1 in ((1.25, 1.3), (1.2501, 1.2502), (0, 0.0004)):
+            window = extract_window(self.dir, START, t0, t1, self.bmap, include_baseline=True)
+            inwindow = full[(full['time'] >= t0 * 1e6) & (full['time'] < t1 * 1e6)]
+            self.assertEqual(inwindow.tobytes(), window.tobytes())
+        window, resids, offsets = extract_window(self.dir, START, 1.2501, 1.3, self.bmap, include_baseline=True,
+                                                 resid_offsets=True)
+        self.assertTrue(((window['time'] >= 1250100) & (window['time'] < 1300000)).all())
+        for resid, a, b in zip(resids, offsets[:-1], offsets[1:]):
+            self.assertTrue((window['resID'][a:b] == resid).all())
+        self.assertEqual(offsets[-1], window.size)
+        with self.assertRaises(ValueError):
+            extract_window(self.dir, START, 1.3, 1.25, self.bmap)
+
+    def test_index_sidecar(self):
+        from mkidcore.binfile.mkidbin import extract
+        with tempfile.TemporaryDirectory() as d:
+            files = synthetic.generate(d, START - 1, 3, NCOLS, NROWS, rate=100, seed=3)
+            unindexed = extract(d, START, 0, self.bmap, NCOLS, NROWS, use_index=False)
+            self.assertFalse(any(os.path.exists(f + '.idx') for f in files))
+            self.assertEqual(unindexed.tobytes(), extract(d, START, 0, self.bmap, NCOLS, NROWS).tobytes())
+            self.assertTrue(all(os.path.exists(f + '.idx') for f in files))
+            self.assertEqual(unindexed.tobytes(), extract(d, START, 0, self.bmap, NCOLS, NROWS).tobytes())
+
+            # a corrupt index is ignored and one for an older version of the file is rebuilt
+            with open(files[0] + '.idx', 'r+b') as f:
+                f.write(b'garbage!')
+            idx = open(files[1] + '.idx', 'rb').read()
+            synthetic.generate(d, START, 1, NCOLS, NROWS, rate=120, seed=4)
+            rewritten = extract(d, START, 0, self.bmap, NCOLS, NROWS, use_index=False)
+            self.assertEqual(rewritten.tobytes(), extract(d, START, 0, self.bmap, NCOLS, NROWS).tobytes())
+            self.assertNotEqual(idx, open(files[1] + '.idx', 'rb').read())
+
+    def test_file_growing_during_extract(self):
+        # a live readout file is appended to between the count and write passes, the photons counted are extracted
+        from mkidcore.binfile.mkidbin import Extractor
+        ext = Extractor(self.bmap)
+        with tempfile.TemporaryDirectory() as d, tempfile.TemporaryDirectory() as src:
+            synthetic.generate(d, START - 1, 3, NCOLS, NROWS, rate=2000, seed=0)
+            synthetic.generate(src, START, 1, NCOLS, NROWS, rate=2000, seed=1)
+            with open(os.path.join(src, '{}.bin'.format(START)), 'rb') as f:
+                extra = f.read()
+            before = ext.extract(d, START, 0, use_index=False).size
+            stop = threading.Event()
+
+            def grow():
+                with open(os.path.join(d, '{}.bin'.format(START)), 'ab') as f:
+                    for _ in range(20):
+                        for i in range(0, len(extra), 8192):
+                            if stop.is_set():
+                                return
+                            f.write(extra[i:i + 8192])
+                            f.flush()
+
+            writer = threading.Thread(target=grow)
+            writer.start()
+            try:
+                for i in range(5):
+                    photons, resids, offsets = ext.extract(d, START, 0, use_index=False, resid_offsets=True)
+                    self.assertGreaterEqual(photons.size, before)
+                    self.assertEqual(offsets[-1], photons.size)
+                    np.testing.assert_array_equal(np.repeat(resids, np.diff(offsets).astype(int)), photons['resID'])
+            finally:
+                stop.set()
+                writer.join()
+
+    def test_parse(self):
+        from mkidcore.binfile.mkidbin import parse
+        from mkidcore.headers import ParsedPhotonType, ParsedPhotonCompactType
+        file = os.path.join(self.dir, '{}.bin'.format(START))
+        wide = parse(file)
+        compact = parse(file, compact=True)
+        self.assertEqual(wide.dtype, ParsedPhotonType)
+        self.assertEqual(compact.dtype, ParsedPhotonCompactType)
+        self.assertGreater(compact.size, 0)
+        self.assertFalse((compact.x == synthetic.FAKE_PHOTON_X).any())
+        for name in wide.dtype.names:
+            np.testing.assert_array_equal(wide[name], compact[name])
+        columns = parse(file, compact=True, columns=True)
+        self.assertEqual(sorted(columns), sorted(wide.dtype.names))
+        self.assertEqual(columns['x'].dtype, np.uint16)
+
+    def test_parse_overflow(self):
+        # a buffer too small for the file is grown and parsing carries on from where it stopped
+        from mkidcore.binfile import mkidbin
+        from mkidcore.headers import ParsedPhotonType
+        file = os.path.join(self.dir, '{}.bin'.format(START))
+        full = mkidbin.parse(file)
+        for capacity in (1, 7, full.size - 1, full.size):
+            grown = mkidbin._cparse(file, capacity)
+            self.assertEqual(full.tobytes(), grown.astype(ParsedPhotonType).tobytes())
+
+    def test_beammap_file_cache(self):
+        from mkidcore.binfile.mkidbin import extract
+        from mkidcore.binfile.npbin import _beammap_array
+        with tempfile.TemporaryDirectory() as d:
+            file = os.path.join(d, 'test.bmap')
+            self.bmap.save(file, forceIntegerCoords=True)
+            bmarr = _beammap_array(file, NCOLS, NROWS)
+            self.assertIs(bmarr, _beammap_array(file, NCOLS, NROWS))
+            self.assertEqual(extract(self.dir, START, 1, file, NCOLS, NROWS).tobytes(),
+                             extract(self.dir, START, 1, self.bmap, NCOLS, NROWS).tobytes())
+            bmap = small_beammap()
+            bmap.flags = np.zeros_like(bmap.flags)
+            bmap.save(file, forceIntegerCoords=True)
+            os.utime(file, ns=(0, 0))
+            self.assertIsNot(bmarr, _beammap_array(file, NCOLS, NROWS))
+            self.assertTrue((_beammap_array(file, NCOLS, NROWS)[:, 1] == 0).all())
+
+    def test_extractor_reuse(self):
+        from mkidcore.binfile.mkidbin import Extractor, extract, extract_window
+        from concurrent.futures import ThreadPoolExecutor
+        ext = Extractor(self.bmap)
+        self.assertEqual((ext.x, ext.y), (NCOLS, NROWS))
+        full = extract(self.dir, START, 3, self.bmap, NCOLS, NROWS)
+        self.assertEqual(full.tobytes(), ext.extract(self.dir, START, 3).tobytes())
+        windows = [(0.1 * i, 0.1 * i + 0.35) for i in range(8)]
+        expected = [extract_window(self.dir, START, t0, t1, self.bmap).tobytes() for t0, t1 in windows]
+        with ThreadPoolExecutor(4) as pool:
+            got = list(pool.map(lambda w: ext.extract_window(self.dir, START, *w).tobytes(), windows))
+        self.assertEqual(expected, got)
+
+    def test_concurrent_extraction(self):
+        # the GIL is released around the C calls, mix parses and extractions across threads
+        from mkidcore.binfile.mkidbin import extract, parse
+        from concurrent.futures import ThreadPoolExecutor
+        files = [os.path.join(self.dir, '{}.bin'.format(START + i)) for i in range(3)]
+        jobs = [lambda: extract(self.dir, START, 2, self.bmap, NCOLS, NROWS, nthreads=2)]
+        jobs += [lambda f=f: parse(f) for f in files]
+        expected = [job().tobytes() for job in jobs]
+        with ThreadPoolExecutor(4) as pool:
+            got = list(pool.map(lambda job: job().tobytes(), jobs * 3))
+        self.assertEqual(expected * 3, got)
+
+    def test_batch_extract(self):
+        from mkidcore.binfile import batch_extract, extract
+        requests = [(self.dir, START, 2), (self.dir, START + 1, 3), (self.dir, START + 10, 1)]
+        done = []
+        photons = batch_extract(requests, self.bmap, workers=2, progress=lambda n, total: done.append((n, total)),
+                                include_baseline=True)
+        self.assertEqual(done, [(1, 3), (2, 3), (3, 3)])
+        for (d, start, inttime), p in zip(requests, photons):
+            expected = extract(d, start, inttime, self.bmap, NCOLS, NROWS, include_baseline=True)
+            self.assertEqual(expected.tobytes(), p.tobytes())
+        self.assertEqual(photons[2].size, 0)
+        with self.assertRaises(RuntimeError):
+            batch_extract([(self.dir + 'missing', START, 1)], self.bmap, workers=1)
+
+    def test_batch_extract_shared_memory(self):
+        # the parent frees the workers' shared memory blocks, so no resource tracker should warn about them at exit
+        tests = os.path.dirname(os.path.abspath(__file__))
+        script = ('import sys, test_binfile as t\n'
+                  'from mkidcore.binfile import batch_extract\n'
+                  'batch_extract([(sys.argv[1], t.START, 2), (sys.argv[1], t.START + 1, 1)], t.small_beammap(), '
+                  'workers=2)\n')
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([tests, os.path.dirname(tests),
+                                                           os.environ.get('PYTHONPATH', '')]))
+        proc = subprocess.run([sys.executable, '-W', 'error', '-W', 'ignore:pkg_resources', '-c', script, self.dir],
+                              env=env, capture_output=True, text=True, timeout=120)
+        self.assertEqual(proc.returncode, 0, proc.stderr)
+        self.assertEqual(proc.stderr, '')
+
+    @unittest.skipUnless(os.path.isdir('/dev/shm'), 'needs POSIX shared memory in /dev/shm')
+    def test_batch_extract_failure_frees_shared_memory(self):
+        # the blocks of requests that finish after another failed are freed, not left until the process exits
+        from mkidcore.binfile import batch_extract
+        before = set(os.listdir('/dev/shm'))
+        with self.assertRaises(RuntimeError):
+            batch_extract([(self.dir, START + 1, 1), (self.dir + 'missing', START, 1), (self.dir, START, 2),
+                           (self.dir, START + 2, 1)], self.bmap, workers=2)
+        self.assertEqual(set(os.listdir('/dev/shm')) - before, set())
+
+    def test_sorted_with_resid_offsets(self):
+        from mkidcore.binfile.mkidbin import extract, Extractor
+        photons, resids, offsets = extract(self.dir, START, 3, self.bmap, NCOLS, NROWS, resid_offsets=True)
+        self.assertEqual(photons.tobytes(), extract(self.dir, START, 3, self.bmap, NCOLS, NROWS).tobytes())
+        self.assertTrue((np.diff(resids.astype(np.int64)) > 0).all())
+        np.testing.assert_array_equal(resids, Extractor(self.bmap).resids)
+        self.assertEqual((offsets[0], offsets[-1]), (0, photons.size))
+        order = np.lexsort((photons['time'], photons['resID']))
+        np.testing.assert_array_equal(order, np.arange(photons.size))
+        for i in (0, 5, resids.size - 1):
+            pixel = photons[offsets[i]:offsets[i + 1]]
+            self.assertTrue((pixel['resID'] == resids[i]).all())
+            self.assertEqual(pixel.size, (photons['resID'] == resids[i]).sum())
+
+    def test_shared_resid(self):
+        # the photons of distinct pixels sharing a resID are merged in time order
+        from mkidcore.binfile import mkidbin, npbin, write_photons, read_photons
+        bmap = small_beammap()
+        resids = bmap.resIDs.copy()
+        resids[1::2] = resids[::2]
+        bmap.setData(np.column_stack((resids, bmap.flags, bmap.xCoords, bmap.yCoords)))
+        photons, uresids, offsets = mkidbin.extract(self.dir, START, 3, bmap, NCOLS, NROWS, resid_offsets=True)
+        order = np.lexsort((photons['time'], photons['resID']))
+        np.testing.assert_array_equal(order, np.arange(photons.size))
+        self.assertTrue((np.diff(uresids.astype(np.int64)) > 0).all())
+        np.testing.assert_array_equal(np.repeat(uresids, np.diff(offsets.astype(np.int64))), photons['resID'])
+        for nthreads in (2, 3, 16):
+            threaded = mkidbin.extract(self.dir, START, 3, bmap, NCOLS, NROWS, nthreads=nthreads)
+            self.assertEqual(photons.tobytes(), threaded.tobytes())
+        py = npbin.extract(self.dir, START, 3, bmap, NCOLS, NROWS, resid_offsets=True)
+        for a, b in zip((photons, uresids, offsets), py):
+            self.assertEqual(a.tobytes(), b.tobytes())
+        with tempfile.TemporaryDirectory() as d:
+            file = os.path.join(d, 'photons.phz')
+            write_photons(file, photons, block_size=1000)
+            self.assertEqual(read_photons(file).tobytes(), photons.tobytes())
+
+    def test_out_of_order_photons(self):
+        # photons of a pixel out of time order are sorted, equal times keep their order in the file
+        from mkidcore.binfile import mkidbin, npbin
+        from mkidcore.headers import year_start
+        tsoffs = year_start(START)
+        tick0 = (START - tsoffs) * synthetic.TICKS_PER_SECOND
+        words = []
+        for tick in range(4):
+            words.append(synthetic.header_words([tick0 + tick], [0]))
+            words.append(synthetic.photon_words([1, 2, 1, 1, 1], [1, 1, 1, 1, 1], [300, 5, 100, 300, 200],
+                                                [10, 20, 30, 40, 50 + tick], [0] * 5))
+        with tempfile.TemporaryDirectory() as d:
+            synthetic.write_bin(os.path.join(d, '{}.bin'.format(START)), np.concatenate(words))
+            bmap = small_beammap()
+            c = mkidbin.extract(d, START, 0, bmap, NCOLS, NROWS, include_baseline=True, use_index=False)
+            py = npbin.extract(d, START, 0, bmap, NCOLS, NROWS, include_baseline=True, use_index=False)
+        self.assertEqual(c.tobytes(), py.tobytes())
+        pixel = c[c['resID'] == bmap.resIDs[NROWS + 1]]
+        self.assertEqual(pixel.size, 12)
+        self.assertTrue((np.diff(pixel['time'].astype(int)) >= 0).all())
+        np.testing.assert_array_equal(pixel['time'][:4], [100, 200, 300, 300])
+        self.assertLess(pixel['wavelength'][2], pixel['wavelength'][3])
+
+    def test_histogram(self):
+        from mkidcore.binfile.mkidbin import extract, histogram
+        edges = np.linspace(-60, 60, 7)
+        for include_baseline in (False, True):
+            photons = extract(self.dir, START, 2, self.bmap, NCOLS, NROWS, include_baseline=include_baseline)
+            pixel = {r: (x, y) for r, x, y in zip(self.bmap.resIDs, self.bmap.xCoords.astype(int),
+                                                  self.bmap.yCoords.astype(int))}
+            x, y = np.array([pixel[r] for r in photons['resID']]).T
+            image = np.zeros((NCOLS, NROWS), dtype=int)
+            np.add.at(image, (x, y), 1)
+            np.testing.assert_array_equal(image, histogram(self.dir, START, 2, self.bmap,
+                                                           include_baseline=include_baseline))
+
+            cube = histogram(self.dir, START, 2, self.bmap, wavelength_bins=edges, time_bin=0.25, nthreads=3,
+                             include_baseline=include_baseline)
+            self.assertEqual(cube.shape, (NCOLS, NROWS, 6, 12))
+            expected, _ = np.histogramdd(np.column_stack((x, y, photons['wavelength'], photons['time'])),
+                                         (np.arange(NCOLS + 1), np.arange(NROWS + 1), edges,
+                                          np.arange(13) * 250000))
+            np.testing.assert_array_equal(expected, cube)
+        with self.assertRaises(ValueError):
+            histogram(self.dir, START, 2, self.bmap, wavelength_bins=[1, 0])
+
+    def test_photon_file(self):
+        from mkidcore.binfile.mkidbin import extract
+        from mkidcore.binfile import write_photons, read_photons, PhotonFile
+        photons = extract(self.dir, START, 3, self.bmap, NCOLS, NROWS, include_baseline=True)
+        photons['weight'][::3] = 0.5
+        with tempfile.TemporaryDirectory() as d:
+            file = os.path.join(d, 'photons.phz')
+            write_photons(file, photons, block_size=1000)
+            self.assertLess(os.path.getsize(file), photons.nbytes / 2)
+            self.assertEqual(read_photons(file).tobytes(), photons.tobytes())
+            self.assertEqual(read_photons(file, nthreads=3).tobytes(), photons.tobytes())
+            f = PhotonFile(file)
+            self.assertGreater(f.nblocks, 3)
+            self.assertEqual(f.read(1500, 3700).tobytes(), photons[1500:3700].tobytes())
+            for r in (self.bmap.resIDs[1], self.bmap.resIDs[-1], 1):
+                self.assertEqual(f.resid(r).tobytes(), photons[photons['resID'] == r].tobytes())
+
+            write_photons(file, photons, block_size=1000, wavelength_step=0.01)
+            quantized = read_photons(file)
+            np.testing.assert_array_equal(quantized[['resID', 'time', 'weight']], photons[['resID', 'time', 'weight']])
+            self.assertLessEqual(np.abs(quantized['wavelength'] - photons['wavelength']).max(), 0.005 + 1e-4)
+
+            write_photons(file, photons[:0])
+            self.assertEqual(read_photons(file).size, 0)
+            with self.assertRaises(ValueError):
+                write_photons(file, photons[::-1])
+
+    def test_high_count_rate(self):
+        # files bigger than the old fixed 2500 cts/pixel/s read buffer
+        from mkidcore.binfile.mkidbin import extract
+        with tempfile.TemporaryDirectory() as d:
+            synthetic.generate(d, START - 1, 3, 4, 4, rate=5000, seed=1)
+            bmap = small_beammap(4, 4)
+            photons = extract(d, START, 0, bmap, 4, 4)
+        self.assertGreater(photons.size, 0.9 * 5000 * (bmap.flags == 0).sum())
+
+
+class TestSynthetic(TestCase):
+    def test_wrapped_timestamps(self):
+        from mkidcore.binfile import mkidbin, npbin
+        bmap = small_beammap()
+        with tempfile.TemporaryDirectory() as d, tempfile.TemporaryDirectory() as w:
+            synthetic.generate(d, START - 1, 3, NCOLS, NROWS, rate=100, seed=6)
+            files = synthetic.generate(w, START - 1, 3, NCOLS, NROWS, rate=100, seed=6, wrap=True)
+            words = np.fromfile(files[0], dtype='>u8')
+            self.assertLess((words[0] & 0xfffffffff) // 2000, synthetic.HEADER_WRAP_SECONDS)
+            expected = mkidbin.extract(d, START, 1, bmap, NCOLS, NROWS)
+            self.assertGreater(expected.size, 0)
+            self.assertEqual(expected.tobytes(), mkidbin.extract(w, START, 1, bmap, NCOLS, NROWS).tobytes())
+            self.assertEqual(expected.tobytes(), npbin.extract(w, START, 1, bmap, NCOLS, NROWS).tobytes())
+
+    def test_pixel_rates(self):
+        from mkidcore.binfile import mkidbin
+        rates = synthetic.pixel_rates(NCOLS, NROWS, mean=200, seed=7)
+        rates[0, 1] = 0
+        rates[0, 2] = 3000
+        bmap = small_beammap()
+        bmap.setData(np.column_stack((bmap.resIDs, np.zeros_like(bmap.flags), bmap.xCoords, bmap.yCoords)))
+        with tempfile.TemporaryDirectory() as d:
+            synthetic.generate(d, START - 1, 3, NCOLS, NROWS, rate=rates, seed=7)
+            photons = mkidbin.extract(d, START, 0, bmap, NCOLS, NROWS)
+        counts = np.bincount(photons['resID'] - 10000, minlength=NCOLS * NROWS).reshape(NCOLS, NROWS)
+        self.assertEqual(counts[0, 1], 0)
+        self.assertGreater(counts[0, 2], 2500)
+        self.assertTrue((counts[rates == 0] == 0).all())
+
+    def test_extract_fake(self):
+        from mkidcore.binfile.npbin import extract_fake
+        from mkidcore.headers import PhotonNumpyType
+        photons = extract_fake(100)
+        self.assertEqual(photons.dtype, PhotonNumpyType)
+        self.assertTrue((photons['weight'] == 1).all())
+
+
+class TestBinTailReader(TestCase):
+    def test_follow(self):
+        from mkidcore.binfile import BinTailReader, npbin
+        with tempfile.TemporaryDirectory() as src, tempfile.TemporaryDirectory() as d:
+            files = synthetic.generate(src, START, 3, 8, 8, rate=3000, seed=8)
+            expected = np.concatenate([npbin.parse(f, compact=True) for f in files])
+            data = [open(f, 'rb').read() for f in files]
+            open(os.path.join(d, '{}.bin'.format(START)), 'wb').close()
+            reader = BinTailReader(d, start=START)
+            batches = []
+            for i, chunk in enumerate(data):
+                out = os.path.join(d, '{}.bin'.format(START + i))
+                cuts = np.linspace(0, len(chunk), 9).astype(int) + 3  # not on word boundaries
+                cuts[-1] = len(chunk)
+                with open(out, 'ab') as f:
+                    for a, b in zip(np.r_[0, cuts[:-1]], cuts):
+                        f.write(chunk[a:b])
+                        f.flush()
+                        batches.append(reader.read())
+                        self.assertTrue(batches[-1].size == 0 or batches[-1]['tstamp'].max()
+                                        <= expected['tstamp'].max())
+            self.assertGreater(sum(b.size for b in batches[:8]), 0)
+            # the last packet is only complete when the next file appears
+            open(os.path.join(d, '{}.bin'.format(START + 3)), 'wb').close()
+            batches.append(reader.read())
+            reader.close()
+            got = np.concatenate(batches)
+            for name in expected.dtype.names:
+                np.testing.assert_array_equal(expected[name], got[name])
+
+    def test_iterate_live(self):
+        import threading
+        from mkidcore.binfile import BinTailReader
+        with tempfile.TemporaryDirectory() as src, tempfile.TemporaryDirectory() as d:
+            file = synthetic.generate(src, START, 1, 8, 8, rate=2000, seed=9)[0]
+            chunk = open(file, 'rb').read()
+            out = os.path.join(d, '{}.bin'.format(START))
+            open(out, 'wb').close()
+
+            def write():
+                with open(out, 'ab') as f:
+                    for part in np.array_split(np.frombuffer(chunk, dtype=np.uint8), 5):
+                        time.sleep(0.05)
+                        f.write(part.tobytes())
+                        f.flush()
+
+            writer = threading.Thread(target=write)
+            with BinTailReader(d, idle_timeout=0.3, poll_interval=0.005) as reader:
+                writer.start()
+                batches = list(reader)
+            writer.join()
+        self.assertGreater(len(batches), 1)
+        self.assertGreater(sum(b.size for b in batches), 0.9 * 2000 * 64)
+
+
+class TestNumpyBackend(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        cls.files = synthetic.generate(cls.dir, START - 1, 4, NCOLS, NROWS, rate=200, seed=2)
+        # a partial packet before the first header and a truncated word at the end
+        words = np.fromfile(cls.files[1], dtype='>u8')
+        with open(cls.files[1], 'wb') as f:
+            f.write(words[3:].tobytes() + b'\x00\x01\x02')
+        cls.bmap = small_beammap()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    def test_extract_matches_c(self):
+        from mkidcore.binfile import mkidbin, npbin
+        for include_baseline in (False, True):
+            c = mkidbin.extract(self.dir, START, 2, self.bmap, NCOLS, NROWS, include_baseline=include_baseline)
+            py = npbin.extract(self.dir, START, 2, self.bmap, NCOLS, NROWS, include_baseline=include_baseline)
+            self.assertEqual(c.dtype, py.dtype)
+            self.assertEqual(c.tobytes(), py.tobytes())
+
+    def test_iter_extract_matches_c(self):
+        from mkidcore.binfile import mkidbin, npbin
+        c = mkidbin.iter_extract(self.dir, START, 2, self.bmap, chunk_seconds=0.6)
+        py = npbin.iter_extract(self.dir, START, 2, self.bmap, chunk_seconds=0.6)
+        for cchunk, pychunk in zip(c, py):
+            self.assertEqual(cchunk.tobytes(), pychunk.tobytes())
+
+    def test_header_index_matches_c(self):
+        from mkidcore.binfile import mkidbin, npbin
+        with tempfile.TemporaryDirectory() as d:
+            files = synthetic.generate(d, START - 1, 3, NCOLS, NROWS, rate=100, seed=5)
+            c = mkidbin.extract_window(d, START, 0.2, 0.45, self.bmap)
+            index = npbin.header_index(files[1])  # read from the sidecar the C code wrote
+            rebuilt = npbin.header_index(files[1], cache=False)
+            for a, b in zip(index, rebuilt):
+                self.assertEqual(a.tobytes(), b.tobytes())
+            self.assertEqual(c.tobytes(), npbin.extract_window(d, START, 0.2, 0.45, self.bmap).tobytes())
+
+    def test_extractor_matches_c(self):
+        from mkidcore.binfile import mkidbin, npbin
+        c, py = mkidbin.Extractor(self.bmap), npbin.Extractor(self.bmap)
+        np.testing.assert_array_equal(c.resids, py.resids)
+        for t0, t1 in ((0, 0.4), (0.9, 1.6)):
+            cout = c.extract_window(self.dir, START, t0, t1, resid_offsets=True)
+            pyout = py.extract_window(self.dir, START, t0, t1, resid_offsets=True)
+            for a, b in zip(cout, pyout):
+                self.assertEqual(a.dtype, b.dtype)
+                self.assertEqual(a.tobytes(), b.tobytes())
+
+    def test_histogram_matches_c(self):
+        from mkidcore.binfile import mkidbin, npbin
+        edges = [-90, -20, 0, 5, 90]
+        for kwargs in (dict(), dict(wavelength_bins=edges), dict(time_bin=0.1), dict(wavelength_bins=edges,
+                                                                                    time_bin=0.3)):
+            c = mkidbin.histogram(self.dir, START, 2, self.bmap, **kwargs)
+            py = npbin.histogram(self.dir, START, 2, self.bmap, **kwargs)
+            self.assertEqual(c.dtype, py.dtype)
+            np.testing.assert_array_equal(c, py)
+
+    def test_parse_matches_c(self):
+        from mkidcore.binfile import mkidbin, npbin
+        for file in self.files[:2]:
+            c, py = mkidbin.parse(file), npbin.parse(file)
+            self.assertEqual(c.dtype, py.dtype)
+            self.assertEqual(c.tobytes(), py.tobytes())
+            c, py = mkidbin.parse(file, compact=True), npbin.parse(file, compact=True)
+            self.assertEqual(c.dtype, py.dtype)
+            for name in c.dtype.names:
+                np.testing.assert_array_equal(c[name], py[name])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,269 @@
+import os
+import tempfile
+import unittest
+from unittest import TestCase, mock
+
+import numpy as np
+
+from mkidcore.objects import Beammap, TimeStream, _read_beammap
+from mkidcore.pixelflags import beammap as beamMapFlags
+
+
+class TestBeammap(TestCase):
+    def test_extraction_array(self):
+        bmap = Beammap('MEC')
+        bmarr = bmap.extraction_array()
+        self.assertIs(bmarr, bmap.extraction_array(bmap.ncols, bmap.nrows))
+        self.assertFalse(bmarr.flags.writeable)
+        self.assertTrue(bmarr.flags.c_contiguous)
+        np.testing.assert_array_equal(bmarr, np.column_stack((bmap.resIDs, bmap.flags, bmap.xCoords,
+                                                              bmap.yCoords)).astype(int))
+
+        bmap.xCoords = bmap.xCoords[::-1].copy()
+        self.assertIsNot(bmarr, bmap.extraction_array())
+        np.testing.assert_array_equal(bmap.extraction_array()[:, 2], bmap.xCoords.astype(int))
+
+        bmarr = bmap.extraction_array()
+        with self.assertRaises(ValueError):
+            bmap.yCoords[0] = np.nan  # read only, so the cached array can't go stale
+        self.assertIs(bmarr, bmap.extraction_array())
+        y = bmap.yCoords.copy()
+        y[0] = np.nan
+        bmap.yCoords = y
+        with self.assertRaises(Exception):
+            bmap.extraction_array()
+        y[0] = bmap.nrows
+        bmap.yCoords = y
+        with self.assertRaises(Exception):
+            bmap.extraction_array()
+
+    def test_copy(self):
+        bmap = Beammap('MEC')
+        bmarr = bmap.extraction_array()
+        copy = bmap.copy()
+        copy.flags = np.ones_like(copy.flags)
+        self.assertIs(bmarr, bmap.extraction_array())
+        self.assertTrue((copy.extraction_array()[:, 1] == 1).all())
+
+    def test_storage(self):
+        bmap = Beammap('MEC')
+        self.assertTrue(np.isnan(bmap.frequencies).all())
+        for name in ('resIDs', 'flags', 'xCoords', 'yCoords', 'frequencies', 'attenuations'):
+            self.assertTrue(np.shares_memory(getattr(bmap, name), bmap._data))
+        self.assertLessEqual(bmap._data.itemsize, 24)
+
+        bmap.setData(np.array([[10, 1, 0.5, 2, 4000.25], [11, 0, 1, 3, 4100]]))
+        self.assertEqual(bmap.resIDs.dtype, np.uint32)
+        np.testing.assert_array_equal(bmap.xCoords, [0.5, 1])
+        np.testing.assert_array_equal(bmap.frequencies, [4000.25, 4100])
+        bmap.setData(np.array([[12, 0, 1, 1], [13, 0, 2, 2]]))
+        np.testing.assert_array_equal(bmap.frequencies, [4000.25, 4100])
+        bmap.setData(np.array([[14, 0, 1, 1]]))
+        self.assertTrue(np.isnan(bmap.frequencies).all())
+
+        # invalid resIDs and flags are refused, not wrapped or truncated, and leave the data as it was
+        for data in ([[-5, 0, 1, 1]], [[np.nan, 0, 1, 1]], [[2 ** 32, 0, 1, 1]], [[14, 300, 1, 1]],
+                     [[14, 1.5, 1, 1]], [[14, -1, 1, 1], [15, 0, 2, 2]]):
+            with self.assertRaises(ValueError):
+                bmap.setData(np.array(data))
+        for name, value in (('resIDs', [-5]), ('resIDs', [np.inf]), ('flags', 256), ('flags', ['a'])):
+            with self.assertRaises(ValueError):
+                setattr(bmap, name, value)
+        np.testing.assert_array_equal(bmap.resIDs, [14])
+        bmap.flags = [np.uint64(3)]
+        self.assertEqual(bmap.flags[0], 3)
+        bmap.flags = 0
+
+        copy = bmap.copy()
+        self.assertFalse(np.shares_memory(copy._data, bmap._data))
+        copy.frequencies = [5000]
+        copy.resIDs = [15]
+        self.assertEqual((bmap.resIDs[0], copy.resIDs[0]), (14, 15))
+        self.assertTrue(np.isnan(bmap.frequencies[0]))
+
+    def test_load_cache(self):
+        mec = Beammap('MEC')
+        with tempfile.TemporaryDirectory() as d, mock.patch.dict(os.environ, {'MKIDCORE_CACHE_DIR': d}):
+            file = os.path.join(d, 'test.bmap')
+            mec.save(file)
+            _read_beammap.cache_clear()
+            bmap = Beammap(file, xydim=(mec.ncols, mec.nrows))
+            cached = [f for f in os.listdir(d) if f.endswith('.npy')]
+            self.assertEqual(len(cached), 1)
+            bmap.flags = np.full_like(bmap.flags, 7)
+            _read_beammap.cache_clear()
+            for _ in range(2):  # from the .npy, then from memory
+                again = Beammap(file, xydim=(mec.ncols, mec.nrows))
+                np.testing.assert_array_equal(again.resIDs, mec.resIDs)
+                np.testing.assert_array_equal(again.flags, mec.flags)
+                np.testing.assert_allclose(again.xCoords, mec.xCoords, atol=1e-5)
+
+            mec.flags = np.ones_like(mec.flags)
+            mec.save(file)
+            os.utime(file, ns=(0, 0))
+            np.testing.assert_array_equal(Beammap(file, xydim=(mec.ncols, mec.nrows)).flags, 1)
+            self.assertNotIn(cached[0], os.listdir(d))
+
+            bad = os.path.join(d, 'bad.bmap')
+            np.savetxt(bad, [[10000, 0, 1, 1], [-5, 0, 2, 2]])
+            with self.assertRaises(ValueError):
+                Beammap(bad, xydim=(mec.ncols, mec.nrows))
+
+    def test_lookups(self):
+        bmap = Beammap('MEC')
+        bmap.ncols, bmap.nrows = 4, 3
+        # a duplicated pixel, a duplicated resID, a pixel off the array and an empty pixel (3, 2)
+        bmap.setData(np.array([[10, 0, 0, 0], [11, 0, 0.5, 1.7], [12, 1, 0, 1], [12, 0, 1, 0], [13, 0, 5, 1],
+                               [14, 0, 3, 1], [15, 0, 2, 2]]))
+        for x in range(-1, 6):
+            for y in range(-1, 4):
+                expected = bmap.resIDs[(np.floor(bmap.xCoords) == x) & (np.floor(bmap.yCoords) == y)]
+                np.testing.assert_array_equal(bmap.resIDat(x, y), expected)
+        np.testing.assert_array_equal(bmap.resIDat(0, 1), [11, 12])
+        np.testing.assert_array_equal(bmap.resIDat(5, 1), [13])
+        self.assertEqual(bmap.resIDat(0.5, 1).size, 0)
+
+        np.testing.assert_array_equal(bmap.resids_at([0, 0, 3, 5, 2], [0, 1, 2, 1, 2]), [10, 12, -1, -1, 15])
+        xs, ys = np.meshgrid(np.arange(4), np.arange(3), indexing='ij')
+        np.testing.assert_array_equal(bmap.resids_at(xs, ys, missing=0), bmap.residmap)
+
+        np.testing.assert_array_equal(bmap.rows_for_resids([12, 15, 99, 10]), [2, 6, -1, 0])
+        self.assertEqual(bmap.getResonatorData(12)[:4], [12, 1, 0, 1])
+        np.testing.assert_array_equal(bmap.getResonatorFlag(12), [1, 0])
+        with self.assertRaises(ValueError):
+            bmap.getResonatorData(99)
+
+        bmap.resIDs = bmap.resIDs + 100
+        np.testing.assert_array_equal(bmap.rows_for_resids([112, 12]), [2, -1])
+        np.testing.assert_array_equal(bmap.resIDat(0, 0), [110])
+        x = bmap.xCoords.copy()
+        x[0] = 3
+        bmap.xCoords = x
+        np.testing.assert_array_equal(bmap.resids_at([0, 3], [0, 0]), [-1, 110])
+
+    def test_load_frequencies(self):
+        bmap = Beammap('MEC')
+        bmap.setData(np.array([[10000, 0, 0, 0], [10001, 0, 1, 0], [10002, 0, 2, 0]]))
+        with tempfile.TemporaryDirectory() as d:
+            np.savetxt(os.path.join(d, 'ps_a.txt'), [[10000, 4e9, 50], [10002, 5e9, 60], [10002, 6e9, 70]])
+            np.savetxt(os.path.join(d, 'ps_b.txt'), [[30000, 6e9, 70]])
+            bmap.loadFrequencies(os.path.join(d, 'ps_*.txt'))
+            np.testing.assert_array_equal(bmap.frequencies, [4000, np.nan, 6000])
+            np.testing.assert_array_equal(bmap.attenuations, [50, np.nan, 70])
+            np.savetxt(os.path.join(d, 'wide.txt'), [[10001, 0, 0, 0, 0, 7e9, 55, 0, 0]])
+            bmap.loadFrequencies(os.path.join(d, 'wide.txt'))
+            np.testing.assert_array_equal(bmap.frequencies, [np.nan, 7000, np.nan])
+
+    def test_retune_map(self):
+        bmap = Beammap('MEC')
+        bmap.setData(np.array([[10000, 0, 0, 0], [10001, 0, 1, 0], [10002, 0, 2, 0], [10003, 1, 3, 0],
+                               [20000, 0, 4, 0]]))
+        with tempfile.TemporaryDirectory() as d:
+            file = os.path.join(d, 'boardA.txt')
+            np.savetxt(file, [[10000, 10001, 1], [10001, 10000, 4], [10002, np.nan, 1], [np.nan, 10005, 1],
+                              [11500, 10000, 1]])
+            bmap.retuneMap(newIDsboardA=file)
+        np.testing.assert_array_equal(bmap.resIDs, [10001, 10000, 10002, 10003, 20000])
+        np.testing.assert_array_equal(bmap.flags, [beamMapFlags['good'], beamMapFlags['failed'],
+                                                   beamMapFlags['failed'], 1, 0])
+        self.assertEqual(len(bmap.reassignmentList), 4)
+        np.testing.assert_array_equal(bmap.resIDat(0, 0), [10001])
+
+    def test_maps(self):
+        bmap = Beammap('MEC')
+        bmap.ncols, bmap.nrows = 3, 2
+        bmap.setData(np.array([[10, 0, 0, 0], [11, 2, 1.5, 1], [12, 1, 1, 1], [13, 0, 5, 1], [14, 0, 2, 0]]))
+        version = bmap.version
+        np.testing.assert_array_equal(bmap.residmap, [[10, 0], [0, 12], [14, 0]])
+        np.testing.assert_array_equal(bmap.flagmap, [[0, 0], [0, 1], [0, 0]])
+        np.testing.assert_array_equal(bmap.failmask, [[False, True, False], [True, True, True]])
+        for name in ('residmap', 'flagmap', 'failmask'):
+            image = getattr(bmap, name)
+            self.assertIs(image, getattr(bmap, name))
+            with self.assertRaises(ValueError):
+                image[0, 0] = 1
+
+        residmap = bmap.residmap
+        bmap.flags = np.zeros(5, dtype=int)
+        self.assertGreater(bmap.version, version)
+        self.assertIsNot(residmap, bmap.residmap)
+        self.assertFalse(bmap.failmask[1, 1])
+        x = bmap.xCoords.copy()
+        x[0] = 1
+        bmap.xCoords = x
+        np.testing.assert_array_equal(bmap.residmap, [[0, 0], [10, 12], [14, 0]])
+        bmap.ncols = 6
+        self.assertEqual(bmap.residmap[5, 1], 13)
+
+    def test_cached_arrays_follow_edits(self):
+        bmap = Beammap('MEC')
+        bmap.ncols, bmap.nrows = 8, 2
+        bmap.setData(np.array([[10, 0, 0, 0], [11, 0, 1, 1], [12, 1, 2, 0]]))
+        # fill every cache, then check none of them survive a change
+        bmap.residmap, bmap.flagmap, bmap.failmask, bmap.extraction_array(), bmap.resIDat(0, 0)
+        bmap.getResonatorFlag(12)
+        for name in ('resIDs', 'flags', 'xCoords', 'yCoords'):
+            with self.assertRaises(ValueError):
+                getattr(bmap, name)[0] = 7
+
+        x = bmap.xCoords.copy()
+        x[0] = 7
+        bmap.xCoords = x
+        self.assertEqual(bmap.resIDat(0, 0).size, 0)
+        np.testing.assert_array_equal(bmap.resIDat(7, 0), [10])
+        np.testing.assert_array_equal(bmap.resids_at([0, 7], [0, 0]), [-1, 10])
+        self.assertEqual((bmap.residmap[0, 0], bmap.residmap[7, 0]), (0, 10))
+        self.assertEqual((bmap.failmask[0, 0], bmap.failmask[0, 7]), (True, False))
+        self.assertEqual(bmap.extraction_array()[0, 2], 7)
+
+        flags = bmap.flags.copy()
+        flags[2] = 0
+        bmap.flags = flags
+        np.testing.assert_array_equal(bmap.getResonatorFlag(12), [0])
+        self.assertEqual(bmap.flagmap[2, 0], 0)
+        self.assertFalse(bmap.failmask[0, 2])
+
+        bmap.resIDs = [10, 20, 12]
+        np.testing.assert_array_equal(bmap.rows_for_resids([11, 20]), [-1, 1])
+        np.testing.assert_array_equal(bmap.getResonatorFlag(20), [0])
+        self.assertEqual(bmap.residmap[1, 1], 20)
+
+
+class TestTimeStream(TestCase):
+    def test_formats(self):
+        phase = np.random.default_rng(0).normal(size=10007).astype(np.float32)
+        with tempfile.TemporaryDirectory() as d:
+            for file, dtype in (('ts.npz', None), ('ts.npy', None), ('ts.bin', np.float32)):
+                TimeStream(os.path.join(d, file), phase=phase, dtype=dtype).save()
+                ts = TimeStream(os.path.join(d, file), dtype=dtype)
+                self.assertEqual(len(ts), phase.size)
+                np.testing.assert_array_equal(ts.phase, phase)
+                np.testing.assert_array_equal(ts[100:2000], phase[100:2000])
+                chunks = list(ts.iter_chunks(1000))
+                self.assertEqual(len(chunks), 11)
+                self.assertTrue(all(c.flags.writeable for c in chunks))
+                np.testing.assert_array_equal(np.concatenate(chunks), phase)
+                if file != 'ts.npz':
+                    self.assertIsInstance(ts.phase, np.memmap)
+                # saving a stream read from its file rewrites it, rather than truncating what is being read
+                ts.save()
+                ts.clear()
+                np.testing.assert_array_equal(TimeStream(os.path.join(d, file), dtype=dtype).phase, phase)
+                self.assertFalse([f for f in os.listdir(d) if f.endswith('.tmp')])
+
+            # the directory is made if it doesn't exist
+            for _ in range(2):
+                TimeStream(os.path.join(d, 'new', 'ts.npy'), phase=phase).save()
+            np.testing.assert_array_equal(TimeStream(os.path.join(d, 'new', 'ts.npy')).phase, phase)
+
+    def test_yaml(self):
+        from io import StringIO
+        from mkidcore.config import yaml
+        out = StringIO()
+        yaml.dump(TimeStream('/a/ts.bin', name='r1', dtype='<f4'), out)
+        ts = yaml.load(out.getvalue())
+        self.assertEqual((ts.file_path, ts.name, ts.dtype), ('/a/ts.bin', 'r1', np.float32))
+
+
+if __name__ == "__main__":
+    unittest.main()